@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+# Statistic agent for WireGuard hosts, python 3.7+ standard library only.
+# Reads peers with `wg show all dump` (or netlink, if wgnlpy is installed) and pushes changed peers
+# to wg-manager, full report every --full-every cycles.
+#
+# Token: `python manage.py agent_token --server <name>` on wg-manager host, then:
+#   WG_AGENT_TOKEN=<token> wg_agent.py --url https://vpn.example.com
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+logger = logging.getLogger('wg_agent')
+
+
+def read_wg() -> dict:
+    out = subprocess.run(['wg', 'show', 'all', 'dump'], capture_output=True, check=True, text=True).stdout
+    peers = {}
+    for line in out.split('\n'):
+        fields = line.split('\t')
+        if len(fields) != 9:
+            continue
+        interface, public_key, _, endpoint, allowed, handshake, rx, tx, _ = fields
+        peers[public_key] = [interface, None if endpoint == '(none)' else endpoint,
+                             None if allowed == '(none)' else allowed, int(handshake), int(rx), int(tx)]
+    return peers
+
+
+def read_netlink(interfaces: list) -> dict:
+    from wgnlpy import WireGuard
+    wg = WireGuard()
+    peers = {}
+    for interface in interfaces:
+        for public_key, peer in wg.get_interface(interface).peers.items():
+            peers[str(public_key)] = [interface, str(peer.endpoint) if peer.endpoint else None,
+                                      ','.join(str(ip) for ip in peer.allowedips) or None,
+                                      int(peer.last_handshake_time or 0), peer.rx_bytes, peer.tx_bytes]
+    return peers
+
+
+def push(url: str, token: str, report: dict, timeout: int) -> dict:
+    body = gzip.compress(json.dumps(report, separators=(',', ':')).encode())
+    request = urllib.request.Request(f'{url.rstrip("/")}/agent/ingest/', data=body, method='POST', headers={
+        'Content-Type': 'application/json', 'Content-Encoding': 'gzip', 'Authorization': f'Bearer {token}'})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def run(args):
+    token = args.token or os.environ.get('WG_AGENT_TOKEN')
+    if not token:
+        sys.exit('token is required: --token or WG_AGENT_TOKEN')
+    sent = {}
+    cycle = 0
+    while True:
+        started = time.monotonic()
+        try:
+            peers = read_netlink(args.interface or ['wg0']) if args.netlink else read_wg()
+        except Exception as e:
+            logger.error(f'read peers: {e}')
+            peers = None
+        if peers is not None:
+            full = cycle % args.full_every == 0
+            changed = peers if full else {key: peer for key, peer in peers.items() if sent.get(key) != peer}
+            if changed or full:
+                try:
+                    result = push(args.url, token, {'ts': int(time.time()), 'full': full, 'peers': changed},
+                                  args.timeout)
+                    logger.info(f'pushed {len(changed)} of {len(peers)} peers: {result}')
+                    sent = peers
+                    cycle += 1
+                except (urllib.error.URLError, OSError, ValueError) as e:
+                    # Next report is full, the server may have missed this one
+                    logger.error(f'push: {e}')
+                    cycle = 0
+            else:
+                cycle += 1
+        if args.once:
+            return
+        time.sleep(max(0.0, args.interval - (time.monotonic() - started)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Push WireGuard peer statistic to wg-manager')
+    parser.add_argument('--url', required=True, help='wg-manager base url')
+    parser.add_argument('--token', help='Agent token (or WG_AGENT_TOKEN environment variable)')
+    parser.add_argument('--interval', type=float, default=30, help='Seconds between reports')
+    # Full report must come more often than STATS_TTL of wg-manager (300 seconds by default)
+    parser.add_argument('--full-every', type=int, default=8, help='Send all peers every N reports')
+    parser.add_argument('--timeout', type=int, default=10, help='Push timeout, seconds')
+    parser.add_argument('--netlink', action='store_true', help='Read peers via netlink (needs wgnlpy)')
+    parser.add_argument('--interface', action='append', help='Interface for --netlink, may be repeated')
+    parser.add_argument('--once', action='store_true', help='Push once and exit')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -67,6 +67,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'config.wsgi.application'
+ASGI_APPLICATION = 'config.asgi.application'
 
 DATABASES = {
     'default': {
@@ -116,5 +117,73 @@ CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
         'LOCATION': '/var/tmp/django_cache',
-    }
+    },
+    # Last peer statistic with STATS_STORE=cache, one entry per peer. Kept apart from the default cache,
+    # FileBasedCache culls a third of entries above MAX_ENTRIES, so it must hold all peers
+    'stats': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': '/var/tmp/django_cache_stats',
+        'OPTIONS': {'MAX_ENTRIES': config('STATS_CACHE_MAX_ENTRIES', default=100000, cast=int)},
+    },
 }
+
+# SSH connections to WireGuard servers are pooled and reused between operations
+SSH_CONNECT_TIMEOUT = config('SSH_CONNECT_TIMEOUT', default=3, cast=int)
+SSH_KEEPALIVE = config('SSH_KEEPALIVE', default=30, cast=int)
+SSH_POOL_IDLE_TIMEOUT = config('SSH_POOL_IDLE_TIMEOUT', default=300, cast=int)
+# Peer changes above this size are applied with `wg syncconf` instead of one `wg set`
+WG_SET_BATCH_LIMIT = config('WG_SET_BATCH_LIMIT', default=200, cast=int)
+# Client changes are coalesced into one push per server after this many seconds (0 - push at commit)
+PUSH_DEBOUNCE = config('PUSH_DEBOUNCE', default=2.0, cast=float)
+# Failed pushes are retried after PUSH_DEBOUNCE (at least a second), doubled up to PUSH_RETRY_MAX seconds
+PUSH_RETRY_MAX = config('PUSH_RETRY_MAX', default=300, cast=int)
+
+# Run remote server operations from the job queue (`manage.py run_worker`) instead of the request
+JOB_QUEUE = config('JOB_QUEUE', default=False, cast=bool)
+JOB_MAX_ATTEMPTS = config('JOB_MAX_ATTEMPTS', default=5, cast=int)
+JOB_RETRY_BASE = config('JOB_RETRY_BASE', default=10, cast=int)
+JOB_RETRY_MAX = config('JOB_RETRY_MAX', default=600, cast=int)
+JOB_TIMEOUT = config('JOB_TIMEOUT', default=600, cast=int)
+
+# Multi-server admin actions and the job worker talk to servers concurrently
+FAN_OUT_WORKERS = config('FAN_OUT_WORKERS', default=16, cast=int)
+FAN_OUT_TIMEOUT = config('FAN_OUT_TIMEOUT', default=30, cast=int)
+
+# Peer traffic history (`manage.py collect_stats`): poll interval and retention of raw/hourly samples, seconds
+STATS_INTERVAL = config('STATS_INTERVAL', default=60, cast=int)
+STATS_RAW_RETENTION = config('STATS_RAW_RETENTION', default=86400, cast=int)
+STATS_RETENTION = config('STATS_RETENTION', default=86400 * 90, cast=int)
+
+# Last peer statistic storage: "sqlite" - SQLite table in WAL mode at STATS_STORE_PATH, "cache" - "stats" cache above
+STATS_STORE = config('STATS_STORE', default='sqlite')
+STATS_STORE_PATH = config('STATS_STORE_PATH', default='/var/tmp/wg_stats.sqlite3')
+STATS_TTL = config('STATS_TTL', default=300, cast=int)
+
+# Rendered client configs for download links are cached for this many seconds
+CLIENT_CONFIG_TTL = config('CLIENT_CONFIG_TTL', default=86400, cast=int)
+
+# Admin dashboard event stream: check for new statistic every DASHBOARD_INTERVAL seconds,
+# close the stream after DASHBOARD_STREAM_TTL (browser reconnects)
+DASHBOARD_INTERVAL = config('DASHBOARD_INTERVAL', default=2, cast=float)
+DASHBOARD_STREAM_TTL = config('DASHBOARD_STREAM_TTL', default=300, cast=int)
+
+# Agent reports (agent/wg_agent.py): limit of uncompressed body, bytes
+AGENT_MAX_BODY = config('AGENT_MAX_BODY', default=64 * 1024 * 1024, cast=int)
+
+# Changing operations on one server are serialized with a file lock (shared by all workers of the host)
+SERVER_LOCK_DIR = config('SERVER_LOCK_DIR', default='/var/tmp/wg_locks')
+SERVER_LOCK_TIMEOUT = config('SERVER_LOCK_TIMEOUT', default=60, cast=float)
+OPERATION_LOG_DAYS = config('OPERATION_LOG_DAYS', default=7, cast=int)
+
+# Control plane metrics (/metrics, Servers -> Metrics in admin): each process publishes its counters
+# every METRICS_FLUSH seconds. /metrics is open to staff users or to "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_ENABLED = config('METRICS_ENABLED', default=True, cast=bool)
+METRICS_FLUSH = config('METRICS_FLUSH', default=10, cast=int)
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
+
+# Automatic client placement (client without server, `rebalance_clients`): peers per server unless
+# data["max_peers"] is set, traffic of the last PLACEMENT_WINDOW seconds counts,
+# rebalance stops when loads differ by no more than PLACEMENT_THRESHOLD (0..1)
+PLACEMENT_MAX_PEERS = config('PLACEMENT_MAX_PEERS', default=5000, cast=int)
+PLACEMENT_WINDOW = config('PLACEMENT_WINDOW', default=900, cast=int)
+PLACEMENT_THRESHOLD = config('PLACEMENT_THRESHOLD', default=0.1, cast=float)
@@ -1,17 +1,27 @@
 # -*- coding: utf-8 -*-
 
 import json
+from datetime import datetime
+from ipaddress import ip_address
 
 from django.contrib import admin
 from django.contrib import messages
-from django.http import HttpResponseRedirect
+from django.contrib.admin.views.main import ChangeList
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponseRedirect, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.template.response import TemplateResponse
 from django.utils.html import format_html
 from django import forms
 from loguru import logger
-from .models import Server, Group, Client
+from .models import Server, Group, Client, Job, Operation, PeerSample, prefetch_stats
 from django.urls import path
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
+from django.contrib.auth.models import User
 from django.db import models
+from django.db.models import Exists, OuterRef, Q
 from django.forms import Textarea
 
 from .services import get_client_file
@@ -30,6 +40,22 @@ cfg_link = _('Cfg link')
 download_link = _('Download cfg')
 
 
+def visible_clients(clients, user):
+    # Clients of users sharing a group with the user, EXISTS instead of join: no duplicate rows, no distinct()
+    if user.is_superuser:
+        return clients
+    shared = User.groups.through.objects.filter(user_id=OuterRef('user_id'), group_id__in=user.groups.values('id'))
+    return clients.filter(Exists(shared))
+
+
+def export_zip(request, clients, folder, filename):
+    # Streamed archive with configs of the clients visible to the user, folder per group or server
+    from .export import iter_zip
+    clients = visible_clients(clients, request.user)
+    return StreamingHttpResponse(iter_zip(clients, folder), content_type='application/zip',
+                                 headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
 def check_if_user_in_group(user, group_name):
     if user.is_superuser:
         return True
@@ -42,8 +68,9 @@ def check_if_user_in_group(user, group_name):
 class ServerAdmin(admin.ModelAdmin):
     list_display = ['name', 'server', 'interface', 'network', 'is_enable']
     readonly_fields = ['ssh_copy_id_help', ]
-    actions = ['server_restart', 'server_statistic']
+    actions = ['server_restart', 'server_statistic', 'export_configs']
     form = DataForm
+    change_list_template = 'admin/vpn/server/change_list.html'
 
     @staticmethod
     def server(obj):
@@ -51,7 +78,7 @@ class ServerAdmin(admin.ModelAdmin):
 
     @staticmethod
     def interface(obj):
-        return f'{obj.data.get("interface")}'
+        return ', '.join(server_interface['name'] for server_interface in obj.interfaces)
 
     def get_actions(self, request):
         actions = super(ServerAdmin, self).get_actions(request)
@@ -69,13 +96,14 @@ class ServerAdmin(admin.ModelAdmin):
 
     @admin.action(description='Restart server')
     def server_restart(self, request, queryset):
-        from vpn.services import ssh_remote_server
-        for srv in queryset:
-            status = ssh_remote_server(srv, restart=True)
-            if not status.get('ok'):
-                self.message_user(request, f'Error to restart server {srv} - {status.get("msg")}', messages.ERROR)
-            if status.get('ok'):
-                self.message_user(request, f'Server {srv} restart OK !', messages.SUCCESS)
+        from vpn.services import ssh_remote_server, fan_out
+        if settings.JOB_QUEUE:
+            self.enqueue_jobs(request, queryset, 'restart')
+            return
+        servers = list(queryset)
+        results = fan_out(servers, lambda srv: ssh_remote_server(srv, restart=True), settings.FAN_OUT_TIMEOUT)
+        self.message_summary(request, 'restart', servers, results)
+        for srv in servers:
             if not srv.is_enable:
                 srv.is_enable = True
                 srv.save()
@@ -83,21 +111,135 @@ class ServerAdmin(admin.ModelAdmin):
 
     @admin.action(description='Server statistic')
     def server_statistic(self, request, queryset):
-        from vpn.services import ssh_remote_server
+        from vpn.services import ssh_remote_server, fan_out
+        if settings.JOB_QUEUE:
+            self.enqueue_jobs(request, queryset.filter(is_enable=True), 'statistic')
+            return
+        for srv in queryset.filter(is_enable=False):
+            self.message_user(request, f'Server  {srv} is not active !', messages.WARNING)
+        servers = list(queryset.filter(is_enable=True))
+        results = fan_out(servers, lambda srv: ssh_remote_server(srv, statistic=True), settings.FAN_OUT_TIMEOUT)
+        self.message_summary(request, 'statistic', servers, results)
+
+    @admin.action(description='Export client configs (zip)')
+    def export_configs(self, request, queryset):
+        return export_zip(request, Client.objects.filter(server__in=queryset), 'server', 'vpn-servers.zip')
+
+    def dashboard(self, request):
+        if not request.user.is_superuser:
+            raise PermissionDenied
+        context = {**self.admin_site.each_context(request), 'opts': self.model._meta, 'title': _('Dashboard')}
+        return TemplateResponse(request, 'admin/vpn/server/dashboard.html', context)
+
+    def metrics(self, request):
+        from .metrics import collect, summary
+        if not request.user.is_superuser:
+            raise PermissionDenied
+        context = {**self.admin_site.each_context(request), 'opts': self.model._meta, 'title': _('Metrics'),
+                   'rows': summary(collect())}
+        return TemplateResponse(request, 'admin/vpn/server/metrics.html', context)
+
+    def dashboard_stream(self, request):
+        # Server-sent events, async iterator under ASGI does not hold a thread per open dashboard
+        from django.core.handlers.asgi import ASGIRequest
+        from .dashboard import DashboardFeed, aiter_events, iter_events
+        if not request.user.is_superuser:
+            raise PermissionDenied
+        feed = DashboardFeed(list(Server.objects.filter(is_enable=True).values_list('id', flat=True)))
+        events = aiter_events(feed) if isinstance(request, ASGIRequest) else iter_events(feed)
+        return StreamingHttpResponse(events, content_type='text/event-stream',
+                                     headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    def get_urls(self):
+        custom_urls = [
+            path('dashboard/', self.admin_site.admin_view(self.dashboard), name='vpn_server_dashboard'),
+            path('dashboard/stream/', self.admin_site.admin_view(self.dashboard_stream),
+                 name='vpn_server_dashboard_stream'),
+            path('metrics/', self.admin_site.admin_view(self.metrics), name='vpn_server_metrics'), ]
+        return custom_urls + super().get_urls()
+
+    def message_summary(self, request, operation, servers, results):
+        # One message for all servers instead of one per server
+        errors = [f'{srv} - {status.get("msg")}' for srv, status in zip(servers, results) if not status.get('ok')]
+        if len(errors) < len(servers):
+            self.message_user(request, f'Server {operation} OK: {len(servers) - len(errors)} of {len(servers)} !',
+                              messages.SUCCESS)
+        if errors:
+            self.message_user(request, f'Server {operation} error: {"; ".join(errors)}', messages.ERROR)
+
+    def enqueue_jobs(self, request, queryset, operation):
+        from vpn.jobs import enqueue
         for srv in queryset:
-            if not srv.is_enable:
-                self.message_user(request, f'Server  {srv} is not active !', messages.WARNING)
-                continue
-            status = ssh_remote_server(srv, statistic=True)
-            if not status.get('ok'):
-                self.message_user(request, f'Error to get statistic from  {srv} - {status.get("msg")}', messages.ERROR)
-            if status.get('ok'):
-                self.message_user(request, f'Update server {srv} stat OK !', messages.SUCCESS)
+            job = enqueue(srv.id, operation)
+            self.message_user(request, f'Server {srv} {operation} queued (job #{job.id})', messages.INFO)
+            if operation == 'restart' and not srv.is_enable:
+                srv.is_enable = True
+                srv.save()
+                self.message_user(request, f'Server {srv} is active now !', messages.WARNING)
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'server', 'operation', 'status', 'attempts', 'run_after', 'update_at', 'message']
+    list_filter = ['status', 'operation', 'server']
+    list_select_related = ['server']
+    readonly_fields = ['server', 'operation', 'status', 'attempts', 'run_after', 'result', 'created_at', 'update_at']
+    actions = ['job_retry']
+
+    @staticmethod
+    def message(obj):
+        return obj.result.get('msg') or obj.result.get('diff') or '-'
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.action(description='Retry job')
+    def job_retry(self, request, queryset):
+        count = queryset.exclude(status=Job.RUNNING).update(status=Job.PENDING, attempts=0, run_after=timezone.now())
+        self.message_user(request, f'{count} jobs queued again', messages.SUCCESS)
+
+
+@admin.register(Operation)
+class OperationAdmin(admin.ModelAdmin):
+    list_display = ['id', 'server', 'operation', 'status', 'covered_by', 'created_at', 'update_at', 'message']
+    list_filter = ['status', 'operation', 'server']
+    list_select_related = ['server']
+    show_full_result_count = False
+
+    @staticmethod
+    def message(obj):
+        return obj.result.get('msg') or obj.result.get('diff') or '-'
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(PeerSample)
+class PeerSampleAdmin(admin.ModelAdmin):
+    list_display = ['public_key', 'server', 'time', 'resolution', 'rx', 'tx', 'rx_rate', 'tx_rate']
+    list_filter = ['server', 'resolution']
+    list_select_related = ['server']
+    search_fields = ['=public_key']
+    show_full_result_count = False
+
+    @staticmethod
+    def time(obj):
+        return datetime.fromtimestamp(obj.ts, tz=timezone.get_current_timezone())
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
 
 
 @admin.register(Group)
 class GroupAdmin(admin.ModelAdmin):
     list_display = ['name', 'description']
+    actions = ['export_configs']
 
     formfield_overrides = {
         models.TextField: {'widget': Textarea(
@@ -112,23 +254,50 @@ class GroupAdmin(admin.ModelAdmin):
             form.base_fields["ips"].help_text = _("Allowed IPs, comma-separated")
         return form
 
+    @admin.action(description='Export client configs (zip)')
+    def export_configs(self, request, queryset):
+        return export_zip(request, Client.objects.filter(group__in=queryset), 'group', 'vpn-groups.zip')
+
+
+class ClientChangeList(ChangeList):
+    def get_results(self, request):
+        super().get_results(request)
+        prefetch_stats(self.result_list)
+
 
 class ClientForm(forms.ModelForm):
     data = forms.JSONField(encoder=PrettyJSONEncoder, initial=dict, required=False, label='Client json data',
                            help_text='"allowed": add allow ips or nets from client (comma-separated)<br />'
                                      '"ip": ip address for client<br />')
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if not self.instance.pk and 'server' in self.fields:
+            # Empty server of a new client: least loaded server is chosen on save
+            self.fields['server'].required = False
+            self.fields['server'].empty_label = _('Automatic')
+
+
+class ClientImportForm(forms.Form):
+    server = forms.ModelChoiceField(queryset=Server.objects.filter(is_enable=True), label=_('Server'),
+                                    required=False, empty_label=_('Automatic'))
+    group = forms.ModelChoiceField(queryset=Group.objects.all(), label=_('Client group'))
+    file = forms.FileField(label=_('CSV file'))
+
 
 @admin.register(Client)
 class ClientAdmin(admin.ModelAdmin):
     list_display = ['name', 'server', 'ip', 'is_enable', 'enable_download', 'group', 'last_seen', 'traffic',
                     'remote_ip', 'config_link', 'config_download', 'download_count', 'user']
     readonly_fields = ['rnd', 'created_at', 'update_at', 'download_count']
-    search_fields = ['name', 'data__ip']
+    search_fields = ['name', 'ip']
     # list_filter = ['group__name', 'server', 'is_enable']
     list_editable = ['is_enable', 'enable_download']
+    list_select_related = ['server', 'group', 'user']
+    show_full_result_count = False
+    actions = ['export_configs']
     form = ClientForm
-    # change_list_template = "admin/config_wg.html"
+    change_list_template = 'admin/vpn/client/change_list.html'
     # fieldsets = (
     #     (None, {'fields': ('name',)}),
     #     (None, {'fields': ('description',)}),
@@ -146,7 +315,8 @@ class ClientAdmin(admin.ModelAdmin):
     @staticmethod
     @admin.display(description=format_html(f"<center>{ download_link }</center>"))
     def config_download(obj):
-        return format_html(f"<center><a href='get_config/{obj.id}/'>💾</a></center>")
+        return format_html(f"<center><a href='get_config/{obj.id}/'>💾</a>"
+                           f"<a href='get_config/{obj.id}/svg/' target='_blank' title='QR code'> ▦</a></center>")
 
     @staticmethod
     @admin.display(description=format_html(f"<center>{ cfg_link }</center>"))
@@ -155,20 +325,52 @@ class ClientAdmin(admin.ModelAdmin):
                            f"<a href='#' onClick=copyToClipboard('/cfg/{obj.rnd}/') title='Copy link'> ✅</a></center>"
                            )
 
-    @staticmethod
-    def client_config(request, config_id):
-        return get_client_file(config_id)
+    def client_config(self, request, config_id, fmt='conf'):
+        # Only clients the user may see, clients of a deleted server have no config
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        client = get_object_or_404(self.get_queryset(request).select_related('server', 'group').filter(
+            server__isnull=False), id=config_id)
+        return get_client_file(client, request, fmt)
+
+    @admin.action(description='Export configs (zip)')
+    def export_configs(self, request, queryset):
+        return export_zip(request, queryset, 'group', 'vpn-clients.zip')
+
+    def import_csv(self, request):
+        from .ipam import AddressPoolExhausted
+        from .placement import PlacementError
+        from .provision import bulk_create_clients, bulk_place_clients, parse_csv
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+        form = ClientImportForm(request.POST or None, request.FILES or None)
+        if request.method == 'POST' and form.is_valid():
+            try:
+                rows = parse_csv(form.cleaned_data['file'].read().decode('utf-8-sig'))
+                if form.cleaned_data['server']:
+                    clients = bulk_create_clients(form.cleaned_data['server'], rows, group=form.cleaned_data['group'],
+                                                  user=request.user)
+                else:
+                    clients = bulk_place_clients(rows, group=form.cleaned_data['group'], user=request.user)
+            except (ValueError, UnicodeDecodeError, AddressPoolExhausted, PlacementError) as e:
+                self.message_user(request, f'Import error: {e}', messages.ERROR)
+            else:
+                self.message_user(request, f'{len(clients)} clients imported !', messages.SUCCESS)
+                return HttpResponseRedirect('../')
+        context = {**self.admin_site.each_context(request), 'opts': self.model._meta, 'form': form,
+                   'title': _('Import CSV')}
+        return TemplateResponse(request, 'admin/vpn/client/import_csv.html', context)
 
     def get_urls(self):
         urls = super(ClientAdmin, self).get_urls()
         custom_urls = [
-            path('get_config/<int:config_id>/', self.client_config, name='get_client_config'), ]
+            path('get_config/<int:config_id>/', self.admin_site.admin_view(self.client_config),
+                 name='get_client_config'),
+            path('get_config/<int:config_id>/<slug:fmt>/', self.admin_site.admin_view(self.client_config),
+                 name='get_client_config_format'),
+            path('import_csv/', self.admin_site.admin_view(self.import_csv), name='vpn_client_import_csv'), ]
         return custom_urls + urls
 
-    @staticmethod
-    def ip(obj):
-        return f'{obj.data.get("ip")}'
-
     def save_model(self, request, obj, form, change):
         #  Automatic fill in the user field if it is empty
         if not obj.user:
@@ -183,12 +385,24 @@ class ClientAdmin(admin.ModelAdmin):
         return ['name', 'description', 'is_enable', 'enable_download', 'server', 'group', 'data', 'user',
                 'created_at', 'update_at']
 
+    def get_changelist(self, request, **kwargs):
+        return ClientChangeList
+
     def get_queryset(self, request):
         # Show only those clients that belong to the group of the current user
-        qs = super().get_queryset(request)
-        if request.user.is_superuser:
-            return qs
-        return qs.filter(user__groups__in=request.user.groups.all())
+        return visible_clients(super().get_queryset(request), request.user)
+
+    def get_search_results(self, request, queryset, search_term):
+        # Address is looked up by exact match on the indexed column
+        try:
+            address = ip_address(search_term.strip())
+        except ValueError:
+            return super().get_search_results(request, queryset, search_term)
+        if address.version == 4:
+            return queryset.filter(ip=str(address)), False
+        # IPv6 is the main address of an IPv6-only client or data["ip6"] of a dual-stack one, name search still applies
+        found, may_have_duplicates = super().get_search_results(request, queryset, search_term)
+        return found | queryset.filter(Q(ip=str(address)) | Q(data__ip6=str(address))), may_have_duplicates
 
     class Media:
         js = ('admin/js/copy.js',)
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+# WireGuard control backends, selected per server by data["backend"]:
+# "ssh" (default) - `wg` commands and sftp over a pooled ssh connection,
+# "netlink" - manager runs on the WireGuard host itself, peers are read and changed through one
+# netlink socket without spawning processes (needs optional "wgnlpy" package).
+# Both give peers and statistic as structured data: sync.parse_live_peers() / dump.PeerTable.records() format.
+
+import os
+import shlex
+import subprocess
+import uuid
+from contextlib import ExitStack
+
+from django.conf import settings
+from loguru import logger
+
+
+class BackendError(Exception):
+    pass
+
+
+class InterfaceDown(BackendError):
+    pass
+
+
+class SSHBackend:
+    def __init__(self, srv_instance):
+        self.srv = srv_instance
+        self.conn = None
+        self._stack = ExitStack()
+
+    def __enter__(self):
+        from .pool import ssh_pool
+        self.conn = self._stack.enter_context(ssh_pool.connection(self.srv))
+        return self
+
+    def __exit__(self, *exc):
+        self.conn = None
+        return self._stack.__exit__(*exc)
+
+    def run(self, command: str) -> tuple:
+        from .pool import TRANSPORT_ERRORS, SSHConnectError
+        try:
+            return self.conn.run(command)
+        except TRANSPORT_ERRORS as e:
+            # Pooled transport died between health check and use: reconnect and retry once,
+            # commands sent here (wg set / syncconf, service) are safe to repeat
+            logger.warning(f'ssh: command failed on server {self.srv} ({e!r}), reconnecting')
+            self.conn.connect()
+        try:
+            return self.conn.run(command)
+        except TRANSPORT_ERRORS as e:
+            raise SSHConnectError(e) from e
+
+    def peers(self, interface: str) -> dict:
+        from .sync import parse_live_peers
+        exit_code, out, err = self.run(f'wg show {interface} dump')
+        if exit_code != 0:
+            raise InterfaceDown(err.strip())
+        return parse_live_peers(out)
+
+    def apply(self, interface: str, diff):
+        if len(diff) > settings.WG_SET_BATCH_LIMIT:
+            # Too long for one command line, let wg compare with the (already uploaded) config file
+            exit_code, out, err = self.run(f"bash -c 'wg syncconf {interface} <(wg-quick strip {interface})'")
+        else:
+            exit_code, out, err = self.run(diff.wg_set(interface))
+        if exit_code != 0:
+            raise BackendError(err.strip())
+
+    def stats(self) -> dict:
+        from .dump import parse
+        from .metrics import timer
+        exit_code, out, err = self.run('wg show all dump')
+        if exit_code != 0:
+            raise BackendError(err.strip())
+        with timer('wg_dump_parse_seconds', server=self.srv.id):
+            return parse(out).records()
+
+    def write_config(self, path: str, chunks):
+        from .services import write_config_stream
+        # Unique name per call, even if two uploads ever meet they don't write the same file
+        from .pool import TRANSPORT_ERRORS, SSHConnectError
+        tmp_path = f'{path}.{uuid.uuid4().hex[:12]}.tmp'
+        try:
+            with self.conn.sftp.open(tmp_path, 'wb') as file:
+                file.set_pipelined(True)
+                write_config_stream(file, chunks)
+            self.conn.sftp.chmod(tmp_path, 0o600)
+            self.conn.sftp.posix_rename(tmp_path, path)
+        except TRANSPORT_ERRORS as e:
+            # Stream is consumed, no retry here: the next sync uploads again
+            if self.conn.is_alive():
+                raise BackendError(f'{path}: {e}') from e
+            raise SSHConnectError(e) from e
+
+
+class NetlinkBackend:
+    def __init__(self, srv_instance):
+        self.srv = srv_instance
+        self.wg = None
+
+    def __enter__(self):
+        try:
+            from wgnlpy import WireGuard
+        except ImportError:
+            raise BackendError('netlink backend needs "wgnlpy" package')
+        self.wg = WireGuard()
+        return self
+
+    def __exit__(self, *exc):
+        wg, self.wg = self.wg, None
+        if hasattr(wg, 'close'):
+            wg.close()
+        elif hasattr(wg, '_WireGuard__socket'):
+            # wgnlpy closes its netlink socket only when the object is collected
+            wg._WireGuard__socket.close()
+
+    def run(self, command: str) -> tuple:
+        # Only for service restart / stop
+        process = subprocess.run(shlex.split(command), capture_output=True, text=True)
+        return process.returncode, process.stdout, process.stderr
+
+    def _interface(self, interface: str):
+        try:
+            return self.wg.get_interface(interface)
+        except Exception as e:
+            raise InterfaceDown(f'{interface}: {e}')
+
+    def peers(self, interface: str) -> dict:
+        from .sync import normalize_allowed_ips
+        return {
+            str(public_key): {
+                'allowed_ips': normalize_allowed_ips(','.join(str(ip) for ip in peer.allowedips)),
+                'keepalive': str(peer.persistent_keepalive_interval or 'off'),
+            } for public_key, peer in self._interface(interface).peers.items()
+        }
+
+    def apply(self, interface: str, diff):
+        try:
+            if diff.remove:
+                self.wg.remove_peers(interface, *diff.remove)
+            for public_key, peer in {**diff.add, **diff.update}.items():
+                keepalive = 0 if peer['keepalive'] == 'off' else int(peer['keepalive'])
+                self.wg.set_peer(interface, public_key, allowedips=sorted(peer['allowed_ips']),
+                                 replace_allowedips=True, persistent_keepalive_interval=keepalive)
+        except Exception as e:
+            raise BackendError(f'{interface}: {e}')
+
+    def stats(self) -> dict:
+        # Peers of all interfaces which are up, like `wg show all dump`
+        result, down = {}, []
+        for interface in [server_interface['name'] for server_interface in self.srv.interfaces]:
+            try:
+                peers = self._interface(interface).peers
+            except InterfaceDown as e:
+                down.append(e)
+                continue
+            result.update({
+                str(public_key): {
+                    'interface': interface, 'remote_ip': str(peer.endpoint) if peer.endpoint else None,
+                    'local_ip': ','.join(str(ip) for ip in peer.allowedips) or None,
+                    'last_handshake': int(peer.last_handshake_time or 0), 'rx_bytes': peer.rx_bytes,
+                    'tx_bytes': peer.tx_bytes,
+                } for public_key, peer in peers.items()
+            })
+        if down and len(down) == len(self.srv.interfaces):
+            raise down[0]
+        return result
+
+    def write_config(self, path: str, chunks):
+        from .services import write_config_stream
+        # Unique name per call, even if two uploads ever meet they don't write the same file
+        tmp_path = f'{path}.{uuid.uuid4().hex[:12]}.tmp'
+        with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as file:
+            write_config_stream(file, chunks)
+        os.replace(tmp_path, path)
+
+
+BACKENDS = {
+    'ssh': SSHBackend,
+    'netlink': NetlinkBackend,
+}
+
+
+def get_backend(srv_instance):
+    name = srv_instance.data.get('backend') or 'ssh'
+    if name not in BACKENDS:
+        raise BackendError(f'unknown backend "{name}" of server {srv_instance}')
+    return BACKENDS[name](srv_instance)
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+import os
+import random
+import tempfile
+import time
+from base64 import b64encode
+from contextlib import contextmanager
+
+from django.conf import settings
+
+
+def timeit(func, repeat: int = 3, setup=None) -> float:
+    # Best of N runs, seconds. setup() runs before each run and is not timed
+    best = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def random_key() -> str:
+    return b64encode(os.urandom(32)).decode()
+
+
+def synthetic_stats(peers: int) -> dict:
+    now = int(time.time())
+    return {random_key(): {
+        'interface': 'wg0',
+        'remote_ip': f'198.51.100.{n % 250 + 1}:{10000 + n % 50000}',
+        'local_ip': f'10.{(n >> 16) & 255}.{(n >> 8) & 255}.{n & 255}/32',
+        'last_handshake': now - random.randrange(3600),
+        'rx_bytes': random.randrange(10 ** 9),
+        'tx_bytes': random.randrange(10 ** 9),
+    } for n in range(peers)}
+
+
+def synthetic_dump(peers: int) -> str:
+    lines = [f'wg0\t{random_key()}\t{random_key()}\t41800\toff']
+    lines.extend(f'wg0\t{key}\t(none)\t{peer["remote_ip"]}\t{peer["local_ip"]}\t{peer["last_handshake"]}\t'
+                 f'{peer["rx_bytes"]}\t{peer["tx_bytes"]}\t20' for key, peer in synthetic_stats(peers).items())
+    return '\n'.join(lines) + '\n'
+
+
+def bench_stats_store(peers: int, repeat: int) -> list:
+    from django.core.cache.backends.filebased import FileBasedCache
+    from .stats_store import CacheStatsStore, SQLiteStatsStore
+    stats = synthetic_stats(peers)
+    page = random.sample(list(stats), min(100, peers))
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = FileBasedCache(f'{tmp}/cache', {'OPTIONS': {'MAX_ENTRIES': peers * 2}})
+        stores = (
+            ('cache (FileBasedCache)', CacheStatsStore(cache, ttl=300)),
+            ('sqlite (WAL)', SQLiteStatsStore(f'{tmp}/stats.sqlite3', ttl=300)),
+        )
+        for name, store in stores:
+            rows.append((f'{name}: write dump of {peers} peers', timeit(lambda: store.set_many(stats), repeat)))
+            rows.append((f'{name}: read changelist page of {len(page)}', timeit(lambda: store.get_many(page), repeat)))
+    return rows
+
+
+def synthetic_clients(peers: int):
+    # Server with N clients, created inside the caller transaction
+    from .models import Client, Group, Server, rnd_gen
+    # bulk_create: no signals, so no ssh keys generated for the bench server
+    srv = Server.objects.bulk_create([Server(name='bench', ip='127.0.0.1', network='10.0.0.0/8', data={
+        'interface': 'wg0', 'persistent': 20, 'private_key': random_key(), 'public_key': random_key()})])[0]
+    group = Group.objects.create(name='bench')
+    Client.objects.bulk_create([
+        Client(name=f'bench-{n}', group=group, server=srv, rnd=rnd_gen(),
+               ip=f'10.{(n >> 16) & 255}.{(n >> 8) & 255}.{n & 255}',
+               data={'ip': f'10.{(n >> 16) & 255}.{(n >> 8) & 255}.{n & 255}', 'public_key': random_key(),
+                     'private_key': random_key()})
+        for n in range(peers)], batch_size=2000)
+    return srv
+
+
+def peak_memory(func) -> float:
+    # Peak python memory allocated by func, MB
+    import tracemalloc
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 2 ** 20
+
+
+def bench_server_config(peers: int, repeat: int) -> list:
+    from django.db import transaction
+    from .services import generate_server_config, iter_server_config, write_config_stream
+
+    class NullFile:
+        def write(self, data):
+            pass
+
+    def as_list():
+        # Old way: whole config as list of strings, then written out
+        NullFile().write(''.join(generate_server_config(srv.id)).encode())
+
+    def as_stream():
+        write_config_stream(NullFile(), iter_server_config(srv))
+
+    rows = []
+    with transaction.atomic():
+        srv = synthetic_clients(peers)
+        for name, func in (('list', as_list), ('stream', as_stream)):
+            rows.append((f'{name}: render {peers} peers (peak {peak_memory(func):.1f} MB)', timeit(func, repeat)))
+        transaction.set_rollback(True)
+    return rows
+
+
+def legacy_parse_dump(out: str, cache) -> dict:
+    # Parser before vpn.dump: formatting for every peer, one cache write per peer
+    from datetime import datetime
+    import humanize
+    stats = {}
+    for line in [s.strip() for s in out.split('\n')]:
+        params = line.split('\t')
+        if len(params) != 9:
+            continue
+        stats[params[1]] = {
+            'interface': params[0], 'remote_ip': params[3] if params[3] != '(none)' else None,
+            'local_ip': params[4] if params[4] != '(none)' else None, 'last_handshake': params[5],
+            'rx_bytes': params[6], 'tx_bytes': params[7],
+            'last_seen': humanize.naturaltime(datetime.fromtimestamp(int(params[5]))) if int(params[5]) else '-',
+            'traffic': f'{humanize.naturalsize(int(params[6]))} / {humanize.naturalsize(int(params[7]))}'
+        }
+        cache.set(params[1], stats[params[1]], 300)
+    return stats
+
+
+def bench_dump_parse(peers: int, repeat: int) -> list:
+    from django.core.cache.backends.locmem import LocMemCache
+    from .dump import parse
+    from .stats_store import CacheStatsStore
+    out = synthetic_dump(peers)
+    cache = LocMemCache('bench', {'OPTIONS': {'MAX_ENTRIES': peers * 2}})
+    store = CacheStatsStore(cache, ttl=300)
+    return [
+        (f'loop: parse, format and store {peers} peers', timeit(lambda: legacy_parse_dump(out, cache), repeat)),
+        (f'columnar: parse {peers} peers', timeit(lambda: parse(out), repeat)),
+        (f'columnar: parse and store {peers} peers', timeit(lambda: store.set_many(parse(out).records()), repeat)),
+    ]
+
+
+@contextmanager
+def fake_host(srv, peers: int = 0):
+    # Local fake WireGuard host for the server: ssh key, port in server data, interface with N peers
+    import paramiko
+    from decouple import config
+    from .fakehost import FakeHost, FakeWireGuard
+    from .pool import ssh_pool
+    host = FakeHost(FakeWireGuard(config('WIREGUARD_CONFIG_BASE_PATH'))).start()
+    host.wireguard.add_interface(srv.data.get('interface') or 'wg0', peers)
+    key_path = f'{settings.BASE_DIR}/config/keys/{srv.id}'
+    own_key = not os.path.exists(key_path)
+    if own_key:
+        paramiko.RSAKey.generate(2048).write_private_key_file(key_path)
+    srv.data['ssh_port'] = host.port
+    type(srv).objects.filter(id=srv.id).update(data=srv.data)
+    try:
+        yield host
+    finally:
+        ssh_pool.discard(srv.id)
+        host.stop()
+        if own_key:
+            os.remove(key_path)
+
+
+def bench_push(peers: int, repeat: int) -> list:
+    from django.db import transaction
+    from .backends import get_backend
+    from .services import ssh_remote_server, upload_server_config
+    from .sync import sync_server
+    rows = []
+    with transaction.atomic():
+        srv = synthetic_clients(peers)
+        client = srv.client_set.first()
+        with fake_host(srv) as host:
+            def empty_interface():
+                host.wireguard.interfaces['wg0']['peers'].clear()
+
+            def upload():
+                with get_backend(srv) as backend:
+                    upload_server_config(backend, srv, force=True)
+
+            rows.append((f'sync: add {peers} peers to empty interface',
+                         timeit(lambda: sync_server(srv), repeat, setup=empty_interface)))
+            rows.append((f'sync: nothing changed, {peers} peers', timeit(lambda: sync_server(srv), repeat)))
+            rows.append((f'upload config of {peers} peers', timeit(upload, repeat)))
+            rows.append((f'push one client, {peers} peers', timeit(lambda: ssh_remote_server(srv, client), repeat)))
+        transaction.set_rollback(True)
+    return rows
+
+
+def bench_statistic(peers: int, repeat: int) -> list:
+    from django.core.cache.backends.locmem import LocMemCache
+    from django.db import transaction
+    from .backends import get_backend
+    from .stats_store import CacheStatsStore
+    # Throwaway store, synthetic peers never get into STATS_STORE
+    store = CacheStatsStore(LocMemCache('bench', {'OPTIONS': {'MAX_ENTRIES': peers * 2}}), ttl=300)
+
+    def statistic():
+        with get_backend(srv) as backend:
+            store.set_many(backend.stats())
+
+    with transaction.atomic():
+        srv = synthetic_clients(0)
+        with fake_host(srv, peers):
+            # ssh round-trip, dump of all peers, parse and store
+            seconds = timeit(statistic, repeat)
+        transaction.set_rollback(True)
+    return [(f'statistic: {peers} peers', seconds)]
+
+
+def bench_bulk_create(peers: int, repeat: int) -> list:
+    from django.db import transaction
+    from .models import Group
+    from .provision import bulk_create_clients
+    servers = []
+    rows = [{'name': f'bench-{n}'} for n in range(peers)]
+    with transaction.atomic():
+        group = Group.objects.create(name='bench-bulk')
+        # Every run allocates addresses on a new empty server
+        seconds = timeit(lambda: bulk_create_clients(servers[-1], rows, group=group), repeat,
+                         setup=lambda: servers.append(synthetic_clients(0)))
+        transaction.set_rollback(True)
+    return [(f'bulk create {peers} clients', seconds)]
+
+
+def bench_download(peers: int, repeat: int) -> list:
+    from asgiref.sync import async_to_sync
+    from django.db import transaction
+    from django.test import RequestFactory
+    from .config_cache import invalidate_client_configs
+    from .views import get_vpn_config
+    factory = RequestFactory()
+    rows = []
+    with transaction.atomic():
+        srv = synthetic_clients(peers)
+        links = list(srv.client_set.values_list('rnd', flat=True)[:1000])
+        etags = {}
+
+        @async_to_sync
+        async def download(headers=None):
+            # One event loop for all requests, as in an ASGI worker
+            for rnd in links:
+                response = await get_vpn_config(factory.get(f'/cfg/{rnd}/', **(headers(rnd) if headers else {})), rnd)
+                etags[rnd] = response.headers.get('ETag', etags.get(rnd))
+
+        rows.append((f'download {len(links)} configs, not cached',
+                     timeit(download, repeat, setup=lambda: invalidate_client_configs(*links))))
+        rows.append((f'download {len(links)} configs, cached', timeit(download, repeat)))
+        rows.append((f'download {len(links)} configs, not modified (304)',
+                     timeit(lambda: download(lambda rnd: {'HTTP_IF_NONE_MATCH': etags[rnd]}), repeat)))
+        invalidate_client_configs(*links)
+        transaction.set_rollback(True)
+    return rows
+
+
+def save_results(path: str, results: list):
+    import json
+    with open(path, 'w') as f:
+        json.dump({'created': int(time.time()), 'results': results}, f, indent=1)
+
+
+def load_results(path: str) -> dict:
+    # {(benchmark, title): seconds}
+    import json
+    with open(path) as f:
+        return {(name, title): seconds for name, title, seconds in json.load(f)['results']}
+
+
+BENCHMARKS = {
+    'stats_store': bench_stats_store,
+    'server_config': bench_server_config,
+    'dump_parse': bench_dump_parse,
+    'push': bench_push,
+    'statistic': bench_statistic,
+    'bulk_create': bench_bulk_create,
+    'download': bench_download,
+}
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+# Coalesce config pushes: signal handlers only mark a server as dirty,
+# one sync per server runs after transaction commit and a short debounce window
+# (or is put to the job queue at commit, when JOB_QUEUE is enabled)
+
+import threading
+
+from django.conf import settings
+from django.db import connection, transaction
+from loguru import logger
+
+_pending = set()
+_lock = threading.Lock()
+_timer = None
+# Flushes in a row which left a failed server
+_retries = 0
+
+
+def mark_dirty(srv_id: int):
+    with _lock:
+        _pending.add(srv_id)
+    # Runs immediately when called outside of atomic block
+    transaction.on_commit(_schedule_flush)
+
+
+def _schedule_flush(delay: float = None):
+    global _timer
+    if delay is None and (settings.JOB_QUEUE or settings.PUSH_DEBOUNCE <= 0):
+        flush()
+        return
+    with _lock:
+        if _timer is not None or not _pending:
+            return
+        _timer = threading.Timer(settings.PUSH_DEBOUNCE if delay is None else delay, _flush_in_thread)
+        _timer.start()
+
+
+def _flush_in_thread():
+    try:
+        flush()
+    finally:
+        connection.close()
+
+
+def flush() -> dict:
+    global _timer, _retries
+    from .models import Server
+    from .sync import sync_server
+    with _lock:
+        srv_ids = set(_pending)
+        _pending.clear()
+        _timer = None
+    if settings.JOB_QUEUE:
+        from .jobs import enqueue
+        return {srv_id: {'ok': True, 'job': enqueue(srv_id, 'sync').id} for srv_id in srv_ids}
+    results = {}
+    for srv in Server.objects.filter(id__in=srv_ids):
+        try:
+            results[srv.id] = sync_server(srv)
+        except Exception as e:  # noqa
+            # One broken server never drops pushes of the others
+            logger.exception(f'push to {srv} failed')
+            results[srv.id] = {'ok': False, 'msg': str(e)}
+            continue
+        if not results[srv.id].get('ok'):
+            logger.error(f'push to {srv} failed: {results[srv.id].get("msg")}')
+    failed = {srv_id for srv_id, result in results.items() if not result.get('ok')}
+    with _lock:
+        _pending.update(failed)
+        _retries = _retries + 1 if failed else 0
+        retries = _retries
+    if failed:
+        # Failed servers are pushed again, the delay doubles with every failed flush
+        _schedule_flush(min(max(settings.PUSH_DEBOUNCE, 1) * 2 ** (retries - 1), settings.PUSH_RETRY_MAX))
+    return results
+
+
+def pending() -> set:
+    with _lock:
+        return set(_pending)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import Max, Sum, F, IntegerField, ExpressionWrapper
+from loguru import logger
+
+from .dashboard import publish, server_summary
+from .models import Server, PeerSample
+
+# Last seen cumulative counters: (srv_id, public_key) -> (ts, rx, tx)
+_counters = {}
+_lock = threading.Lock()
+
+
+def make_samples(srv_id: int, stats: dict, previous: dict, now: int) -> list:
+    # Deltas of cumulative counters, previous: {public key: (ts, rx, tx)} seen last time
+    samples = []
+    for public_key, peer in stats.items():
+        prev_ts, prev_rx, prev_tx = previous.get(public_key) or (None, 0, 0)
+        if not prev_ts or now <= prev_ts:
+            # First time seen, only baseline for the next delta
+            continue
+        rx, tx = int(peer['rx_bytes']), int(peer['tx_bytes'])
+        # Counters go back to zero when interface or peer was re-created
+        rx_delta = rx - prev_rx if rx >= prev_rx else rx
+        tx_delta = tx - prev_tx if tx >= prev_tx else tx
+        samples.append(PeerSample(server_id=srv_id, public_key=public_key, ts=now, rx=rx_delta, tx=tx_delta,
+                                  rx_rate=rx_delta / (now - prev_ts), tx_rate=tx_delta / (now - prev_ts),
+                                  handshake=int(peer['last_handshake'])))
+    return samples
+
+
+def swap_counters(srv_id: int, stats: dict, now: int) -> dict:
+    # Counters of the previous poll of this process, replaced by the current ones
+    with _lock:
+        previous = {public_key: _counters.get((srv_id, public_key)) for public_key in stats}
+        for public_key, peer in stats.items():
+            _counters[(srv_id, public_key)] = (now, int(peer['rx_bytes']), int(peer['tx_bytes']))
+    return previous
+
+
+def collect_server(srv_instance: Server) -> dict:
+    from .backends import BackendError, get_backend
+    from .pool import SSHConnectError
+    from .services import store_stats
+    try:
+        with get_backend(srv_instance) as backend:
+            stats = backend.stats()
+    except SSHConnectError as e:
+        msg = f"can't connect to server via ssh: {e}"
+        logger.error(msg)
+        return {'ok': False, 'msg': msg}
+    except BackendError as e:
+        return {'ok': False, 'msg': str(e)}
+
+    store_stats(stats)
+    now = int(time.time())
+    samples = make_samples(srv_instance.id, stats, swap_counters(srv_instance.id, stats, now), now)
+    PeerSample.objects.bulk_create(samples, batch_size=1000)
+    publish(srv_instance.id, server_summary(srv_instance, stats, samples, now))
+    return {'ok': True, 'peers': len(stats), 'samples': len(samples)}
+
+
+def collect_all() -> dict:
+    from .services import fan_out
+    # Servers with an agent push statistic themselves
+    servers = [srv for srv in Server.objects.filter(is_enable=True) if not srv.data.get('agent_token')]
+    results = fan_out(servers, collect_server, settings.FAN_OUT_TIMEOUT)
+    return {srv.id: result for srv, result in zip(servers, results)}
+
+
+def downsample(now: int = None) -> tuple:
+    # Raw samples older than STATS_RAW_RETENTION become hourly rows, hourly rows live STATS_RETENTION
+    now = now or int(time.time())
+    raw_deadline = (now - settings.STATS_RAW_RETENTION) // PeerSample.HOURLY * PeerSample.HOURLY
+    raw = PeerSample.objects.filter(resolution=PeerSample.RAW, ts__lt=raw_deadline)
+    bucket = ExpressionWrapper(F('ts') / PeerSample.HOURLY * PeerSample.HOURLY, output_field=IntegerField())
+    hourly = [
+        PeerSample(server_id=row['server_id'], public_key=row['public_key'], ts=row['bucket'],
+                   resolution=PeerSample.HOURLY, rx=row['rx_sum'], tx=row['tx_sum'],
+                   rx_rate=row['rx_sum'] / PeerSample.HOURLY, tx_rate=row['tx_sum'] / PeerSample.HOURLY,
+                   handshake=row['handshake_max'])
+        for row in raw.annotate(bucket=bucket).values('server_id', 'public_key', 'bucket').annotate(
+            rx_sum=Sum('rx'), tx_sum=Sum('tx'), handshake_max=Max('handshake')).order_by()
+    ]
+    PeerSample.objects.bulk_create(hourly, batch_size=1000)
+    raw_deleted, _ = raw.delete()
+    expired, _ = PeerSample.objects.filter(ts__lt=now - settings.STATS_RETENTION).delete()
+    return len(hourly), raw_deleted, expired
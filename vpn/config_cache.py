@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+# Content hash of rendered server configs, to skip uploads of byte-for-byte identical files.
+# Hash is kept in cache under a per-server version token, any change of a field which feeds
+# generate_server_config() replaces the token. Hash of the last uploaded file is Server.data['pushed_hash'].
+#
+# Rendered client configs for the download link, by client rnd, dropped on client, server or group save.
+
+import hashlib
+import json
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .metrics import inc
+from .models import Client, Server
+
+
+def client_config_state(client: Client) -> tuple:
+    return (client.name, client.is_enable, client.server_id, client.data.get('public_key'), client.data.get('ip'),
+            client.data.get('ip6'), client.data.get('interface'), client.data.get('allowed'))
+
+
+def server_config_state(srv: Server) -> tuple:
+    return (srv.network, srv.port, srv.data.get('private_key'), srv.data.get('persistent'), srv.data.get('interface'),
+            json.dumps(srv.data.get('interfaces'), sort_keys=True))
+
+
+def client_configs_state(srv: Server) -> tuple:
+    # Server fields which are in every client config: endpoint, port and public key of every interface
+    return srv.ip, srv.network, tuple((iface['name'], iface.get('port'), iface.get('public_key'), iface.get('network'))
+                                      for iface in srv.interfaces)
+
+
+def config_version(srv_id: int) -> str:
+    key = f'server-config-version:{srv_id}'
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+    return version
+
+
+def invalidate(*srv_ids):
+    cache.set_many({f'server-config-version:{srv_id}': uuid.uuid4().hex for srv_id in srv_ids if srv_id}, None)
+
+
+def cached_hash(srv_id: int):
+    return cache.get(f'server-config-hash:{srv_id}:{config_version(srv_id)}')
+
+
+class HashingStream:
+    # Pass config blocks through, counting content hash on the way
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.sha = hashlib.sha256()
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.sha.update(chunk)
+            yield chunk
+
+    def hexdigest(self) -> str:
+        return self.sha.hexdigest()
+
+
+def store_hash(srv_id: int, version: str, digest: str):
+    # Stored under the version seen before rendering: a change during rendering makes it unreachable
+    cache.set(f'server-config-hash:{srv_id}:{version}', digest, None)
+
+
+def is_pushed(srv: Server) -> bool:
+    digest = cached_hash(srv.id)
+    inc('wg_cache_requests_total', cache='server_config_hash', result='miss' if digest is None else 'hit')
+    return digest is not None and digest == srv.data.get('pushed_hash')
+
+
+def set_pushed(srv: Server, digest: str):
+    with transaction.atomic():
+        # Fresh copy under row lock, in-memory data may be stale (ipam state)
+        data = Server.objects.select_for_update().filter(id=srv.id).values_list('data', flat=True).first()
+        if data is None:
+            return
+        data['pushed_hash'] = digest
+        Server.objects.filter(id=srv.id).update(data=data)
+    srv.data['pushed_hash'] = digest
+
+
+def get_client_config(rnd: str):
+    return cache.get(f'client-config:{rnd}') if rnd else None
+
+
+def set_client_config(rnd: str, entry: dict):
+    cache.set(f'client-config:{rnd}', entry, settings.CLIENT_CONFIG_TTL)
+
+
+async def aget_client_config(rnd: str):
+    return await cache.aget(f'client-config:{rnd}') if rnd else None
+
+
+async def aset_client_config(rnd: str, entry: dict):
+    await cache.aset(f'client-config:{rnd}', entry, settings.CLIENT_CONFIG_TTL)
+
+
+def invalidate_client_configs(*rnds):
+    cache.delete_many([f'client-config:{rnd}' for rnd in rnds if rnd])
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+# Live peer status for the admin dashboard. Stats collector publishes a summary of every server to cache,
+# the event stream merges all servers into one state and sends only what changed since the previous event.
+
+import asyncio
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Client, Server
+
+# Active tunnels re-handshake every 2 minutes
+ONLINE_WINDOW = 180
+
+
+def server_summary(srv_instance: Server, stats: dict, samples: list, now: int) -> dict:
+    rates = {sample.public_key: (sample.rx_rate, sample.tx_rate) for sample in samples}
+    names = dict(Client.objects.filter(server_id=srv_instance.id).values_list('data__public_key', 'name'))
+    clients = {}
+    # Interface is shown only when the server has several
+    several = len(srv_instance.interfaces) > 1
+    for public_key, peer in stats.items():
+        handshake = int(peer['last_handshake'])
+        if now - handshake > ONLINE_WINDOW:
+            continue
+        rx_rate, tx_rate = rates.get(public_key, (0, 0))
+        server = f'{srv_instance.name} ({peer.get("interface")})' if several else srv_instance.name
+        clients[public_key] = {'name': names.get(public_key) or public_key[:8], 'server': server,
+                               'handshake': handshake, 'rx_rate': round(rx_rate), 'tx_rate': round(tx_rate)}
+    return {'name': srv_instance.name, 'peers': len(stats), 'online': len(clients),
+            'rx_rate': round(sum(rx for rx, _ in rates.values())),
+            'tx_rate': round(sum(tx for _, tx in rates.values())),
+            'updated': now, 'clients': clients}
+
+
+def publish(srv_id: int, summary: dict):
+    cache.set(f'dashboard:{srv_id}', summary, settings.STATS_TTL)
+
+
+def update_summary(srv_instance: Server, stats: dict, samples: list, now: int, full: bool):
+    # Agent reports without "full" carry changed peers only, they are merged into the published summary
+    summary = None if full else cache.get(f'dashboard:{srv_instance.id}')
+    fresh = server_summary(srv_instance, stats, samples, now)
+    if summary is not None:
+        # Peers missing in the report had no traffic since the previous one
+        clients = {public_key: {**client, 'rx_rate': 0, 'tx_rate': 0}
+                   for public_key, client in summary['clients'].items()
+                   if public_key not in stats and now - client['handshake'] <= ONLINE_WINDOW}
+        clients.update(fresh['clients'])
+        fresh.update(peers=summary['peers'], online=len(clients), clients=clients)
+    publish(srv_instance.id, fresh)
+
+
+def dashboard_state(summaries: dict) -> dict:
+    servers, clients = {}, {}
+    for key, summary in summaries.items():
+        servers[key.split(':')[1]] = {field: value for field, value in summary.items() if field != 'clients'}
+        clients.update(summary['clients'])
+    totals = {field: sum(srv[field] for srv in servers.values()) for field in ('peers', 'online', 'rx_rate', 'tx_rate')}
+    return {'servers': servers, 'clients': clients, 'totals': {'servers': len(servers), **totals}}
+
+
+def diff_state(old: dict, new: dict) -> dict:
+    # Changed fields of every entry, None for entries which are gone
+    delta = {}
+    for section in ('servers', 'clients'):
+        before = old.get(section, {})
+        changes = {}
+        for key, value in new[section].items():
+            if key not in before:
+                changes[key] = value
+            elif fields := {field: v for field, v in value.items() if before[key].get(field) != v}:
+                changes[key] = fields
+        changes.update({key: None for key in before if key not in new[section]})
+        if changes:
+            delta[section] = changes
+    if new['totals'] != old.get('totals'):
+        delta['totals'] = new['totals']
+    return delta
+
+
+class DashboardFeed:
+    def __init__(self, server_ids: list):
+        self.keys = [f'dashboard:{srv_id}' for srv_id in server_ids]
+        self.state = {}
+
+    def event(self, summaries: dict) -> str:
+        state = dashboard_state(summaries)
+        delta = diff_state(self.state, state)
+        self.state = state
+        # Comment line keeps the connection alive when nothing changed
+        return f'data: {json.dumps(delta)}\n\n' if delta else ': ping\n\n'
+
+
+def iter_events(feed: DashboardFeed):
+    # Stream is closed after DASHBOARD_STREAM_TTL, browser reconnects by itself and gets the full state
+    deadline = time.monotonic() + settings.DASHBOARD_STREAM_TTL
+    while time.monotonic() < deadline:
+        yield feed.event(cache.get_many(feed.keys))
+        time.sleep(settings.DASHBOARD_INTERVAL)
+
+
+async def aiter_events(feed: DashboardFeed):
+    deadline = time.monotonic() + settings.DASHBOARD_STREAM_TTL
+    while time.monotonic() < deadline:
+        yield feed.event(await cache.aget_many(feed.keys))
+        await asyncio.sleep(settings.DASHBOARD_INTERVAL)
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+# Columnar parser of `wg show all dump`. Peer lines are split once and transposed into columns,
+# counters are kept in typed arrays. Nothing is formatted here, see Client.last_seen / Client.traffic.
+
+from array import array
+
+# interface, public key, preshared key, endpoint, allowed ips, handshake, rx, tx, keepalive
+PEER_FIELDS = 9
+
+
+def _none(value: str):
+    return None if value == '(none)' else value
+
+
+class PeerTable:
+    __slots__ = ('interface', 'public_key', 'remote_ip', 'local_ip', 'handshake', 'rx', 'tx')
+
+    def __init__(self, rows: list):
+        columns = list(zip(*rows)) or [()] * PEER_FIELDS
+        self.interface = columns[0]
+        self.public_key = columns[1]
+        self.remote_ip = columns[3]
+        self.local_ip = columns[4]
+        self.handshake = array('q', map(int, columns[5]))
+        self.rx = array('q', map(int, columns[6]))
+        self.tx = array('q', map(int, columns[7]))
+
+    def __len__(self):
+        return len(self.public_key)
+
+    def online(self, now: int, window: int) -> int:
+        return sum(1 for handshake in self.handshake if now - handshake <= window)
+
+    def totals(self) -> tuple:
+        return sum(self.rx), sum(self.tx)
+
+    def records(self) -> dict:
+        # Raw per-peer records for the stats store, keyed by public key
+        return {
+            public_key: {'interface': interface, 'remote_ip': _none(remote_ip), 'local_ip': _none(local_ip),
+                         'last_handshake': handshake, 'rx_bytes': rx, 'tx_bytes': tx}
+            for public_key, interface, remote_ip, local_ip, handshake, rx, tx in zip(
+                self.public_key, self.interface, self.remote_ip, self.local_ip, self.handshake, self.rx, self.tx)
+        }
+
+
+def parse(out: str) -> PeerTable:
+    # Interface lines have 5 fields and are skipped
+    rows = [line.split('\t') for line in out.split('\n')]
+    return PeerTable([fields for fields in rows if len(fields) == PEER_FIELDS])
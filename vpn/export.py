@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+# Client config export: .conf, json, QR code (png/svg) and zip archives.
+# Every artifact is derived from the rendered .conf only, so it is cached by the hash of the config
+# and never needs invalidation. QR codes need optional "segno" package (poetry install -E qr).
+
+import io
+import json
+import re
+import zipfile
+
+from django.conf import settings
+from django.core.cache import cache
+
+# format -> (content type, content disposition)
+FORMATS = {
+    'conf': ('application/octet-stream', 'attachment'),
+    'json': ('application/json', 'attachment'),
+    'png': ('image/png', 'inline'),
+    'svg': ('image/svg+xml', 'inline'),
+}
+
+
+class ExportUnavailable(Exception):
+    pass
+
+
+def conf_to_dict(body: bytes) -> dict:
+    # [Interface] / [Peer] sections as {"interface": {...}, "peers": [{...}]}
+    result = {'interface': {}, 'peers': []}
+    section = None
+    for line in body.decode().splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line == '[Interface]':
+            section = result['interface']
+        elif line == '[Peer]':
+            section = {}
+            result['peers'].append(section)
+        elif '=' in line and section is not None:
+            key, value = line.split('=', 1)
+            section[key.strip()] = value.strip()
+    return result
+
+
+def render_json(body: bytes) -> bytes:
+    return json.dumps(conf_to_dict(body), indent=2).encode()
+
+
+def render_qr(body: bytes, kind: str) -> bytes:
+    try:
+        import segno
+    except ImportError:
+        raise ExportUnavailable('QR code export needs "segno" package')
+    buffer = io.BytesIO()
+    segno.make(body.decode(), error='l', micro=False).save(buffer, kind=kind, scale=6, border=4)
+    return buffer.getvalue()
+
+
+RENDERERS = {
+    'json': render_json,
+    'png': lambda body: render_qr(body, 'png'),
+    'svg': lambda body: render_qr(body, 'svg'),
+}
+
+
+def artifact_etag(entry: dict, fmt: str) -> str:
+    return entry['etag'] if fmt == 'conf' else f'{entry["etag"][:-1]}-{fmt}"'
+
+
+def render_artifact(entry: dict, fmt: str) -> bytes:
+    if fmt == 'conf':
+        return entry['body']
+    digest = entry['etag'].strip('"')
+    key = f'client-artifact:{fmt}:{digest}'
+    body = cache.get(key)
+    if body is None:
+        body = RENDERERS[fmt](entry['body'])
+        cache.set(key, body, settings.CLIENT_CONFIG_TTL)
+    return body
+
+
+async def arender_artifact(entry: dict, fmt: str) -> bytes:
+    from asgiref.sync import sync_to_async
+    if fmt == 'conf':
+        return entry['body']
+    digest = entry['etag'].strip('"')
+    key = f'client-artifact:{fmt}:{digest}'
+    body = await cache.aget(key)
+    if body is None:
+        # QR rendering is CPU bound, not worth to hold the event loop
+        body = await sync_to_async(RENDERERS[fmt], thread_sensitive=False)(entry['body'])
+        await cache.aset(key, body, settings.CLIENT_CONFIG_TTL)
+    return body
+
+
+class _ZipSink:
+    # Write-only file for ZipFile, written data is taken away after every member
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def pop(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def safe_name(name: str) -> str:
+    return re.sub(r'[^\w.-]+', '_', str(name)).strip('_') or 'noname'
+
+
+def iter_zip(clients, folder: str = 'group', fmt: str = 'conf'):
+    # Zip archive of client configs, one folder per group (or server), yielded member by member
+    from .services import client_config_entry
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        # Clients of a deleted server have no config
+        clients = clients.filter(server__isnull=False).select_related('server', 'group').order_by(f'{folder}_id', 'id')
+        for client in clients.iterator(chunk_size=500):
+            entry = client_config_entry(client, store=False)
+            name = f'{safe_name(getattr(client, folder))}/{safe_name(client.name)}-{client.id}.{fmt}'
+            archive.writestr(name, render_artifact(entry, fmt))
+            yield sink.pop()
+    yield sink.pop()
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+# Local stand-in for a WireGuard host, used by `manage.py bench` (push, statistic):
+# paramiko SSH/SFTP server on 127.0.0.1 with in-memory config files and interfaces,
+# understands the commands wg-manager runs: `wg show <if>|all dump`, `wg set`, `wg syncconf`,
+# `wg-quick strip` and `service wg-quick@<if> restart|stop`.
+# Point a server at it with ip 127.0.0.1 and data["ssh_port"] = host.port, any client key is accepted.
+
+import io
+import os
+import random
+import shlex
+import socket
+import threading
+import time
+
+import paramiko
+from loguru import logger
+
+from .bench import random_key
+
+
+def parse_wg_config(text: str) -> dict:
+    iface = {'private_key': None, 'port': 0, 'peers': {}}
+    section, peer = None, None
+    for line in text.splitlines():
+        line = line.split('#')[0].strip()
+        if not line:
+            continue
+        if line.startswith('['):
+            section = line.strip('[]').lower()
+            peer = {} if section == 'peer' else None
+            continue
+        key, _, value = (s.strip() for s in line.partition('='))
+        key = key.lower()
+        if section == 'interface':
+            if key == 'privatekey':
+                iface['private_key'] = value
+            if key == 'listenport':
+                iface['port'] = int(value)
+        if section == 'peer':
+            if key == 'publickey':
+                iface['peers'][value] = peer
+                peer.update({'endpoint': None, 'handshake': 0, 'rx': 0, 'tx': 0, 'keepalive': 'off',
+                             'allowed_ips': ''})
+            if key == 'allowedips':
+                peer['allowed_ips'] = value.replace(' ', '')
+            if key == 'persistentkeepalive':
+                peer['keepalive'] = value
+    return iface
+
+
+class FakeWireGuard:
+    # In-memory state of a WireGuard host: config files and running interfaces
+    def __init__(self, config_base_path: str = '/etc/wireguard'):
+        self.config_base_path = config_base_path
+        self.files = {}
+        self.interfaces = {}
+        self.commands = []
+        self.lock = threading.Lock()
+
+    def add_interface(self, name: str = 'wg0', peers: int = 0, port: int = 41800):
+        iface = {'private_key': random_key(), 'port': port, 'peers': {}}
+        for n in range(peers):
+            iface['peers'][random_key()] = {
+                'endpoint': f'198.51.100.{n % 250 + 1}:{10000 + n % 50000}' if n % 3 else None,
+                'allowed_ips': f'10.{(n >> 16) & 255}.{(n >> 8) & 255}.{n & 255}/32',
+                'handshake': int(time.time()) - random.randrange(3600) if n % 3 else 0,
+                'rx': random.randrange(10 ** 9) if n % 3 else 0,
+                'tx': random.randrange(10 ** 9) if n % 3 else 0,
+                'keepalive': '20',
+            }
+        self.interfaces[name] = iface
+        return iface
+
+    def dump(self, name: str, prefix: bool) -> str:
+        iface = self.interfaces[name]
+        head = f'{name}\t' if prefix else ''
+        lines = [f'{head}{iface["private_key"]}\t{random_key()}\t{iface["port"]}\toff']
+        for public_key, p in iface['peers'].items():
+            lines.append(f'{head}{public_key}\t(none)\t{p["endpoint"] or "(none)"}\t{p["allowed_ips"] or "(none)"}\t'
+                         f'{p["handshake"]}\t{p["rx"]}\t{p["tx"]}\t{p["keepalive"]}')
+        return '\n'.join(lines) + '\n'
+
+    def load(self, name: str):
+        path = f'{self.config_base_path}/{name}.conf'
+        if path not in self.files:
+            return 1, '', f'wg-quick: `{path}\' does not exist\n'
+        live = self.interfaces.get(name, {}).get('peers', {})
+        iface = parse_wg_config(self.files[path].decode())
+        for public_key, peer in iface['peers'].items():
+            # syncconf keeps counters of existing peers
+            if public_key in live:
+                peer.update({k: live[public_key][k] for k in ('endpoint', 'handshake', 'rx', 'tx')})
+        self.interfaces[name] = iface
+        return 0, '', ''
+
+    def wg_set(self, args: list):
+        name, args = args[0], args[1:]
+        if name not in self.interfaces:
+            return 1, '', 'Unable to access interface: No such device\n'
+        peers = self.interfaces[name]['peers']
+        peer = None
+        while args:
+            token = args.pop(0)
+            if token == 'peer':
+                public_key = args.pop(0)
+                peer = peers.setdefault(public_key, {'endpoint': None, 'handshake': 0, 'rx': 0, 'tx': 0,
+                                                     'keepalive': 'off', 'allowed_ips': ''})
+            elif token == 'remove':
+                peers.pop(public_key, None)
+            elif token == 'allowed-ips':
+                peer['allowed_ips'] = args.pop(0)
+            elif token == 'persistent-keepalive':
+                value = args.pop(0)
+                peer['keepalive'] = 'off' if value in ('0', 'off') else value
+            elif token == 'listen-port':
+                self.interfaces[name]['port'] = int(args.pop(0))
+            else:
+                return 1, '', f'Invalid argument: {token}\n'
+        return 0, '', ''
+
+    def execute(self, command: str) -> tuple:
+        with self.lock:
+            self.commands.append(command)
+            args = shlex.split(command)
+            if args[:2] == ['bash', '-c']:
+                args = args[2].replace('<(wg-quick strip', '').replace(')', '').split()
+            if args[:4] == ['wg', 'show', 'all', 'dump']:
+                return 0, ''.join(self.dump(name, True) for name in self.interfaces), ''
+            if args[:2] == ['wg', 'show'] and args[3:4] == ['dump']:
+                if args[2] not in self.interfaces:
+                    return 1, '', 'Unable to access interface: No such device\n'
+                return 0, self.dump(args[2], False), ''
+            if args[:2] == ['wg', 'set']:
+                return self.wg_set(args[2:])
+            if args[:2] == ['wg', 'syncconf']:
+                if args[2] not in self.interfaces:
+                    return 1, '', 'Unable to access interface: No such device\n'
+                return self.load(args[2])
+            if args[:1] == ['service'] and args[1].startswith('wg-quick@'):
+                name = args[1].split('@')[1]
+                if args[2] == 'stop':
+                    self.interfaces.pop(name, None)
+                    return 0, '', ''
+                return self.load(name)
+            return 127, '', f'{args[0]}: command not found\n'
+
+
+class _Handle(paramiko.SFTPHandle):
+    def __init__(self, host: FakeWireGuard, path: str, flags: int):
+        super().__init__(flags)
+        self.host = host
+        self.path = path
+        self.buffer = io.BytesIO(b'' if flags & os.O_TRUNC else host.files.get(path, b''))
+
+    def read(self, offset, length):
+        self.buffer.seek(offset)
+        return self.buffer.read(length)
+
+    def write(self, offset, data):
+        self.buffer.seek(offset)
+        self.buffer.write(data)
+        return paramiko.SFTP_OK
+
+    def stat(self):
+        attr = paramiko.SFTPAttributes()
+        attr.st_size = len(self.buffer.getvalue())
+        attr.st_mode = 0o100600
+        return attr
+
+    def chattr(self, attr):
+        return paramiko.SFTP_OK
+
+    def close(self):
+        with self.host.lock:
+            self.host.files[self.path] = self.buffer.getvalue()
+        super().close()
+
+
+class _SFTPServer(paramiko.SFTPServerInterface):
+    def __init__(self, server, *args, **kwargs):
+        self.host = server.host
+        super().__init__(server, *args, **kwargs)
+
+    def open(self, path, flags, attr):
+        if not flags & (os.O_WRONLY | os.O_RDWR) and path not in self.host.files:
+            return paramiko.SFTP_NO_SUCH_FILE
+        handle = _Handle(self.host, path, flags)
+        handle.filename = path
+        return handle
+
+    def stat(self, path):
+        if path not in self.host.files:
+            return paramiko.SFTP_NO_SUCH_FILE
+        attr = paramiko.SFTPAttributes()
+        attr.st_size = len(self.host.files[path])
+        attr.st_mode = 0o100600
+        return attr
+
+    lstat = stat
+
+    def chmod(self, path, mode):
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        return paramiko.SFTP_OK
+
+    def remove(self, path):
+        self.host.files.pop(path, None)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        with self.host.lock:
+            if oldpath not in self.host.files:
+                return paramiko.SFTP_NO_SUCH_FILE
+            self.host.files[newpath] = self.host.files.pop(oldpath)
+        return paramiko.SFTP_OK
+
+    posix_rename = rename
+
+    def canonicalize(self, path):
+        return os.path.normpath(path)
+
+
+class _ServerInterface(paramiko.ServerInterface):
+    def __init__(self, host: FakeWireGuard):
+        self.host = host
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL if username == 'root' else paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == 'session' else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        def run():
+            exit_code, out, err = self.host.execute(command.decode())
+            channel.sendall(out.encode())
+            channel.sendall_stderr(err.encode())
+            channel.send_exit_status(exit_code)
+            # EOF instead of close: closing before the exec reply is sent would fail the client request
+            channel.shutdown_write()
+        threading.Thread(target=run, daemon=True).start()
+        return True
+
+
+class FakeHost:
+    # Local SSH/SFTP server on 127.0.0.1 emulating `wg`, `wg-quick` and config files of a WireGuard host
+    def __init__(self, wireguard: FakeWireGuard = None):
+        self.wireguard = wireguard or FakeWireGuard()
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.connections = 0
+        self._transports = []
+        self._running = False
+
+    def start(self) -> 'FakeHost':
+        self.sock.listen(100)
+        self._running = True
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self
+
+    def _accept(self):
+        while self._running:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                return
+            self.connections += 1
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, _SFTPServer)
+            try:
+                transport.start_server(server=_ServerInterface(self.wireguard))
+            except (paramiko.SSHException, EOFError) as e:
+                logger.warning(f'fake host: {e}')
+                continue
+            self._transports.append(transport)
+
+    def stop(self):
+        self._running = False
+        self.sock.close()
+        for transport in self._transports:
+            transport.close()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+# Peer statistic pushed by agent/wg_agent.py running on WireGuard hosts.
+# Servers with an agent token are not polled over ssh by collect_stats.
+# Agent reports carry only peers changed since the previous report, plus a full report every few cycles:
+# {"ts": 1680364116, "full": false, "peers": {"<public key>": [interface, endpoint, allowed ips, handshake, rx, tx]}}
+
+import hashlib
+import hmac
+import secrets
+import time
+import zlib
+
+from django.conf import settings
+
+from .models import Server, PeerSample
+
+
+class IngestError(Exception):
+    pass
+
+
+def token_hash(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def issue_token(srv_instance: Server) -> str:
+    # Only hash is kept, token is shown once
+    token = secrets.token_urlsafe(32)
+    srv_instance.data['agent_token'] = token_hash(token)
+    Server.objects.filter(id=srv_instance.id).update(data=srv_instance.data)
+    return token
+
+
+def authenticate(header: str):
+    # "Bearer <server id>.<token>"
+    scheme, _, credentials = (header or '').partition(' ')
+    srv_id, _, token = credentials.partition('.')
+    if scheme != 'Bearer' or not srv_id.isdigit() or not token:
+        return None
+    srv_instance = Server.objects.filter(id=srv_id, is_enable=True).first()
+    if not srv_instance or not srv_instance.data.get('agent_token'):
+        return None
+    return srv_instance if hmac.compare_digest(srv_instance.data['agent_token'], token_hash(token)) else None
+
+
+def decode_body(body: bytes, encoding: str) -> bytes:
+    if encoding != 'gzip':
+        return body
+    decompressor = zlib.decompressobj(wbits=31)
+    try:
+        data = decompressor.decompress(body, settings.AGENT_MAX_BODY)
+    except zlib.error as e:
+        raise IngestError(f'bad gzip body: {e}')
+    if decompressor.unconsumed_tail:
+        raise IngestError('body is too large')
+    return data
+
+
+def parse_report(payload: dict) -> tuple:
+    try:
+        now = int(payload.get('ts') or time.time())
+        stats = {public_key: {'interface': interface, 'remote_ip': endpoint, 'local_ip': allowed,
+                              'last_handshake': int(handshake), 'rx_bytes': int(rx), 'tx_bytes': int(tx),
+                              'updated': now}
+                 for public_key, (interface, endpoint, allowed, handshake, rx, tx) in payload['peers'].items()}
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        raise IngestError(f'bad report: {e}')
+    return now, stats, bool(payload.get('full'))
+
+
+def ingest(srv_instance: Server, payload: dict) -> dict:
+    from .collector import make_samples
+    from .dashboard import update_summary
+    from .stats_store import get_counter_store, get_stats_store
+    now, stats, full = parse_report(payload)
+    counters = get_counter_store()
+    # Deltas against the stored counters, so any web worker can take any report
+    previous = {public_key: tuple(prev) for public_key, prev in counters.get_many(list(stats)).items()}
+    samples = make_samples(srv_instance.id, stats, previous, now)
+    # One upsert for all changed peers, one insert for all samples
+    counters.set_many({public_key: (now, peer['rx_bytes'], peer['tx_bytes']) for public_key, peer in stats.items()})
+    get_stats_store().set_many(stats)
+    PeerSample.objects.bulk_create(samples, batch_size=1000)
+    update_summary(srv_instance, stats, samples, now, full)
+    return {'ok': True, 'peers': len(stats), 'samples': len(samples)}
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+# Per-interface client address allocator. State of the main interface lives in Server.data:
+# "ip_next" - offset (from network address) of the first never used address,
+# "ip_free" - offsets released by deleted clients, reused first,
+# extra interfaces keep the same pair in data["ipam"][<interface>].
+# Dual-stack interface gives a client the same offset in both networks: 10.10.10.5 and fd00:10::5.
+# Both allocation and release are O(1) and run under a row lock of the server.
+
+from ipaddress import ip_address
+
+from django.db import transaction
+
+from .models import Server, parse_networks
+
+# .0 is network address, .1 is the server itself
+FIRST_OFFSET = 2
+
+
+class AddressPoolExhausted(Exception):
+    pass
+
+
+def pool_size(network) -> int:
+    # Last usable offset + 1, IPv4 broadcast address is not usable
+    return network.num_addresses - 1 if network.version == 4 else network.num_addresses
+
+
+def _state(srv_instance: Server, iface: dict) -> tuple:
+    networks = parse_networks(iface['network'])
+    if iface['name'] != srv_instance.interfaces[0]['name']:
+        state = (srv_instance.data.get('ipam') or {}).get(iface['name']) or {}
+        return networks, state.get('ip_next', FIRST_OFFSET), list(state.get('ip_free', []))
+    ip_next = srv_instance.data.get('ip_next')
+    if ip_next is None:
+        # Servers created before the allocator kept only the last given address
+        last_ip = srv_instance.data.get('last_ip')
+        ip_next = int(ip_address(last_ip)) - int(networks[0].network_address) + 1 if last_ip else FIRST_OFFSET
+    return networks, ip_next, list(srv_instance.data.get('ip_free', []))
+
+
+def _set_state(srv_instance: Server, iface: dict, ip_next: int, ip_free: list):
+    if iface['name'] != srv_instance.interfaces[0]['name']:
+        srv_instance.data.setdefault('ipam', {})[iface['name']] = {'ip_next': ip_next, 'ip_free': ip_free}
+        return
+    srv_instance.data['ip_next'] = ip_next
+    srv_instance.data['ip_free'] = ip_free
+    srv_instance.data.pop('last_ip', None)
+
+
+def _save(srv_instance: Server):
+    # update() instead of save(): no server signals for every client
+    Server.objects.filter(id=srv_instance.id).update(data=srv_instance.data)
+
+
+def _size(networks: list) -> int:
+    return min(pool_size(network) for network in networks)
+
+
+def free_count(srv_instance: Server, interface: str = None) -> int:
+    free = 0
+    for iface in srv_instance.interfaces:
+        if interface is None or iface['name'] == interface:
+            networks, ip_next, ip_free = _state(srv_instance, iface)
+            free += max(_size(networks) - ip_next, 0) + len(ip_free)
+    return free
+
+
+def capacity(srv_instance: Server) -> int:
+    # Client addresses of all interfaces
+    return sum(max(_size(parse_networks(iface['network'])) - FIRST_OFFSET, 0) for iface in srv_instance.interfaces)
+
+
+def assign(data: dict, address: dict):
+    # Address from allocate() into client data, replacing the previous one
+    for key in ('interface', 'ip', 'ip6'):
+        data.pop(key, None)
+    data.update(address)
+
+
+def allocate(srv_id: int, count: int = 1, interface: str = None) -> list:
+    # [{"interface": "wg0", "ip": "10.10.10.2", "ip6": "fd00:10::2"}, ...], spread over interfaces:
+    # every address goes to the interface with the lowest share of used addresses
+    with transaction.atomic():
+        srv_instance = Server.objects.select_for_update().get(id=srv_id)
+        pools = []
+        for iface in srv_instance.interfaces:
+            if interface is None or iface['name'] == interface:
+                networks, ip_next, ip_free = _state(srv_instance, iface)
+                pools.append([iface, networks, ip_next, ip_free, _size(networks)])
+        if count > sum(max(size - ip_next, 0) + len(ip_free) for _, _, ip_next, ip_free, size in pools):
+            raise AddressPoolExhausted(f'No free addresses left in {srv_instance.network} of server {srv_instance}')
+        addresses = []
+        for _ in range(count):
+            pool = min((pool for pool in pools if pool[3] or pool[2] < pool[4]),
+                       key=lambda pool: (pool[2] - FIRST_OFFSET - len(pool[3])) / (pool[4] - FIRST_OFFSET))
+            iface, networks, ip_next, ip_free, size = pool
+            if ip_free:
+                offset = ip_free.pop()
+            else:
+                offset = ip_next
+                pool[2] += 1
+            ips = [str(network.network_address + offset) for network in networks]
+            addresses.append({'interface': iface['name'], 'ip': ips[0], **({'ip6': ips[1]} if len(ips) > 1 else {})})
+        for iface, networks, ip_next, ip_free, size in pools:
+            _set_state(srv_instance, iface, ip_next, ip_free)
+        _save(srv_instance)
+    return addresses
+
+
+def release(srv_id: int, *ips):
+    with transaction.atomic():
+        srv_instance = Server.objects.select_for_update().filter(id=srv_id).first()
+        if not srv_instance:
+            return
+        pools = [(iface, *_state(srv_instance, iface)) for iface in srv_instance.interfaces]
+        free = {iface['name']: set(ip_free) for iface, _, _, ip_free in pools}
+        for ip in ips:
+            try:
+                address = ip_address(ip)
+            except ValueError:
+                continue
+            for iface, networks, ip_next, ip_free in pools:
+                network = next((network for network in networks if address in network), None)
+                if network is None:
+                    continue
+                offset = int(address) - int(network.network_address)
+                if FIRST_OFFSET <= offset < ip_next and offset not in free[iface['name']]:
+                    ip_free.append(offset)
+                    free[iface['name']].add(offset)
+                break
+        for iface, networks, ip_next, ip_free in pools:
+            _set_state(srv_instance, iface, ip_next, ip_free)
+        _save(srv_instance)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef
+from django.utils import timezone
+from loguru import logger
+
+from .models import Job, Server
+
+
+def enqueue(srv_id: int, operation: str) -> Job:
+    # Same operation already waiting for the server covers this request too
+    job = Job.objects.filter(server_id=srv_id, operation=operation, status=Job.PENDING).first()
+    if job:
+        return job
+    return Job.objects.create(server_id=srv_id, operation=operation)
+
+
+def run_operation(srv_instance: Server, operation: str) -> dict:
+    from .services import ssh_remote_server
+    from .sync import sync_server
+    if operation == 'sync':
+        return sync_server(srv_instance)
+    if operation == 'restart':
+        return ssh_remote_server(srv_instance, restart=True)
+    if operation == 'stop':
+        return ssh_remote_server(srv_instance, stop=True)
+    if operation == 'statistic':
+        return ssh_remote_server(srv_instance, statistic=True)
+    return {'ok': False, 'msg': f'unknown operation {operation}'}
+
+
+def claim_job():
+    # One running job per server at a time. The claim is one conditional update (pending and no running job
+    # of the server) under a row lock of the server, so two workers never run jobs of the same server
+    now = timezone.now()
+    busy = Job.objects.filter(status=Job.RUNNING).values('server_id')
+    candidates = Job.objects.filter(status=Job.PENDING, run_after__lte=now).exclude(server_id__in=busy)
+    for job in candidates.order_by('id')[:10]:
+        with transaction.atomic():
+            Server.objects.select_for_update().filter(id=job.server_id).first()
+            running = Job.objects.filter(server_id=OuterRef('server_id'), status=Job.RUNNING)
+            claimed = Job.objects.filter(id=job.id, status=Job.PENDING).exclude(Exists(running)).update(
+                status=Job.RUNNING, attempts=F('attempts') + 1, update_at=now)
+        if claimed:
+            job.refresh_from_db()
+            return job
+    return None
+
+
+def run_job(job: Job) -> Job:
+    try:
+        result = run_operation(job.server, job.operation)
+    except Exception as e:  # noqa
+        logger.exception(f'job {job} failed')
+        result = {'ok': False, 'msg': str(e)}
+
+    job.result = result
+    if result.get('ok'):
+        job.status = Job.DONE
+    elif job.attempts < settings.JOB_MAX_ATTEMPTS:
+        # Exponential backoff: base, 2*base, 4*base ... up to JOB_RETRY_MAX
+        delay = min(settings.JOB_RETRY_BASE * 2 ** (job.attempts - 1), settings.JOB_RETRY_MAX)
+        job.status = Job.PENDING
+        job.run_after = timezone.now() + timedelta(seconds=delay)
+        logger.warning(f'job {job} failed ({result.get("msg")}), retry in {delay}s')
+    else:
+        job.status = Job.FAILED
+        logger.error(f'job {job} failed after {job.attempts} attempts: {result.get("msg")}')
+    job.save(update_fields=['result', 'status', 'run_after', 'update_at'])
+    return job
+
+
+def run_pending() -> int:
+    # Jobs of different servers run concurrently, claim_job never gives two jobs of the same server
+    from .services import fan_out
+    count = 0
+    while True:
+        jobs = []
+        while len(jobs) < settings.FAN_OUT_WORKERS and (job := claim_job()):
+            jobs.append(job)
+        if not jobs:
+            return count
+        fan_out(jobs, run_job)
+        count += len(jobs)
+
+
+def requeue_stale() -> int:
+    # Jobs left running by a killed worker
+    deadline = timezone.now() - timedelta(seconds=settings.JOB_TIMEOUT)
+    return Job.objects.filter(status=Job.RUNNING, update_at__lt=deadline).update(status=Job.PENDING)
+
+
+def cleanup(days: int = 7) -> int:
+    deadline = timezone.now() - timedelta(days=days)
+    deleted, _ = Job.objects.filter(status__in=[Job.DONE, Job.FAILED], update_at__lt=deadline).delete()
+    return deleted
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+from django.core.management.base import BaseCommand, CommandError
+
+from vpn.ingest import issue_token
+from vpn.models import Server
+
+
+class Command(BaseCommand):
+    help = 'Issue (or replace) the token of the statistic agent of a server, ssh polling of the server stops'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--server', required=True, help='Server id or name')
+        parser.add_argument('--revoke', action='store_true', help='Remove token, poll the server over ssh again')
+
+    def handle(self, *args, **options):
+        lookup = {'id': options['server']} if options['server'].isdigit() else {'name': options['server']}
+        srv = Server.objects.filter(**lookup).first()
+        if not srv:
+            raise CommandError(f'Server {options["server"]} not found')
+        if options['revoke']:
+            srv.data.pop('agent_token', None)
+            Server.objects.filter(id=srv.id).update(data=srv.data)
+            self.stdout.write(f'Agent token of {srv} removed')
+            return
+        self.stdout.write(f'{srv.id}.{issue_token(srv)}')
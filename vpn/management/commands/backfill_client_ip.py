@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+from django.core.management.base import BaseCommand
+
+from vpn.models import Client
+
+
+class Command(BaseCommand):
+    help = 'Fill indexed Client.ip column from client data (once, after upgrade)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=2000, help='Clients per update query')
+
+    def handle(self, *args, **options):
+        updated = 0
+        batch = []
+        # bulk_update sends no signals, so nothing is pushed to servers
+        for client in Client.objects.only('id', 'ip', 'data').iterator(chunk_size=options['batch']):
+            ip = client.data.get('ip') or None
+            if client.ip != ip:
+                client.ip = ip
+                batch.append(client)
+            if len(batch) >= options['batch']:
+                updated += Client.objects.bulk_update(batch, ['ip'])
+                batch = []
+        if batch:
+            updated += Client.objects.bulk_update(batch, ['ip'])
+        self.stdout.write(f'{updated} clients updated')
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+from django.core.management.base import BaseCommand, CommandError
+
+from vpn.bench import BENCHMARKS, load_results, save_results
+
+
+class Command(BaseCommand):
+    help = 'Run performance benchmarks (push and statistic run against a local fake WireGuard host)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help=f'Benchmarks to run: {", ".join(BENCHMARKS)} (all by default)')
+        parser.add_argument('--peers', default='10000',
+                            help='Number of synthetic peers, comma-separated for several runs')
+        parser.add_argument('--repeat', type=int, default=3, help='Best of N runs')
+        parser.add_argument('--save', help='Write results to this JSON file')
+        parser.add_argument('--compare', help='JSON file of a previous run (--save) to compare with')
+
+    def handle(self, *args, **options):
+        if unknown := set(options['names']) - set(BENCHMARKS):
+            raise CommandError(f'Unknown benchmarks: {", ".join(unknown)}')
+        baseline = {}
+        if options['compare']:
+            try:
+                baseline = load_results(options['compare'])
+            except (OSError, ValueError, KeyError) as e:
+                raise CommandError(f'Can not read {options["compare"]}: {e}')
+        results = []
+        for name in options['names'] or BENCHMARKS:
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            for peers in [int(p) for p in options['peers'].split(',')]:
+                for title, seconds in BENCHMARKS[name](peers, options['repeat']):
+                    results.append((name, title, seconds))
+                    line = f'  {title:<60} {seconds * 1000:>10.1f} ms'
+                    if before := baseline.get((name, title)):
+                        change = (seconds - before) / before * 100
+                        style = self.style.ERROR if change > 10 else self.style.SUCCESS if change < -10 else str
+                        line += style(f'  {before * 1000:>10.1f} ms {change:+6.1f}%')
+                    self.stdout.write(line)
+        if options['save']:
+            save_results(options['save'], results)
+            self.stdout.write(f'Results saved to {options["save"]}')
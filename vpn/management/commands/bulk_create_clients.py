@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from vpn.ipam import AddressPoolExhausted
+from vpn.models import Server, Group
+from vpn.placement import PlacementError
+from vpn.provision import bulk_create_clients, bulk_place_clients, parse_csv
+
+
+class Command(BaseCommand):
+    help = 'Create many clients at once from CSV file (name, group, description, allowed) or by count'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--server', required=True, help='Server id or name, "auto" to spread over servers by load')
+        parser.add_argument('--group', help='Client group name (default for CSV rows without group)')
+        parser.add_argument('--file', help='CSV file, "-" for stdin')
+        parser.add_argument('--count', type=int, help='Create N clients named <prefix><number>')
+        parser.add_argument('--prefix', default='client-', help='Name prefix for --count')
+        parser.add_argument('--user', help='Owner username')
+        parser.add_argument('--disabled', action='store_true', help='Create clients not active')
+
+    def handle(self, *args, **options):
+        srv = None
+        if options['server'] != 'auto':
+            lookup = {'id': options['server']} if options['server'].isdigit() else {'name': options['server']}
+            if not (srv := Server.objects.filter(**lookup).first()):
+                raise CommandError(f'Server {options["server"]} not found')
+        group = None
+        if options['group'] and not (group := Group.objects.filter(name=options['group']).first()):
+            raise CommandError(f'Client group {options["group"]} not found')
+        user = None
+        if options['user'] and not (user := User.objects.filter(username=options['user']).first()):
+            raise CommandError(f'User {options["user"]} not found')
+
+        if options['file']:
+            if options['file'] == '-':
+                import sys
+                rows = parse_csv(sys.stdin.read())
+            else:
+                with open(options['file'], encoding='utf-8') as f:
+                    rows = parse_csv(f.read())
+        elif options['count']:
+            rows = [{'name': f'{options["prefix"]}{n}'} for n in range(1, options['count'] + 1)]
+        else:
+            raise CommandError('Use --file or --count')
+
+        started = time.monotonic()
+        try:
+            if srv:
+                clients = bulk_create_clients(srv, rows, group=group, user=user, is_enable=not options['disabled'])
+            else:
+                clients = bulk_place_clients(rows, group=group, user=user, is_enable=not options['disabled'])
+        except (ValueError, AddressPoolExhausted, PlacementError) as e:
+            raise CommandError(e)
+        placed = {}
+        for client in clients:
+            placed[client.server.name] = placed.get(client.server.name, 0) + 1
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(clients)} clients created in {time.monotonic() - started:.2f}s: '
+            f'{", ".join(f"{name} {count}" for name, count in placed.items())}'))
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from loguru import logger
+
+from vpn.collector import collect_all, downsample
+
+
+class Command(BaseCommand):
+    help = 'Poll peer statistic of all active servers and store traffic history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Poll servers once and exit')
+        parser.add_argument('--interval', type=int, default=settings.STATS_INTERVAL, help='Poll interval, seconds')
+
+    def handle(self, *args, **options):
+        last_downsample = 0
+        while True:
+            started = time.monotonic()
+            close_old_connections()
+            for srv_id, result in collect_all().items():
+                if not result.get('ok'):
+                    logger.error(f'collect stats from server {srv_id} failed: {result.get("msg")}')
+            if time.monotonic() - last_downsample > 3600:
+                hourly, raw, expired = downsample()
+                logger.info(f'stats downsample: {raw} raw samples to {hourly} hourly, {expired} expired')
+                last_downsample = time.monotonic()
+            if options['once']:
+                return
+            time.sleep(max(0, options['interval'] - (time.monotonic() - started)))
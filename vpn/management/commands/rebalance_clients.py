@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+from django.core.management.base import BaseCommand
+
+from vpn.placement import rebalance, server_loads
+
+
+class Command(BaseCommand):
+    help = 'Move clients from overloaded to idle servers in batches (moved clients must download config again)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=50, help='Clients moved and pushed at once')
+        parser.add_argument('--limit', type=int, help='Move at most N clients')
+        parser.add_argument('--threshold', type=float, help='Stop when loads differ by this much (0..1)')
+        parser.add_argument('--dry-run', action='store_true', help='Only show what would be moved')
+
+    def handle(self, *args, **options):
+        from vpn.coalesce import flush
+        for load in server_loads():
+            self.stdout.write(f'  {load}')
+        moved = 0
+        for source, target, clients in rebalance(options['batch'], options['limit'], options['threshold'],
+                                                 options['dry_run']):
+            moved += len(clients)
+            self.stdout.write(f'{len(clients)} clients {source.srv} -> {target.srv}: '
+                              f'{", ".join(client.name for client in clients[:5])}{" ..." if len(clients) > 5 else ""}')
+            if options['dry_run']:
+                continue
+            # Push this batch before the next one, both sides get a diff-only sync
+            for srv_id, result in flush().items():
+                if not result.get('ok'):
+                    self.stderr.write(f'  server {srv_id}: {result.get("msg")}')
+        if not moved:
+            self.stdout.write('Servers are balanced')
+            return
+        self.stdout.write(self.style.SUCCESS(f'{moved} clients {"to move" if options["dry_run"] else "moved"}'))
+        if not options['dry_run']:
+            for load in server_loads():
+                self.stdout.write(f'  {load}')
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from loguru import logger
+
+from vpn.jobs import run_pending, requeue_stale, cleanup
+
+
+class Command(BaseCommand):
+    help = 'Run remote server jobs (sync, restart, stop, statistic) from the job queue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Run pending jobs and exit')
+        parser.add_argument('--interval', type=float, default=1.0, help='Poll interval, seconds')
+        parser.add_argument('--keep-days', type=int, default=7, help='Delete finished jobs older than N days')
+
+    def handle(self, *args, **options):
+        logger.info(f'worker started, requeue {requeue_stale()} stale jobs')
+        last_cleanup, last_requeue = 0, time.monotonic()
+        while True:
+            close_old_connections()
+            # Jobs of a worker which died while this one is running
+            if time.monotonic() - last_requeue > settings.JOB_TIMEOUT / 2:
+                if count := requeue_stale():
+                    logger.warning(f'worker: requeue {count} stale jobs')
+                last_requeue = time.monotonic()
+            count = run_pending()
+            if count:
+                logger.info(f'worker: {count} jobs done')
+            if time.monotonic() - last_cleanup > 3600:
+                cleanup(options['keep_days'])
+                last_cleanup = time.monotonic()
+            if options['once']:
+                return
+            time.sleep(options['interval'])
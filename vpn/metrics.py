@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+# In-process counters and histograms of control plane operations.
+# Recording is a dict update under a lock. Every METRICS_FLUSH seconds a process puts its snapshot to cache,
+# /metrics and the admin page sum snapshots of all processes (web workers, run_worker, collect_stats).
+
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+# Seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+HELP = {
+    'wg_ssh_connect_seconds': 'SSH connect and authentication time',
+    'wg_ssh_command_seconds': 'Remote command time',
+    'wg_ssh_pool_total': 'SSH pool checkouts by result',
+    'wg_config_upload_seconds': 'Server config render and upload time',
+    'wg_client_config_render_seconds': 'Client config render time',
+    'wg_dump_parse_seconds': 'wg dump parse time',
+    'wg_cache_requests_total': 'Cache lookups by result',
+    'wg_operation_seconds': 'Server operation time, lock wait included',
+    'wg_download_seconds': 'Client config download view time',
+}
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_last_flush = 0.0
+PROCESS = f'{socket.gethostname()}:{os.getpid()}'
+
+
+def _key(labels: dict) -> tuple:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def observe(name: str, seconds: float, **labels):
+    if not settings.METRICS_ENABLED:
+        return
+    with _lock:
+        series = _histograms.setdefault(name, {}).get(_key(labels))
+        if series is None:
+            # Bucket counts, sum, count
+            series = _histograms[name][_key(labels)] = [0] * len(BUCKETS) + [0.0, 0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                series[i] += 1
+                break
+        series[-2] += seconds
+        series[-1] += 1
+    _maybe_flush()
+
+
+def inc(name: str, value: int = 1, **labels):
+    if not settings.METRICS_ENABLED:
+        return
+    with _lock:
+        series = _counters.setdefault(name, {})
+        key = _key(labels)
+        series[key] = series.get(key, 0) + value
+    _maybe_flush()
+
+
+@contextmanager
+def timer(name: str, **labels):
+    # Labels may be added inside the block: with timer(...) as labels: labels['result'] = 'hit'
+    started = time.perf_counter()
+    try:
+        yield labels
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+def snapshot() -> dict:
+    with _lock:
+        return {'histograms': {name: {key: list(series) for key, series in values.items()}
+                               for name, values in _histograms.items()},
+                'counters': {name: dict(values) for name, values in _counters.items()}}
+
+
+def _maybe_flush():
+    if time.monotonic() - _last_flush >= settings.METRICS_FLUSH:
+        flush()
+
+
+def flush():
+    global _last_flush
+    _last_flush = time.monotonic()
+    ttl = settings.METRICS_FLUSH * 30
+    try:
+        cache.set(f'metrics:{PROCESS}', snapshot(), ttl)
+        # Read-modify-write, an entry lost in a race comes back with the next flush
+        processes = cache.get('metrics:processes') or {}
+        now = time.time()
+        processes = {process: seen for process, seen in processes.items() if now - seen < ttl}
+        processes[PROCESS] = now
+        cache.set('metrics:processes', processes, None)
+    except Exception:  # noqa
+        # Metrics never break the operation they measure
+        pass
+
+
+def collect() -> dict:
+    # Sum of snapshots of all live processes
+    flush()
+    processes = cache.get('metrics:processes') or {}
+    merged = {'histograms': {}, 'counters': {}}
+    for data in cache.get_many([f'metrics:{process}' for process in processes]).values():
+        for name, values in data['histograms'].items():
+            target = merged['histograms'].setdefault(name, {})
+            for key, series in values.items():
+                target[key] = [a + b for a, b in zip(target[key], series)] if key in target else list(series)
+        for name, values in data['counters'].items():
+            target = merged['counters'].setdefault(name, {})
+            for key, value in values.items():
+                target[key] = target.get(key, 0) + value
+    return merged
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(key: tuple, **extra) -> str:
+    pairs = list(key) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def render(data: dict) -> str:
+    # Prometheus text exposition format
+    lines = []
+    for name, values in sorted(data['histograms'].items()):
+        lines += [f'# HELP {name} {HELP.get(name, name)}', f'# TYPE {name} histogram']
+        for key, series in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS, series):
+                cumulative += count
+                lines.append(f'{name}_bucket{_labels(key, le=bound)} {cumulative}')
+            lines.append(f'{name}_bucket{_labels(key, le="+Inf")} {series[-1]}')
+            lines.append(f'{name}_sum{_labels(key)} {series[-2]}')
+            lines.append(f'{name}_count{_labels(key)} {series[-1]}')
+    for name, values in sorted(data['counters'].items()):
+        lines += [f'# HELP {name} {HELP.get(name, name)}', f'# TYPE {name} counter']
+        for key, value in sorted(values.items()):
+            lines.append(f'{name}{_labels(key)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def quantile(series: list, q: float):
+    # Upper bound of the bucket holding the q-quantile
+    count = series[-1]
+    if not count:
+        return None
+    cumulative = 0
+    for bound, bucket in zip(BUCKETS, series):
+        cumulative += bucket
+        if cumulative >= q * count:
+            return bound
+    return float('inf')
+
+
+def _ms(seconds) -> str:
+    if seconds is None:
+        return ''
+    return f'> {BUCKETS[-1] * 1000:g}' if seconds == float('inf') else f'{seconds * 1000:.1f}'
+
+
+def summary(data: dict) -> list:
+    # Rows for the admin page, times in milliseconds
+    rows = []
+    for name, values in sorted(data['histograms'].items()):
+        for key, series in sorted(values.items()):
+            rows.append({'name': name, 'labels': ', '.join(f'{k}={v}' for k, v in key), 'count': series[-1],
+                         'avg': _ms(series[-2] / series[-1] if series[-1] else None),
+                         'p50': _ms(quantile(series, 0.5)), 'p95': _ms(quantile(series, 0.95)),
+                         'p99': _ms(quantile(series, 0.99))})
+    for name, values in sorted(data['counters'].items()):
+        for key, value in sorted(values.items()):
+            rows.append({'name': name, 'labels': ', '.join(f'{k}={v}' for k, v in key), 'count': value})
+    return rows
@@ -1,14 +1,17 @@
 # -*- coding: utf-8 -*-
 import random
 import re
+from datetime import datetime
+
+import humanize
 from loguru import logger
 
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.db import models
-from django.core.cache import cache
 from django.contrib.auth.models import User
-from ipaddress import IPv4Network, ip_address, AddressValueError, ip_network
+from django.utils import timezone
+from ipaddress import AddressValueError, ip_address, ip_network
 from django.utils.translation import gettext_lazy as _
 
 
@@ -16,6 +19,18 @@ def default_server_data():
     return {'interface': 'wg0'}
 
 
+INTERFACE_NAME = re.compile(r'^[a-zA-Z0-9_=+.-]{1,15}$')
+
+
+def parse_networks(value: str) -> list:
+    # "10.10.10.0/24" or dual-stack "10.10.10.0/24, fd00:10::/64", at most one network per family, IPv4 first
+    networks = sorted((ip_network(net.strip(), strict=False) for net in (value or '').split(',') if net.strip()),
+                      key=lambda net: net.version)
+    if not networks or len({net.version for net in networks}) != len(networks):
+        raise ValueError(f'{value} - one IPv4 and / or one IPv6 network expected')
+    return networks
+
+
 class Server(models.Model):
     name = models.CharField(max_length=255, blank=False, null=False, verbose_name=_("Server name"))
     ip = models.CharField(max_length=255, verbose_name="IP/Hostname", default='0.0.0.0', blank=False, null=False)
@@ -34,17 +49,63 @@ class Server(models.Model):
     @property
     def ssh_copy_id_help(self) -> str:
         if self.name:
-            return f'ssh-copy-id -i {settings.BASE_DIR}/config/keys/{self.id}.pub root@{self.ip}'
+            port = f'-p {self.data["ssh_port"]} ' if self.data.get('ssh_port') else ''
+            return f'ssh-copy-id -i {settings.BASE_DIR}/config/keys/{self.id}.pub {port}root@{self.ip}'
         return "-"
 
+    @property
+    def interfaces(self) -> list:
+        # Main interface from server fields, extra ones from data["interfaces"]:
+        # [{"name": "wg1", "port": 41801, "network": "10.10.11.0/24, fd00:11::/64"}], keys are generated on save
+        main = {'name': self.data.get('interface') or 'wg0', 'port': self.port, 'network': self.network,
+                'private_key': self.data.get('private_key'), 'public_key': self.data.get('public_key')}
+        return [main] + [dict(iface) for iface in self.data.get('interfaces') or []]
+
+    def get_interface(self, name: str = None) -> dict:
+        # Clients without interface (or with a removed one) are on the main interface
+        interfaces = self.interfaces
+        return next((iface for iface in interfaces if iface['name'] == name), interfaces[0])
+
+    def interface_clients(self, name: str = None) -> models.Q:
+        # Filter of clients on the interface
+        interfaces = self.interfaces
+        if name and name != interfaces[0]['name']:
+            return models.Q(data__interface=name)
+        return ~models.Q(data__interface__in=[iface['name'] for iface in interfaces[1:]]) | models.Q(
+            data__interface__isnull=True)
+
     def clean(self):
         try:
-            IPv4Network(self.network)
+            parse_networks(self.network)
         except (ValueError, AddressValueError):
             raise ValidationError({"network": "Not looks like valid network"})
+        extra = self.data.get('interfaces') or []
+        if not isinstance(extra, list) or not all(isinstance(iface, dict) for iface in extra):
+            raise ValidationError({"data": '"interfaces" must be a list of {"name", "port", "network"}'})
+        names, ports = {self.data.get('interface') or 'wg0'}, {self.port}
+        for iface in extra:
+            name, port = iface.get('name'), iface.get('port')
+            if not isinstance(name, str) or not INTERFACE_NAME.match(name) or name in names:
+                raise ValidationError({"data": f'interface name "{name}" is not valid or not unique'})
+            if not isinstance(port, int) or not 0 < port < 65536 or port in ports:
+                raise ValidationError({"data": f'{name}: port "{port}" is not valid or not unique'})
+            try:
+                parse_networks(iface.get('network'))
+            except (ValueError, AddressValueError, TypeError):
+                raise ValidationError({"data": f'{name}: "{iface.get("network")}" not looks like valid network'})
+            names.add(name)
+            ports.add(port)
+        if self.pk:
+            # Clients of a removed interface would get into the main one with addresses of another subnet
+            current = Server.objects.filter(id=self.pk).values_list('data', flat=True).first() or {}
+            removed = {iface.get('name') for iface in current.get('interfaces') or []} - names
+            if removed and (used := Client.objects.filter(server_id=self.pk, data__interface__in=removed).values_list(
+                    'data__interface', flat=True).distinct()):
+                raise ValidationError({"data": f'interface {", ".join(sorted(used))} still has clients'})
 
     def save(self, *args, **kwargs):
         created = self._state.adding
+        current = {}
         if created:
             private_key, public_key = key_gen()
             self.data['interface'] = 'wg0'
@@ -52,6 +113,21 @@ class Server(models.Model):
             self.data['route'] = '0.0.0.0/0'
             self.data['private_key'] = private_key
             self.data['public_key'] = public_key
+        else:
+            # Address allocator and pushed config state are not edited here, never overwrite them with a stale copy
+            current = Server.objects.filter(id=self.id).values_list('data', flat=True).first() or {}
+            for key in ('ip_next', 'ip_free', 'ipam', 'pushed_hash'):
+                if key in current:
+                    self.data[key] = current[key]
+        # Extra interfaces keep their keys when edited without them
+        keys = {iface.get('name'): iface for iface in current.get('interfaces') or []}
+        for iface in self.data.get('interfaces') or []:
+            if not iface.get('private_key'):
+                known = keys.get(iface.get('name')) or {}
+                if known.get('private_key'):
+                    iface['private_key'], iface['public_key'] = known['private_key'], known['public_key']
+                else:
+                    iface['private_key'], iface['public_key'] = key_gen()
         super(Server, self).save(*args, **kwargs)
 
 
@@ -98,6 +174,9 @@ class Client(models.Model):
     server = models.ForeignKey(Server, blank=False, null=True,
                                on_delete=models.SET_NULL, verbose_name=_('Server'))
     data = models.JSONField(default=dict, verbose_name=_("Client data"), blank=True)
+    # Copy of data["ip"] for indexed search and sorting, JSON lookups can't use an index on SQLite
+    ip = models.CharField(max_length=64, blank=True, null=True, db_index=True, editable=False,
+                          verbose_name=_("IP address"))
     download_count = models.IntegerField(default=0, verbose_name=_("Download count"))
     enable_download = models.BooleanField(default=True, verbose_name=_("Enable download"))
     user = models.ForeignKey(User, blank=True, null=True, on_delete=models.SET_NULL, verbose_name=_("User"))
@@ -110,60 +189,170 @@ class Client(models.Model):
         verbose_name_plural = _('Clients')
 
     @property
-    def set_add(self) -> str:
-        interface = self.server.data.get('interface') if self.server.data.get('interface') else 'wg0'
-        return f'wg set {interface} peer {self.data.get("public_key")} allowed-ips {self.data.get("ip")}/32' \
-               f'{"," + self.data.get("allowed") if self.data.get("allowed") else ""} '\
-               f'persistent-keepalive {self.server.data.get("persistent")}'
-
-    @property
-    def set_remove(self) -> str:
-        interface = self.server.data.get('interface') if self.server.data.get('interface') else 'wg0'
-        return f'wg set {interface} peer {self.data.get("public_key")} remove'
+    def stats(self) -> dict:
+        # Filled in bulk by prefetch_stats() for changelist pages, otherwise one stats store lookup per instance
+        if not hasattr(self, '_stats'):
+            from .stats_store import get_stats_store
+            public_key = self.data.get('public_key')
+            self._stats = (get_stats_store().get(public_key) if public_key else None) or {}
+        return self._stats
 
     @property
     def last_seen(self) -> str:
-        cache_data = cache.get(self.data.get('public_key'))
-        if cache_data:
-            return cache_data.get('last_seen')
-        return '-'
+        handshake = int(self.stats.get('last_handshake') or 0)
+        return humanize.naturaltime(datetime.fromtimestamp(handshake)) if handshake else '-'
 
     @property
     def traffic(self) -> str:
-        cache_data = cache.get(self.data.get('public_key'))
-        if cache_data:
-            return cache_data.get('traffic')
-        return '-'
+        if not self.stats:
+            return '-'
+        rx, tx = int(self.stats['rx_bytes']), int(self.stats['tx_bytes'])
+        return f'{humanize.naturalsize(rx)} / {humanize.naturalsize(tx)}'
 
     @property
     def remote_ip(self) -> str:
-        cache_data = cache.get(self.data.get('public_key'))
-        if cache_data and cache_data.get('remote_ip'):
-            return cache_data.get('remote_ip').split(':')[0]
+        if self.stats.get('remote_ip'):
+            # "1.2.3.4:51820" or "[2001:db8::1]:51820"
+            return self.stats.get('remote_ip').rsplit(':', 1)[0].strip('[]')
         return '-'
 
+    def clean(self):
+        from .ipam import free_count
+        from .placement import PlacementError, choose_server
+        moved = not self._state.adding and self.server_id and Client.objects.filter(id=self.id).exclude(
+            server_id=self.server_id).exists()
+        if (self._state.adding or moved) and self.server_id and not free_count(Server.objects.get(id=self.server_id)):
+            raise ValidationError({"server": _("No free addresses left in the server network")})
+        if self._state.adding and not self.server_id:
+            try:
+                choose_server()
+            except PlacementError as e:
+                raise ValidationError({"server": str(e)})
+
     def save(self, *args, **kwargs):
         created = self._state.adding
         if created:
+            from .ipam import allocate, assign
+            if not self.server_id:
+                # New client without server goes to the least loaded one
+                from .placement import choose_server
+                self.server = choose_server()
             private_key, public_key = key_gen()
-            server_instance = Server.objects.get(id=self.server_id)
-            network = IPv4Network(server_instance.network)
-            last_ip = server_instance.data.get('last_ip')
-            if not last_ip:
-                last_ip = int(network.network_address) + 1
-
-            last_ip = ip_address(int(ip_address(last_ip)) + 1)
-            server_instance.data['last_ip'] = str(last_ip)
-            server_instance.save()
-
-            self.data['ip'] = str(last_ip)
+            assign(self.data, allocate(self.server_id)[0])
             self.data['private_key'] = private_key
             self.data['public_key'] = public_key
-            self.rnd = f'%0{6}x' % random.randrange(16**6)
+            self.rnd = rnd_gen()
+        else:
+            old_server_id, old_ip = Client.objects.filter(id=self.id).values_list(
+                'server_id', 'data__ip').first() or (self.server_id, None)
+            if old_server_id != self.server_id:
+                # Moved to another server: new address there, the old one back to the pool of the old server
+                from .ipam import allocate, assign, release
+                assign(self.data, allocate(self.server_id)[0] if self.server_id else {})
+                if old_server_id:
+                    release(old_server_id, old_ip)
+        self.ip = self.data.get('ip') or None
 
         super(Client, self).save(*args, **kwargs)
 
 
+class Job(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, _('Pending')), (RUNNING, _('Running')), (DONE, _('Done')), (FAILED, _('Failed'))]
+    OPERATION_CHOICES = [('sync', _('Sync peers')), ('restart', _('Restart')), ('stop', _('Stop')),
+                         ('statistic', _('Statistic'))]
+
+    server = models.ForeignKey(Server, on_delete=models.CASCADE, verbose_name=_('Server'))
+    operation = models.CharField(max_length=32, choices=OPERATION_CHOICES, verbose_name=_("Operation"))
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING, db_index=True,
+                              verbose_name=_("Status"))
+    attempts = models.IntegerField(default=0, verbose_name=_("Attempts"))
+    run_after = models.DateTimeField(default=timezone.now, db_index=True, verbose_name=_("Run after"))
+    result = models.JSONField(default=dict, verbose_name=_("Result"), blank=True)
+    created_at = models.DateTimeField(verbose_name=_("Create time"), auto_now_add=True)
+    update_at = models.DateTimeField(verbose_name=_("Update time"), auto_now=True)
+
+    def __str__(self):
+        return f'{self.operation} {self.server_id} #{self.id}'
+
+    class Meta:
+        verbose_name = _('Job')
+        verbose_name_plural = _('Jobs')
+
+
+class Operation(models.Model):
+    # Log of changing operations on servers, id is the sequence number.
+    # A sync covers every sync of the same server logged before it started, those are marked as skipped
+    PENDING = 'pending'
+    DONE = 'done'
+    SKIPPED = 'skipped'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, _('Pending')), (DONE, _('Done')), (SKIPPED, _('Skipped')), (FAILED, _('Failed'))]
+    OPERATION_CHOICES = [('sync', _('Sync peers')), ('push', _('Push config')), ('restart', _('Restart')),
+                         ('stop', _('Stop'))]
+
+    server = models.ForeignKey(Server, on_delete=models.CASCADE, verbose_name=_('Server'))
+    operation = models.CharField(max_length=32, choices=OPERATION_CHOICES, verbose_name=_("Operation"))
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING, verbose_name=_("Status"))
+    covered_by = models.BigIntegerField(blank=True, null=True, verbose_name=_("Covered by"))
+    result = models.JSONField(default=dict, verbose_name=_("Result"), blank=True)
+    created_at = models.DateTimeField(verbose_name=_("Create time"), auto_now_add=True, db_index=True)
+    update_at = models.DateTimeField(verbose_name=_("Update time"), auto_now=True)
+
+    def __str__(self):
+        return f'{self.operation} {self.server_id} #{self.id}'
+
+    class Meta:
+        verbose_name = _('Operation')
+        verbose_name_plural = _('Operations')
+        indexes = [models.Index(fields=['server', 'operation', 'status'])]
+
+
+class PeerSample(models.Model):
+    # Time-series of peer counters, raw samples are downsampled to hourly rows by the collector
+    RAW = 0
+    HOURLY = 3600
+
+    server = models.ForeignKey(Server, on_delete=models.CASCADE, verbose_name=_('Server'))
+    public_key = models.CharField(max_length=64, verbose_name=_("Public key"))
+    ts = models.IntegerField(verbose_name=_("Timestamp"))
+    resolution = models.IntegerField(default=RAW, verbose_name=_("Resolution"))
+    rx = models.BigIntegerField(default=0, verbose_name="RX")
+    tx = models.BigIntegerField(default=0, verbose_name="TX")
+    rx_rate = models.FloatField(default=0, verbose_name=_("RX rate"))
+    tx_rate = models.FloatField(default=0, verbose_name=_("TX rate"))
+    handshake = models.IntegerField(default=0, verbose_name=_("Last handshake"))
+
+    def __str__(self):
+        return f'{self.public_key} {self.ts}'
+
+    class Meta:
+        verbose_name = _('Peer sample')
+        verbose_name_plural = _('Peer samples')
+        indexes = [models.Index(fields=['public_key', 'ts']), models.Index(fields=['resolution', 'ts'])]
+
+
+def prefetch_stats(clients) -> None:
+    # One stats store round-trip for all clients instead of one per client and column
+    from .stats_store import get_stats_store
+    keys = [client.data.get('public_key') for client in clients if client.data.get('public_key')]
+    found = get_stats_store().get_many(keys) if keys else {}
+    for client in clients:
+        client._stats = found.get(client.data.get('public_key')) or {}
+
+
+def client_addresses(data: dict) -> list:
+    # Tunnel addresses of a client as host routes: "10.10.10.2/32", "fd00:10::2/128"
+    return [f'{ip}/{ip_address(ip).max_prefixlen}' for ip in (data.get('ip'), data.get('ip6')) if ip]
+
+
+def rnd_gen() -> str:
+    return f'%0{6}x' % random.randrange(16**6)
+
+
 def key_gen() -> list:
     from .keygen import PrivateKey
     private_key = PrivateKey.generate()
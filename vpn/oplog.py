@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+# Changing operations on a server run one at a time across all processes of the host (file lock per server)
+# and are logged with a sequence number. Sync reads the whole desired state at start, so it makes every
+# sync logged before it redundant: those are marked as skipped and return without touching the server.
+
+import fcntl
+import os
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Max
+from django.utils import timezone
+from loguru import logger
+
+from .metrics import observe
+from .models import Operation, Server
+
+
+class ServerLocked(Exception):
+    pass
+
+
+@contextmanager
+def server_lock(srv_id: int, timeout: float = None):
+    timeout = settings.SERVER_LOCK_TIMEOUT if timeout is None else timeout
+    os.makedirs(settings.SERVER_LOCK_DIR, exist_ok=True)
+    # Every call opens its own file description, so threads of one process exclude each other as well
+    with open(os.path.join(settings.SERVER_LOCK_DIR, f'server-{srv_id}.lock'), 'a') as file:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    raise ServerLocked(f'server {srv_id} is busy with another operation')
+                time.sleep(0.05)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def execute(srv_instance: Server, operation: str, func) -> dict:
+    started = time.perf_counter()
+    entry = Operation.objects.create(server_id=srv_instance.id, operation=operation)
+    try:
+        with server_lock(srv_instance.id):
+            entry.refresh_from_db(fields=['status', 'covered_by'])
+            if entry.status == Operation.SKIPPED:
+                observe('wg_operation_seconds', time.perf_counter() - started, server=srv_instance.id,
+                        operation=operation, status=Operation.SKIPPED)
+                return {'ok': True, 'msg': f'superseded by #{entry.covered_by}', 'skipped': True}
+            # Everything logged up to now is covered, state is read after this point
+            head = Operation.objects.filter(server_id=srv_instance.id, operation=operation,
+                                            status=Operation.PENDING).aggregate(head=Max('id'))['head']
+            srv_instance = Server.objects.filter(id=srv_instance.id).first() or srv_instance
+            result = func(srv_instance)
+            if result.get('ok') and operation == 'sync':
+                Operation.objects.filter(server_id=srv_instance.id, operation=operation, status=Operation.PENDING,
+                                         id__lte=head).exclude(id=entry.id).update(
+                    status=Operation.SKIPPED, covered_by=entry.id, update_at=timezone.now())
+    except ServerLocked as e:
+        result = {'ok': False, 'msg': str(e)}
+    except Exception as e:
+        Operation.objects.filter(id=entry.id).update(status=Operation.FAILED, result={'ok': False, 'msg': str(e)},
+                                                     update_at=timezone.now())
+        observe('wg_operation_seconds', time.perf_counter() - started, server=srv_instance.id, operation=operation,
+                status=Operation.FAILED)
+        raise
+    status = Operation.DONE if result.get('ok') else Operation.FAILED
+    Operation.objects.filter(id=entry.id).update(status=status, covered_by=entry.id, result=result,
+                                                 update_at=timezone.now())
+    observe('wg_operation_seconds', time.perf_counter() - started, server=srv_instance.id, operation=operation,
+            status=status)
+    trim(srv_instance.id)
+    return result
+
+
+def trim(srv_id: int):
+    deadline = timezone.now() - timedelta(days=settings.OPERATION_LOG_DAYS)
+    deleted, _ = Operation.objects.filter(server_id=srv_id, created_at__lt=deadline).delete()
+    if deleted:
+        logger.debug(f'operation log: {deleted} old entries of server {srv_id} deleted')
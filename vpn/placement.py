@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+# Automatic placement of clients on servers and rebalancing between servers.
+# Load of a server is its highest utilization of: enabled peers of "max_peers", traffic of the last
+# PLACEMENT_WINDOW seconds of "max_mbps" and used addresses of the network.
+# Server data: "placement": false - never chosen automatically, "max_peers" (default PLACEMENT_MAX_PEERS),
+# "max_mbps" - traffic the host is good for, no traffic limit when not set.
+
+import heapq
+import math
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from loguru import logger
+
+from .models import Client, PeerSample, Server
+
+
+class PlacementError(Exception):
+    pass
+
+
+class ServerLoad:
+    def __init__(self, srv_instance: Server, peers: int, rate: float, free: int, capacity: int):
+        self.srv = srv_instance
+        self.peers = peers
+        # Bytes per second, both directions
+        self.rate = rate
+        self.free = free
+        self.capacity = capacity
+        self.max_peers = int(srv_instance.data.get('max_peers') or settings.PLACEMENT_MAX_PEERS)
+        mbps = srv_instance.data.get('max_mbps')
+        self.max_rate = float(mbps) * 125000 if mbps else None
+
+    def ratios(self) -> dict:
+        return {'peers': self.peers / self.max_peers if self.max_peers else 0.0,
+                'traffic': self.rate / self.max_rate if self.max_rate else 0.0,
+                'addresses': 1 - self.free / self.capacity if self.capacity else 1.0}
+
+    @property
+    def score(self) -> float:
+        return max(self.ratios().values())
+
+    @property
+    def dominant(self) -> str:
+        ratios = self.ratios()
+        return max(ratios, key=ratios.get)
+
+    @property
+    def headroom(self) -> int:
+        # New clients the server can take
+        return max(min(self.free, self.max_peers - self.peers), 0)
+
+    def __str__(self):
+        return (f'{self.srv}: load {self.score:.2f} ({self.dominant}), {self.peers} peers, '
+                f'{self.rate * 8 / 10 ** 6:.1f} Mbit/s, {self.free} free addresses')
+
+
+def server_loads(servers=None) -> list:
+    # Three aggregate queries for all servers
+    from .ipam import capacity, free_count
+    if servers is None:
+        servers = Server.objects.filter(is_enable=True)
+    servers = [srv for srv in servers if srv.data.get('placement', True)]
+    ids = [srv.id for srv in servers]
+    peers = dict(Client.objects.filter(server_id__in=ids, is_enable=True).values('server_id').annotate(
+        n=Count('id')).values_list('server_id', 'n'))
+    since = int(time.time()) - settings.PLACEMENT_WINDOW
+    traffic = dict(PeerSample.objects.filter(server_id__in=ids, resolution=PeerSample.RAW, ts__gte=since).values(
+        'server_id').annotate(total=Sum(F('rx') + F('tx'))).values_list('server_id', 'total'))
+    return [ServerLoad(srv, peers.get(srv.id, 0), (traffic.get(srv.id) or 0) / settings.PLACEMENT_WINDOW,
+                       free_count(srv), capacity(srv)) for srv in servers]
+
+
+def choose_server() -> Server:
+    # Least loaded server with room for one more client
+    candidates = [load for load in server_loads() if load.headroom > 0]
+    if not candidates:
+        raise PlacementError('No server with free capacity for a new client')
+    return min(candidates, key=lambda load: (load.score, load.peers, load.srv.id)).srv
+
+
+def plan(count: int) -> dict:
+    # {server: number of new clients}, every client goes to the least loaded server at that moment
+    loads = [load for load in server_loads() if load.headroom > 0]
+    if sum(load.headroom for load in loads) < count:
+        raise PlacementError(f'Servers have room for {sum(load.headroom for load in loads)} new clients, '
+                             f'{count} requested')
+    heap = [(load.score, load.peers, load.srv.id, n) for n, load in enumerate(loads)]
+    heapq.heapify(heap)
+    result = {}
+    for _ in range(count):
+        *_, n = heapq.heappop(heap)
+        load = loads[n]
+        load.peers += 1
+        load.free -= 1
+        result[load.srv] = result.get(load.srv, 0) + 1
+        if load.headroom > 0:
+            heapq.heappush(heap, (load.score, load.peers, load.srv.id, n))
+    return result
+
+
+def migrate_clients(clients: list, target: Server):
+    # New addresses on the target, old ones back to the source pools, then one diff-only sync of every
+    # server involved (coalesced). Clients have to download their config again: endpoint and address change
+    from .coalesce import mark_dirty
+    from .config_cache import invalidate, invalidate_client_configs
+    from .ipam import allocate, assign, release
+    sources = {}
+    for client in clients:
+        sources.setdefault(client.server_id, []).append(client.data.get('ip'))
+    with transaction.atomic():
+        addresses = allocate(target.id, len(clients))
+        for srv_id, old_ips in sources.items():
+            if srv_id:
+                release(srv_id, *old_ips)
+        for client, address in zip(clients, addresses):
+            client.server = target
+            assign(client.data, address)
+            client.ip = address['ip']
+        # bulk_update sends no signals, caches and pushes are handled here
+        Client.objects.bulk_update(clients, ['server', 'data', 'ip'], batch_size=500)
+        invalidate(target.id, *sources)
+        invalidate_client_configs(*[client.rnd for client in clients])
+        for srv_id in {target.id, *sources} - {None}:
+            mark_dirty(srv_id)
+    logger.info(f'placement: {len(clients)} clients moved to server {target}')
+
+
+def client_rates(srv_id: int) -> dict:
+    # {client id: bytes per second} of enabled clients of the server over PLACEMENT_WINDOW
+    since = int(time.time()) - settings.PLACEMENT_WINDOW
+    traffic = dict(PeerSample.objects.filter(server_id=srv_id, resolution=PeerSample.RAW, ts__gte=since).values(
+        'public_key').annotate(total=Sum(F('rx') + F('tx'))).values_list('public_key', 'total'))
+    return {client_id: (traffic.get(public_key) or 0) / settings.PLACEMENT_WINDOW
+            for client_id, public_key in Client.objects.filter(server_id=srv_id, is_enable=True).values_list(
+                'id', 'data__public_key')}
+
+
+def rebalance(batch: int, limit: int = None, threshold: float = None, dry_run: bool = False):
+    # Moves clients from the most to the least loaded server until loads are within threshold of each other.
+    # Yields (source load, target load, clients) after every batch (committed, unless dry_run)
+    threshold = settings.PLACEMENT_THRESHOLD if threshold is None else threshold
+    loads = server_loads()
+    rates = {}
+    moved = set()
+    # A server which got clients is never a source in the same run, no ping-pong
+    received = set()
+    while len(loads) > 1 and (limit is None or len(moved) < limit):
+        source = max(loads, key=lambda load: load.score)
+        targets = [load for load in loads if load is not source and load.headroom > 0]
+        if source.srv.id in received or not targets or not source.peers:
+            return
+        target = min(targets, key=lambda load: (load.score, load.peers))
+        gap = source.score - target.score
+        if gap <= threshold:
+            return
+        # Clients to meet in the middle: load one client takes from the source and adds to the target
+        step = source.score / source.peers + max(1 / target.max_peers if target.max_peers else 0.0,
+                                                  1 / target.capacity if target.capacity else 0.0,
+                                                  target.score / target.peers if target.peers else 0.0)
+        count = min(batch, target.headroom, math.floor(gap / step),
+                    limit - len(moved) if limit is not None else batch)
+        if source.srv.id not in rates:
+            rates[source.srv.id] = client_rates(source.srv.id)
+        candidates = [(rate, client_id) for client_id, rate in rates[source.srv.id].items() if client_id not in moved]
+        if source.dominant == 'traffic':
+            # Busiest first, but never more than half of the traffic difference
+            budget = (source.rate - target.rate) / 2
+            chosen = []
+            for rate, client_id in sorted(candidates, reverse=True):
+                if len(chosen) < count and 0 < rate <= budget:
+                    chosen.append((rate, client_id))
+                    budget -= rate
+        else:
+            # Idle clients first, they notice the move least
+            chosen = sorted(candidates)[:count]
+        if not chosen:
+            return
+        clients = list(Client.objects.filter(id__in=[client_id for _, client_id in chosen]))
+        if not dry_run:
+            migrate_clients(clients, target.srv)
+        moved_rate = sum(rate for rate, _ in chosen)
+        for load, sign in ((source, -1), (target, 1)):
+            load.peers += sign * len(clients)
+            load.free -= sign * len(clients)
+            load.rate += sign * moved_rate
+        rates[source.srv.id] = {client_id: rate for client_id, rate in rates[source.srv.id].items()
+                                if client_id not in {c.id for c in clients}}
+        moved.update(client.id for client in clients)
+        received.add(target.srv.id)
+        yield source, target, clients
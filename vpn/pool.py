@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+import atexit
+import threading
+import time
+from contextlib import contextmanager
+
+import paramiko
+from django.conf import settings
+from loguru import logger
+
+from .metrics import inc, timer
+
+
+class SSHConnectError(Exception):
+    pass
+
+
+# Errors of a broken transport, raised by the first use of a dead pooled connection
+TRANSPORT_ERRORS = (EOFError, OSError, paramiko.SSHException)
+
+
+def ssh_port(srv_instance) -> int:
+    # Optional data["ssh_port"] for hosts with sshd on a non-standard port (and the local fake host of benchmarks)
+    return int(srv_instance.data.get('ssh_port') or 22)
+
+
+class PooledConnection:
+    # One authenticated SSH transport (and its SFTP channel) per server
+
+    def __init__(self, srv_id: int, hostname: str, port: int = 22):
+        self.srv_id = srv_id
+        self.hostname = hostname
+        self.port = port
+        self.client = None
+        self._sftp = None
+        self.last_used = time.monotonic()
+        self.lock = threading.RLock()
+
+    @property
+    def key_filename(self) -> str:
+        return f'{settings.BASE_DIR}/config/keys/{self.srv_id}'
+
+    def connect(self):
+        self.close()
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            with timer('wg_ssh_connect_seconds', server=self.srv_id):
+                client.connect(hostname=self.hostname, port=self.port, username='root',
+                               timeout=settings.SSH_CONNECT_TIMEOUT, key_filename=self.key_filename)
+        except Exception as e:
+            raise SSHConnectError(e) from e
+        client.get_transport().set_keepalive(settings.SSH_KEEPALIVE)
+        self.client = client
+
+    def is_alive(self) -> bool:
+        transport = self.client.get_transport() if self.client else None
+        if transport is None or not transport.is_active() or not transport.is_authenticated():
+            return False
+        try:
+            # Only catches a transport already known to be closed, a half-open TCP session shows up on first use
+            # and is retried by SSHBackend.run()
+            transport.send_ignore()
+        except (EOFError, OSError):
+            return False
+        return True
+
+    @property
+    def sftp(self):
+        if self._sftp is None or self._sftp.get_channel().closed:
+            self._sftp = self.client.open_sftp()
+        return self._sftp
+
+    def run(self, command: str) -> tuple:
+        # Wait for the command to finish, so channels are not left open on the shared transport
+        # Label is the program name only ("wg", "service", ...), full command lines would be unbounded
+        with timer('wg_ssh_command_seconds', server=self.srv_id, command=command.split(' ', 1)[0]):
+            stdin, stdout, stderr = self.client.exec_command(command)
+            out = stdout.read().decode('utf-8')
+            err = stderr.read().decode('utf-8')
+            return stdout.channel.recv_exit_status(), out, err
+
+    def close(self):
+        for item in (self._sftp, self.client):
+            if item is None:
+                continue
+            try:
+                item.close()
+            except Exception:  # noqa
+                pass
+        self._sftp = None
+        self.client = None
+
+
+class SSHPool:
+    def __init__(self):
+        self._connections = {}
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'reconnects': 0, 'evictions': 0}
+
+    def _count(self, name: str):
+        with self._lock:
+            self.counters[name] += 1
+        inc('wg_ssh_pool_total', event=name)
+
+    def evict_idle(self):
+        deadline = time.monotonic() - settings.SSH_POOL_IDLE_TIMEOUT
+        with self._lock:
+            idle = [srv_id for srv_id, conn in self._connections.items() if conn.last_used < deadline]
+            evicted = [self._connections.pop(srv_id) for srv_id in idle]
+        for conn in evicted:
+            # Connection in use right now will be closed after release
+            with conn.lock:
+                conn.close()
+            self._count('evictions')
+            logger.debug(f'ssh pool: evict idle connection to server {conn.srv_id}')
+
+    def _get(self, srv_instance) -> PooledConnection:
+        with self._lock:
+            conn = self._connections.get(srv_instance.id)
+            if conn is None:
+                conn = self._connections[srv_instance.id] = PooledConnection(srv_instance.id, srv_instance.ip,
+                                                                             ssh_port(srv_instance))
+            return conn
+
+    @contextmanager
+    def connection(self, srv_instance):
+        self.evict_idle()
+        conn = self._get(srv_instance)
+        with conn.lock:
+            address = (srv_instance.ip, ssh_port(srv_instance))
+            if conn.client is not None and (conn.hostname, conn.port) == address and conn.is_alive():
+                self._count('hits')
+            else:
+                self._count('reconnects' if conn.client is not None else 'misses')
+                conn.hostname, conn.port = address
+                conn.connect()
+            try:
+                yield conn
+            except (*TRANSPORT_ERRORS, SSHConnectError):
+                # Broken transport, next checkout will reconnect
+                conn.close()
+                raise
+            finally:
+                conn.last_used = time.monotonic()
+
+    def discard(self, srv_id: int):
+        with self._lock:
+            conn = self._connections.pop(srv_id, None)
+        if conn:
+            with conn.lock:
+                conn.close()
+
+    def close_all(self):
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for conn in connections:
+            conn.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self.counters, 'open': sum(1 for c in self._connections.values() if c.client is not None)}
+
+
+ssh_pool = SSHPool()
+atexit.register(ssh_pool.close_all)
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+import csv
+import io
+from ipaddress import ip_network
+
+from django.db import transaction
+from loguru import logger
+
+from .models import Client, Group, Server, key_gen, rnd_gen
+
+CSV_FIELDS = ['name', 'group', 'description', 'allowed']
+
+
+def clean_allowed(row: dict) -> str:
+    # Extra networks routed to the client, a bad one would break every later sync of the server
+    items = [item.strip() for item in (row.get('allowed') or '').split(',') if item.strip()]
+    try:
+        return ','.join(str(ip_network(item, strict=False)) for item in items)
+    except ValueError as e:
+        raise ValueError(f'Not valid allowed IPs "{row["allowed"]}" for client "{row["name"]}": {e}')
+
+
+def parse_csv(content: str) -> list:
+    # Header is optional, without header columns are: name, group, description, allowed
+    sample = content.lstrip().split('\n', 1)[0].lower()
+    has_header = 'name' in [s.strip() for s in sample.split(',')]
+    reader = csv.DictReader(io.StringIO(content), fieldnames=None if has_header else CSV_FIELDS)
+    rows = []
+    for row in reader:
+        row = {(k or '').strip().lower(): (v or '').strip() for k, v in row.items() if isinstance(v, str)}
+        if row.get('name'):
+            row['allowed'] = clean_allowed(row)
+            rows.append(row)
+    return rows
+
+
+def bulk_create_clients(srv_instance: Server, rows: list, group: Group = None, user=None,
+                        is_enable: bool = True, enable_download: bool = True) -> list:
+    # Keys and addresses for all clients at once, one insert batch and one config push at the end
+    from .coalesce import mark_dirty
+    from .config_cache import invalidate
+    from .ipam import allocate
+
+    groups = {g.name: g for g in Group.objects.filter(name__in={r['group'] for r in rows if r.get('group')})}
+    for row in rows:
+        if row.get('group') and row['group'] not in groups:
+            raise ValueError(f'Unknown client group "{row["group"]}" for client "{row["name"]}"')
+        if not row.get('group') and not group:
+            raise ValueError(f'No client group for client "{row["name"]}"')
+        row['allowed'] = clean_allowed(row)
+
+    keys = [key_gen() for _ in rows]
+    with transaction.atomic():
+        addresses = allocate(srv_instance.id, len(rows))
+        clients = [
+            Client(name=row['name'], description=row.get('description') or None, is_enable=is_enable,
+                   enable_download=enable_download, server=srv_instance, user=user, rnd=rnd_gen(),
+                   ip=address['ip'], group=groups[row['group']] if row.get('group') else group,
+                   data={**address, 'private_key': private_key, 'public_key': public_key,
+                         **({'allowed': row['allowed']} if row.get('allowed') else {})})
+            for row, address, (private_key, public_key) in zip(rows, addresses, keys)
+        ]
+        Client.objects.bulk_create(clients, batch_size=500)
+        # bulk_create sends no signals
+        invalidate(srv_instance.id)
+        mark_dirty(srv_instance.id)
+    logger.info(f'bulk create {len(clients)} clients on server {srv_instance}')
+    return clients
+
+
+def bulk_place_clients(rows: list, **kwargs) -> list:
+    # Spread new clients over servers by load, see placement.plan()
+    from .placement import plan
+    clients = []
+    with transaction.atomic():
+        for srv_instance, count in plan(len(rows)).items():
+            clients += bulk_create_clients(srv_instance, rows[len(clients):len(clients) + count], **kwargs)
+    return clients
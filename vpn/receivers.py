@@ -2,14 +2,33 @@
 
 __author__ = 'Nikolai Mamashin (mamashin@gmail.com)'
 
-from django.db.models.signals import post_save, post_delete
+from django.conf import settings
+from django.db.models.signals import post_init, post_save, post_delete
 from django.dispatch import receiver
 from loguru import logger
-from .models import Server, Client
+from .models import Server, Client, Group
+
+
+@receiver(post_init, sender=Server)
+def server_post_init(sender, instance: Server, **kwargs):
+    from .config_cache import client_configs_state, server_config_state
+    deferred = instance.get_deferred_fields()
+    instance._config_state = None if deferred & {'network', 'port', 'data'} else server_config_state(instance)
+    client_deferred = deferred & {'ip', 'network', 'port', 'data'}
+    instance._client_configs_state = None if client_deferred else client_configs_state(instance)
 
 
 @receiver(post_save, sender=Server)
 def server_post_save(sender, instance: Server, created, **kwargs):
+    from .config_cache import client_configs_state, server_config_state, invalidate, invalidate_client_configs
+    if server_config_state(instance) != instance._config_state:
+        instance._config_state = server_config_state(instance)
+        invalidate(instance.id)
+    if client_configs_state(instance) != instance._client_configs_state:
+        if not created:
+            # Endpoint and public key are in every client config of the server
+            invalidate_client_configs(*Client.objects.filter(server_id=instance.id).values_list('rnd', flat=True))
+        instance._client_configs_state = client_configs_state(instance)
     copy_ssh_key_id = None
     if created:
         if exist_srv := Server.objects.filter(ip=instance.ip).exclude(pk=instance.id).first():
@@ -18,19 +37,53 @@ def server_post_save(sender, instance: Server, created, **kwargs):
         from .services import ssh_keygen
         ssh_keygen(instance.id, copy_ssh_key_id)
     if not instance.is_enable:
+        if settings.JOB_QUEUE:
+            from .jobs import enqueue
+            enqueue(instance.id, 'stop')
+            return
         from .services import ssh_remote_server
         ssh_remote_server(instance, stop=True)
 
 
+@receiver(post_init, sender=Client)
+def client_post_init(sender, instance: Client, **kwargs):
+    from vpn.config_cache import client_config_state
+    # Reading deferred fields here would cost a query per instance, such instances always count as changed
+    deferred = instance.get_deferred_fields() & {'name', 'is_enable', 'server_id', 'data'}
+    instance._config_state = None if deferred else client_config_state(instance)
+
+
 @receiver(post_save, sender=Client)
 def client_post_save(sender, instance: Client, created, **kwargs):
-    from vpn.services import ssh_remote_server
-    # logger.info(instance)
-    ssh_remote_server(instance.server, client_instance=instance)
+    from vpn.coalesce import mark_dirty
+    from vpn.config_cache import client_config_state, invalidate, invalidate_client_configs
+    invalidate_client_configs(instance.rnd)
+    state = client_config_state(instance)
+    if not created and state == instance._config_state:
+        # Nothing that goes to the server config changed (download flag, description ...)
+        return
+    old_server_id = instance._config_state[2] if instance._config_state else None
+    instance._config_state = state
+    invalidate(instance.server_id, old_server_id)
+    for srv_id in {instance.server_id, old_server_id} - {None}:
+        mark_dirty(srv_id)
 
 
 @receiver(post_delete, sender=Client)
 def client_post_delete(sender, instance: Client, **kwargs):
-    from vpn.services import ssh_remote_server
-    instance.is_enable = False
-    ssh_remote_server(instance.server, client_instance=instance)
+    from vpn.coalesce import mark_dirty
+    from vpn.config_cache import invalidate, invalidate_client_configs
+    from vpn.ipam import release
+    invalidate_client_configs(instance.rnd)
+    if instance.server_id:
+        release(instance.server_id, instance.data.get('ip'))
+        if instance.is_enable:
+            invalidate(instance.server_id)
+            mark_dirty(instance.server_id)
+
+
+@receiver(post_save, sender=Group)
+def group_post_save(sender, instance: Group, created, **kwargs):
+    from vpn.config_cache import invalidate_client_configs
+    if not created:
+        invalidate_client_configs(*Client.objects.filter(group_id=instance.id).values_list('rnd', flat=True))
@@ -1,35 +1,44 @@
 # -*- coding: utf-8 -*-
 __author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
 
-import ipaddress
-import os
-import re
+import hashlib
+import time
+from ipaddress import ip_interface
 
 from decouple import config  # noqa
+from django.db.models import F
 from django.http import HttpResponse
-from django.core.cache import cache
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 from loguru import logger
-from .models import Client, Server
+from .models import Client, Server, client_addresses, parse_networks
 
-from datetime import datetime
-import humanize
 
-
-def generate_client_config(client_id: int = None) -> list:
-    client_instance = Client.objects.get(id=client_id)
-    server_instance = Server.objects.get(id=client_instance.server_id)
+def generate_client_config(client_id: int = None, client_instance: Client = None) -> list:
+    if client_instance is None:
+        client_instance = Client.objects.select_related('server', 'group').get(id=client_id)
+    server_instance = client_instance.server
+    server_interface = server_instance.get_interface(client_instance.data.get('interface'))
+    addresses = client_addresses(client_instance.data)
+    allowed_ips = client_instance.group.ips_for_config
+    if allowed_ips == '0.0.0.0/0':
+        # Full tunnel takes the traffic of every address family of the client
+        families = {ip_interface(address).version for address in addresses}
+        allowed_ips = ','.join(route for version, route in ((4, '0.0.0.0/0'), (6, '::/0')) if version in families)
+    # IPv6 literal endpoint needs brackets
+    host = f'[{server_instance.ip}]' if ':' in server_instance.ip else server_instance.ip
     all_clients = []
     interface = f"""
 [Interface]
-Address = {client_instance.data.get('ip')}/32
+Address = {', '.join(addresses)}
 PrivateKey = {client_instance.data.get('private_key')}
 DNS = 1.1.1.1,8.8.8.8
 """
     peer = f"""
 [Peer]
-Endpoint = {server_instance.ip}:{server_instance.port}
-PublicKey = {server_instance.data.get('public_key')}
-AllowedIPs = {client_instance.group.ips_for_config}
+Endpoint = {host}:{server_interface['port']}
+PublicKey = {server_interface['public_key']}
+AllowedIPs = {allowed_ips}
 
 """
     # AllowedIPs = {server_instance.data.get('route') if server_instance.data.get('route') else '0.0.0.0/0'}
@@ -38,55 +47,138 @@ AllowedIPs = {client_instance.group.ips_for_config}
     return all_clients
 
 
-def generate_server_config(srv_id) -> list:
-    server_instance = Server.objects.get(id=srv_id)
-    all_cfg = []
-    network = ipaddress.IPv4Network(server_instance.network)
-    interface = f"""
+def iter_server_config(srv_instance: Server, interface: str = None):
+    # Encoded config blocks of one interface (main by default) one by one,
+    # only needed client fields are fetched, in chunks
+    server_interface = srv_instance.get_interface(interface)
+    networks = parse_networks(server_interface['network'])
+    yield f"""
 [Interface]
-Address =  {network.network_address + 1}/{network.prefixlen}
-PrivateKey = {server_instance.data.get('private_key')}
-ListenPort = {server_instance.port}
+Address =  {', '.join(f'{network.network_address + 1}/{network.prefixlen}' for network in networks)}
+PrivateKey = {server_interface['private_key']}
+ListenPort = {server_interface['port']}
 Table = off
-"""
-    all_cfg.append(interface)
+""".encode()
 
-    for client in Client.objects.filter(is_enable=True, server_id=srv_id):
-        peer = f"""
+    persistent = srv_instance.data.get('persistent')
+    clients = Client.objects.filter(srv_instance.interface_clients(server_interface['name']), is_enable=True,
+                                    server_id=srv_instance.id).values_list('name', 'data')
+    for name, data in clients.iterator(chunk_size=2000):
+        yield f"""
 [Peer]
-# Name = {client.name}
-PublicKey = {client.data.get('public_key')}
-AllowedIPs = {client.data.get('ip')}/32{',' + client.data.get('allowed') if client.data.get('allowed') else ''}
-PersistentKeepalive = {server_instance.data.get('persistent')}
+# Name = {name}
+PublicKey = {data.get('public_key')}
+AllowedIPs = {','.join(client_addresses(data))}{',' + data.get('allowed') if data.get('allowed') else ''}
+PersistentKeepalive = {persistent}
 
-"""
-        all_cfg.append(peer)
-    return all_cfg
+""".encode()
 
 
-def get_client_file(client_instance: Client) -> HttpResponse:
-    if isinstance(client_instance, int):
-        logger.info(f'get_client_file: {client_instance}')
-        client_instance = Client.objects.get(id=client_instance)
-    raw_list = generate_client_config(client_instance.id)
+def generate_server_config(srv_id, interface: str = None) -> list:
+    return [chunk.decode() for chunk in iter_server_config(Server.objects.get(id=srv_id), interface)]
+
+
+def write_config_stream(file, chunks, buffer_size: int = 32768):
+    # Group small blocks into bigger writes, each write is one SFTP request
+    buffer = []
+    size = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= buffer_size:
+            file.write(b''.join(buffer))
+            buffer, size = [], 0
+    if buffer:
+        file.write(b''.join(buffer))
+
+
+def render_client_entry(client_instance: Client) -> dict:
+    # Rendered config of a client with validators for conditional GET
+    from .metrics import timer
+    with timer('wg_client_config_render_seconds'):
+        raw_list = generate_client_config(client_instance=client_instance)
+        body = (raw_list[0][0] + raw_list[0][1]).encode()
+    return {'id': client_instance.id, 'body': body, 'etag': f'"{hashlib.sha256(body).hexdigest()[:32]}"',
+            'last_modified': int(time.time())}
+
+
+def client_config_entry(client_instance: Client, store: bool = True) -> dict:
+    # Cached until client, server or group change
+    from .config_cache import get_client_config, set_client_config
+    from .metrics import inc
+    if entry := get_client_config(client_instance.rnd):
+        inc('wg_cache_requests_total', cache='client_config', result='hit')
+        return entry
+    inc('wg_cache_requests_total', cache='client_config', result='miss')
+    entry = render_client_entry(client_instance)
+    if store and client_instance.enable_download:
+        set_client_config(client_instance.rnd, entry)
+    return entry
+
+
+def file_validators(response: HttpResponse, entry: dict, fmt: str) -> HttpResponse:
+    from .export import artifact_etag
+    response.headers['ETag'] = artifact_etag(entry, fmt)
+    response.headers['Last-Modified'] = http_date(entry['last_modified'])
+    # Config contains private key, never store it in shared caches
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def not_modified(request, entry: dict, fmt: str):
+    from .export import artifact_etag
+    if request is None:
+        return None
+    response = get_conditional_response(request, etag=artifact_etag(entry, fmt), last_modified=entry['last_modified'])
+    return file_validators(response, entry, fmt) if response else None
+
+
+def file_response(entry: dict, fmt: str, body: bytes) -> HttpResponse:
+    from .export import FORMATS
+    content_type, disposition = FORMATS[fmt]
     response = HttpResponse(
-        content_type='application/octet-stream',
-        headers={'Content-Disposition': f'attachment; filename="vpn-wg-{client_instance.id}.conf"'},
+        body,
+        content_type=content_type,
+        headers={'Content-Disposition': f'{disposition}; filename="vpn-wg-{entry["id"]}.{fmt}"'},
     )
-    response.write(raw_list[0][0])
-    response.write(raw_list[0][1])
-    client_instance.download_count += 1
-    client_instance.save()
-    return response
+    return file_validators(response, entry, fmt)
+
+
+def client_file_response(request, entry: dict, fmt: str = 'conf') -> HttpResponse:
+    from .export import FORMATS, render_artifact, ExportUnavailable
+    if fmt not in FORMATS:
+        return HttpResponse(f'Unknown format {fmt}', status=404)
+    if response := not_modified(request, entry, fmt):
+        return response
+    try:
+        body = render_artifact(entry, fmt)
+    except ExportUnavailable as e:
+        return HttpResponse(str(e), status=501)
+    # Atomic counter, update() does not send signals (and does not push anything to the server)
+    Client.objects.filter(id=entry['id']).update(download_count=F('download_count') + 1)
+    return file_response(entry, fmt, body)
 
 
-def write_server_config(srv_id):
-    srv_data = generate_server_config(srv_id)
-    file = open(config('TMP_SERVER_FILE'), 'wb')
-    for srv in srv_data:
-        file.write(srv.encode())
-    file.close()
-    os.chmod(config('TMP_SERVER_FILE'), 0o600)
+async def aclient_file_response(request, entry: dict, fmt: str = 'conf') -> HttpResponse:
+    # Same for async views
+    from .export import FORMATS, arender_artifact, ExportUnavailable
+    if fmt not in FORMATS:
+        return HttpResponse(f'Unknown format {fmt}', status=404)
+    if response := not_modified(request, entry, fmt):
+        return response
+    try:
+        body = await arender_artifact(entry, fmt)
+    except ExportUnavailable as e:
+        return HttpResponse(str(e), status=501)
+    await Client.objects.filter(id=entry['id']).aupdate(download_count=F('download_count') + 1)
+    return file_response(entry, fmt, body)
+
+
+def get_client_file(client_instance: Client, request=None, fmt: str = 'conf') -> HttpResponse:
+    if isinstance(client_instance, int):
+        logger.info(f'get_client_file: {client_instance}')
+        client_instance = Client.objects.select_related('server', 'group').get(id=client_instance)
+    return client_file_response(request, client_config_entry(client_instance), fmt)
 
 
 def ssh_keygen(srv_id, copy_ssh_key_id=None):
@@ -106,72 +198,108 @@ def ssh_keygen(srv_id, copy_ssh_key_id=None):
 
 def ssh_remote_server(srv_instance: Server, client_instance: Client = None,
                       restart: bool = False, statistic: bool = False, stop: bool = False) -> dict:
+    if statistic:
+        return _remote_server(srv_instance, statistic=True)
+    # Changing operations are serialized per server and logged
+    from .oplog import execute
+    operation = 'restart' if restart else 'stop' if stop else 'push'
+    return execute(srv_instance, operation,
+                   lambda srv: _remote_server(srv, client_instance, restart=restart, stop=stop))
+
+
+def _remote_server(srv_instance: Server, client_instance: Client = None,
+                   restart: bool = False, statistic: bool = False, stop: bool = False) -> dict:
     result = {'ok': False}
-    import paramiko
-    from django.conf import settings
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    from .backends import BackendError, get_backend
+    from .pool import SSHConnectError
     try:
-        client.connect(hostname=srv_instance.ip, username='root', timeout=3,
-                       key_filename=f'{settings.BASE_DIR}/config/keys/{srv_instance.id}')
-    except Exception as e:
+        with get_backend(srv_instance) as backend:
+            if statistic:
+                stats = backend.stats()
+            else:
+                push_server_config(backend, srv_instance, client_instance, restart=restart, stop=stop)
+    except SSHConnectError as e:
         msg = f"can't connect to server via ssh: {e}"
         logger.error(msg)
         result['msg'] = msg
         return result
+    except BackendError as e:
+        logger.error(f'server {srv_instance}: {e}')
+        result['msg'] = str(e)
+        return result
 
     if statistic:
-        stats = {}
-        stdin, stdout, stderr = client.exec_command('wg show all dump')
-        out = stdout.read().decode('utf-8')
-        client.close()
-        """
-        Dumps looks like:
-        wg0	8GISFUGGDsg1AzV4co7FU6d6YQUyG3txxxxxxxxxxxx=	jvbsBUsx67JP1Au5Ejcy5dyRUzFbxxxxxxxxxxxx=	41800	off
-        wg0	ll1spR1+/PLDFVl0AKwzXT2P7fg+svwrU5dd3mx9nSI=	(none)	(none)	172.16.208.2/32	0	0	0	20
-        wg0	ZfHvDtfbF7/UANYN4RWa8mli3hL7tRgm5W1Uef/Sjkk=	(none)	(none)	172.16.208.3/32	0	0	0	20
-        wg0	p+pVmawyYA63GQZk5uU9VHC5P4+D6CmDAO/UR9vmwR0=	(none)	111.11.111.195:11122	172.16.208.4/32	1680364116	2581732	31106272	20
-        """
-        for line in [s.strip() for s in out.split('\n')]:
-            if not line:
-                continue
-            params = line.split('\t')
-            if len(params) != 9:
-                continue
-            stats[params[1]] = {
-                'interface': params[0],
-                'remote_ip': params[3] if params[3] != '(none)' else None,
-                'local_ip': params[4] if params[4] != '(none)' else None,
-                'last_handshake': params[5],
-                'rx_bytes': params[6],
-                'tx_bytes': params[7],
-                'last_seen': humanize.naturaltime(datetime.fromtimestamp(int(params[5]))) if int(params[5]) else '-',
-                'traffic': f'{humanize.naturalsize(int(params[6]))} / {humanize.naturalsize(int(params[7]))}'
-            }
-            # Store to cache for 5 minutes
-            cache.set(params[1], stats[params[1]], 300)
-
-        result['ok'] = True
-        return result
+        store_stats(stats)
 
-    sftp = client.open_sftp()
-    write_server_config(srv_instance.id)
+    result['ok'] = True
+    return result
 
-    remote_cfg_path = f'{config("WIREGUARD_CONFIG_BASE_PATH")}/{srv_instance.data.get("interface")}.conf'
-    sftp.put(config('TMP_SERVER_FILE'), remote_cfg_path)
-    sftp.chmod(remote_cfg_path, 0o600)
 
-    if client_instance and client_instance.is_enable:
-        stdin, stdout, stderr = client.exec_command(client_instance.set_add)
-    if client_instance and not client_instance.is_enable:
-        stdin, stdout, stderr = client.exec_command(client_instance.set_remove)
+def store_stats(stats: dict):
+    # One bulk write per dump, entries live STATS_TTL seconds
+    from .stats_store import get_stats_store
+    get_stats_store().set_many(stats)
 
-    if restart:
-        stdin, stdout, stderr = client.exec_command(f"service wg-quick@{srv_instance.data.get('interface')} restart")
-    if stop:
-        stdin, stdout, stderr = client.exec_command(f"service wg-quick@{srv_instance.data.get('interface')} stop")
-    sftp.close()
-    client.close()
 
-    result['ok'] = True
-    return result
+def upload_server_config(backend, srv_instance: Server, force: bool = False) -> bool:
+    # Stream config straight to a temporary file on the server, then atomically replace the real one.
+    # Skipped when the config did not change since the last upload
+    from .config_cache import HashingStream, config_version, is_pushed, set_pushed, store_hash
+    from .metrics import timer
+    if not force and is_pushed(srv_instance):
+        return False
+    version = config_version(srv_instance.id)
+    digests = []
+    # One file per interface, hash of the set is kept
+    for server_interface in srv_instance.interfaces:
+        stream = HashingStream(iter_server_config(srv_instance, server_interface['name']))
+        with timer('wg_config_upload_seconds', server=srv_instance.id):
+            backend.write_config(f'{config("WIREGUARD_CONFIG_BASE_PATH")}/{server_interface["name"]}.conf', stream)
+        digests.append(stream.hexdigest())
+    digest = digests[0] if len(digests) == 1 else hashlib.sha256(''.join(digests).encode()).hexdigest()
+    store_hash(srv_instance.id, version, digest)
+    set_pushed(srv_instance, digest)
+    return True
+
+
+def push_server_config(backend, srv_instance: Server, client_instance: Client = None,
+                       restart: bool = False, stop: bool = False):
+    from .sync import PeerDiff, client_peer, peer_keepalive
+    upload_server_config(backend, srv_instance)
+
+    if client_instance and client_instance.data.get('public_key'):
+        public_key = client_instance.data['public_key']
+        if client_instance.is_enable:
+            diff = PeerDiff(add={public_key: client_peer(client_instance.data, peer_keepalive(srv_instance))})
+        else:
+            diff = PeerDiff(remove=[public_key])
+        backend.apply(srv_instance.get_interface(client_instance.data.get('interface'))['name'], diff)
+
+    for server_interface in srv_instance.interfaces if restart or stop else []:
+        backend.run(f"service wg-quick@{server_interface['name']} {'restart' if restart else 'stop'}")
+
+
+def fan_out(items: list, func, timeout: float = None) -> list:
+    # Run func(item) concurrently for each item (server, job ...), results are in the same order as items
+    from concurrent.futures import ThreadPoolExecutor, wait
+    from django.conf import settings
+    from django.db import connection
+
+    def run(item):
+        try:
+            return func(item)
+        except Exception as e:  # noqa
+            logger.exception(f'fan out: {item} failed')
+            return {'ok': False, 'msg': str(e)}
+        finally:
+            connection.close()
+
+    if not items:
+        return []
+    executor = ThreadPoolExecutor(max_workers=min(len(items), settings.FAN_OUT_WORKERS))
+    futures = [executor.submit(run, item) for item in items]
+    wait(futures, timeout=timeout)
+    # Do not wait for hung servers, their threads finish in background
+    executor.shutdown(wait=False, cancel_futures=True)
+    return [f.result() if f.done() and not f.cancelled() else {'ok': False, 'msg': f'timeout after {timeout}s'}
+            for f in futures]
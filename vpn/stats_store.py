@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+# Storage for the last peer statistic, keyed by public key.
+# Selected by STATS_STORE setting: "sqlite" - SQLite table in WAL mode (default), "cache" - django cache
+
+import json
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+
+
+class CacheStatsStore:
+    def __init__(self, cache=None, ttl: int = None):
+        from django.core.cache import caches
+        # "stats" cache is sized for all peers, the default one may cull them
+        self.cache = cache or caches['stats' if 'stats' in settings.CACHES else 'default']
+        self.ttl = ttl or settings.STATS_TTL
+
+    def set_many(self, stats: dict):
+        self.cache.set_many(stats, self.ttl)
+
+    def get_many(self, keys: list) -> dict:
+        return self.cache.get_many(keys)
+
+    def get(self, key: str):
+        return self.cache.get(key)
+
+
+class SQLiteStatsStore:
+    # One row per peer, one transaction per dump, expired rows are evicted on write
+    chunk = 900
+
+    def __init__(self, path: str = None, ttl: int = None, table: str = 'peer_stats'):
+        self.path = str(path or settings.STATS_STORE_PATH)
+        self.ttl = ttl or settings.STATS_TTL
+        self.table = table
+        self._local = threading.local()
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute(f'CREATE TABLE IF NOT EXISTS {self.table} '
+                       '(public_key TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)')
+            self._local.db = db
+        return db
+
+    def set_many(self, stats: dict):
+        now = time.time()
+        rows = [(key, json.dumps(value), now + self.ttl) for key, value in stats.items()]
+        with self.db:
+            self.db.execute('BEGIN')
+            self.db.executemany(f'INSERT INTO {self.table} (public_key, data, expires) VALUES (?, ?, ?) '
+                                'ON CONFLICT(public_key) DO UPDATE SET data=excluded.data, expires=excluded.expires',
+                                rows)
+            self.db.execute(f'DELETE FROM {self.table} WHERE expires < ?', (now,))
+
+    def get_many(self, keys: list) -> dict:
+        found = {}
+        now = time.time()
+        keys = list(keys)
+        for i in range(0, len(keys), self.chunk):
+            chunk = keys[i:i + self.chunk]
+            rows = self.db.execute(f'SELECT public_key, data FROM {self.table} WHERE expires >= ? '
+                                   f'AND public_key IN ({",".join("?" * len(chunk))})', [now, *chunk])
+            found.update((key, json.loads(data)) for key, data in rows)
+        return found
+
+    def get(self, key: str):
+        return self.get_many([key]).get(key)
+
+
+STATS_STORES = {
+    'cache': CacheStatsStore,
+    'sqlite': SQLiteStatsStore,
+}
+
+_store = None
+_counter_store = None
+
+
+def get_stats_store():
+    global _store
+    if _store is None:
+        _store = STATS_STORES[settings.STATS_STORE]()
+    return _store
+
+
+def get_counter_store():
+    # Last counters of agent reports, baseline of the next delta. Own SQLite table whatever STATS_STORE is:
+    # nothing is culled, and idle peers missing from incremental reports keep the baseline for STATS_RAW_RETENTION
+    global _counter_store
+    if _counter_store is None:
+        _counter_store = SQLiteStatsStore(ttl=settings.STATS_RAW_RETENTION, table='peer_counters')
+    return _counter_store
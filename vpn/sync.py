@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+from ipaddress import ip_network
+
+from loguru import logger
+
+from .models import Client, Server, client_addresses
+
+
+def normalize_allowed_ips(value: str) -> frozenset:
+    if not value or value == '(none)':
+        return frozenset()
+    return frozenset(str(ip_network(ip.strip(), strict=False)) for ip in value.split(',') if ip.strip())
+
+
+def parse_live_peers(out: str) -> dict:
+    """
+    Parse `wg show <interface> dump`, first line is the interface itself:
+    8GISFUGGDsg1AzV4co7FU6d6YQUyG3txxxxxxxxxxxx=	jvbsBUsx67JP1Au5Ejcy5dyRUzFbxxxxxxxxxxxx=	41800	off
+    ll1spR1+/PLDFVl0AKwzXT2P7fg+svwrU5dd3mx9nSI=	(none)	(none)	172.16.208.2/32	0	0	0	20
+    """
+    peers = {}
+    for line in out.split('\n'):
+        params = line.strip().split('\t')
+        if len(params) != 8:
+            continue
+        peers[params[0]] = {'allowed_ips': normalize_allowed_ips(params[3]), 'keepalive': params[7]}
+    return peers
+
+
+def peer_keepalive(srv_instance: Server) -> str:
+    return str(srv_instance.data.get('persistent') or 'off')
+
+
+def client_peer(data: dict, keepalive: str) -> dict:
+    allowed = ','.join(client_addresses(data) + ([data['allowed']] if data.get('allowed') else []))
+    return {'allowed_ips': normalize_allowed_ips(allowed), 'keepalive': keepalive}
+
+
+def desired_peers(srv_instance: Server, interface: str = None) -> dict:
+    # Peers of one interface, main by default
+    keepalive = peer_keepalive(srv_instance)
+    peers = {}
+    clients = Client.objects.filter(srv_instance.interface_clients(srv_instance.get_interface(interface)['name']),
+                                    is_enable=True, server_id=srv_instance.id)
+    for data in clients.values_list('data', flat=True):
+        if not data.get('public_key') or not data.get('ip'):
+            continue
+        peers[data['public_key']] = client_peer(data, keepalive)
+    return peers
+
+
+class PeerDiff:
+    def __init__(self, add: dict = None, remove: list = None, update: dict = None):
+        self.add = add or {}
+        self.remove = remove or []
+        self.update = update or {}
+
+    def __len__(self):
+        return len(self.add) + len(self.remove) + len(self.update)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __str__(self):
+        return f'+{len(self.add)} -{len(self.remove)} ~{len(self.update)}'
+
+    def wg_set(self, interface: str) -> str:
+        # All changes in one `wg set` invocation, it accepts any number of peer clauses
+        clauses = []
+        for public_key, peer in {**self.add, **self.update}.items():
+            clause = f'peer {public_key} allowed-ips {",".join(sorted(peer["allowed_ips"]))}'
+            if peer['keepalive'] != 'off':
+                clause += f' persistent-keepalive {peer["keepalive"]}'
+            clauses.append(clause)
+        clauses.extend(f'peer {public_key} remove' for public_key in self.remove)
+        return f'wg set {interface} {" ".join(clauses)}'
+
+
+def diff_peers(desired: dict, live: dict) -> PeerDiff:
+    diff = PeerDiff()
+    for public_key, peer in desired.items():
+        if public_key not in live:
+            diff.add[public_key] = peer
+        elif live[public_key] != peer:
+            diff.update[public_key] = peer
+    diff.remove = [public_key for public_key in live if public_key not in desired]
+    return diff
+
+
+def sync_server(srv_instance: Server) -> dict:
+    # Serialized with other operations on the server, skipped when a later sync already covered it
+    from .oplog import execute
+    return execute(srv_instance, 'sync', _sync_server)
+
+
+def _sync_server(srv_instance: Server) -> dict:
+    # Reconcile live peers with enabled clients and push only the delta
+    from .backends import BackendError, InterfaceDown, get_backend
+    from .pool import SSHConnectError
+    from .services import upload_server_config
+    result = {'ok': False}
+    diffs = {}
+    down = []
+    try:
+        with get_backend(srv_instance) as backend:
+            # Config files are rewritten only if their content changed (also names, not visible in live peers)
+            result['uploaded'] = upload_server_config(backend, srv_instance)
+            for interface in [server_interface['name'] for server_interface in srv_instance.interfaces]:
+                try:
+                    live = backend.peers(interface)
+                except InterfaceDown as e:
+                    # Interface is down, config file is already actual for the next start
+                    logger.warning(f'sync {srv_instance}: {interface} is not up ({e}), config uploaded only')
+                    down.append(str(e))
+                    continue
+                diffs[interface] = diff_peers(desired_peers(srv_instance, interface), live)
+                if diffs[interface]:
+                    backend.apply(interface, diffs[interface])
+    except SSHConnectError as e:
+        msg = f"can't connect to server via ssh: {e}"
+        logger.error(msg)
+        result['msg'] = msg
+        return result
+    except BackendError as e:
+        result['msg'] = str(e)
+        logger.error(f'sync {srv_instance} failed: {result["msg"]}')
+        return result
+    if len(diffs) == 1 and not down:
+        diff = str(*diffs.values())
+    else:
+        diff = ', '.join(f'{interface} {interface_diff}' for interface, interface_diff in diffs.items())
+    if diffs:
+        result['diff'] = diff
+    if down:
+        result['msg'] = '; '.join(down)
+    if any(diffs.values()):
+        logger.info(f'sync {srv_instance}: {diff}')
+    result['ok'] = True
+    return result
@@ -1,3 +1,715 @@
-from django.test import TestCase
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
 
-# Create your tests here.
+# python manage.py test vpn
+# Push and sync run over ssh against a local fake WireGuard host (vpn/fakehost.py), no real server is touched
+
+import tempfile
+from contextlib import contextmanager
+from ipaddress import ip_address, ip_network
+from unittest import mock
+
+from django.core.exceptions import ValidationError
+from django.test import TestCase, override_settings
+
+from vpn import coalesce
+from vpn.models import Client, Group, Operation, Server
+from vpn.stats_store import SQLiteStatsStore
+
+TEST_SETTINGS = {
+    'CACHES': {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'vpn-tests'}},
+    'PUSH_DEBOUNCE': 3600,
+    'JOB_QUEUE': False,
+    'METRICS_ENABLED': False,
+    'SERVER_LOCK_DIR': tempfile.mkdtemp(prefix='wg-test-locks-'),
+}
+
+
+@override_settings(**TEST_SETTINGS)
+class VpnTestCase(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        coalesce._pending.clear()
+        coalesce._retries = 0
+        self.addCleanup(self.cancel_flush)
+        # No ssh keys of test servers in config/keys, fake_host() makes a temporary one
+        patcher = mock.patch('vpn.services.ssh_keygen')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Empty stats store for every test
+        stats_dir = tempfile.TemporaryDirectory(prefix='wg-test-stats-')
+        self.addCleanup(stats_dir.cleanup)
+        for name in ('_store', '_counter_store'):
+            store = mock.patch(f'vpn.stats_store.{name}', SQLiteStatsStore(f'{stats_dir.name}/stats.sqlite3',
+                                                                         table=name.strip('_')))
+            store.start()
+            self.addCleanup(store.stop)
+        self.group = Group.objects.create(name='test')
+
+    @staticmethod
+    def cancel_flush():
+        # Retries of failed pushes are not run after the test
+        if coalesce._timer is not None:
+            coalesce._timer.cancel()
+            coalesce._timer = None
+
+    def make_server(self, name='s1', network='10.10.10.0/24', **kwargs) -> Server:
+        return Server.objects.create(name=name, ip='127.0.0.1', network=network, **kwargs)
+
+    def make_client(self, srv_instance, name='c', **kwargs) -> Client:
+        return Client.objects.create(name=name, server=srv_instance, group=self.group, **kwargs)
+
+    @contextmanager
+    def fake_host(self, srv_instance, *interfaces):
+        from vpn.bench import fake_host
+        with fake_host(srv_instance) as host:
+            for name in interfaces:
+                host.wireguard.add_interface(name)
+            srv_instance.refresh_from_db()
+            yield host
+
+    @property
+    def config_path(self) -> str:
+        from decouple import config
+        return config('WIREGUARD_CONFIG_BASE_PATH')
+
+
+class SSHPoolTests(VpnTestCase):
+    def test_reconnect_once_on_dead_transport(self):
+        from vpn.pool import PooledConnection
+        from vpn.sync import sync_server
+        srv = self.make_server()
+        self.make_client(srv)
+        run = PooledConnection.run
+        calls = []
+
+        def flaky(conn, command):
+            calls.append(command)
+            if len(calls) == 1:
+                raise EOFError()
+            return run(conn, command)
+
+        with self.fake_host(srv) as host, mock.patch.object(PooledConnection, 'run', flaky):
+            self.assertTrue(sync_server(srv)['ok'])
+            self.assertEqual(len(host.wireguard.interfaces['wg0']['peers']), 1)
+        self.assertEqual(calls[0], calls[1])
+
+
+class PeerDiffTests(TestCase):
+    def peer(self, *ips, keepalive='20'):
+        from vpn.sync import normalize_allowed_ips
+        return {'allowed_ips': normalize_allowed_ips(','.join(ips)), 'keepalive': keepalive}
+
+    def test_diff_peers(self):
+        from vpn.sync import diff_peers
+        desired = {'a': self.peer('10.0.0.2/32'), 'b': self.peer('10.0.0.3/32'), 'c': self.peer('10.0.0.4/32')}
+        live = {'b': self.peer('10.0.0.3/32'), 'c': self.peer('10.0.0.9/32'), 'd': self.peer('10.0.0.5/32')}
+        diff = diff_peers(desired, live)
+        self.assertEqual(list(diff.add), ['a'])
+        self.assertEqual(list(diff.update), ['c'])
+        self.assertEqual(diff.remove, ['d'])
+        self.assertEqual(str(diff), '+1 -1 ~1')
+        self.assertFalse(diff_peers(desired, dict(desired)))
+
+    def test_normalized_allowed_ips_are_equal(self):
+        from vpn.sync import diff_peers
+        desired = {'a': self.peer('10.0.0.2', '192.168.1.0/24')}
+        live = {'a': self.peer('192.168.1.0/24', '10.0.0.2/32')}
+        self.assertFalse(diff_peers(desired, live))
+
+    def test_wg_set(self):
+        from vpn.sync import PeerDiff
+        diff = PeerDiff(add={'a': self.peer('10.0.0.3/32', '10.0.0.2/32')},
+                        update={'b': self.peer('10.0.0.4/32', keepalive='off')}, remove=['c'])
+        self.assertEqual(diff.wg_set('wg0'), 'wg set wg0 peer a allowed-ips 10.0.0.2/32,10.0.0.3/32 '
+                                             'persistent-keepalive 20 peer b allowed-ips 10.0.0.4/32 peer c remove')
+
+
+class SyncTests(VpnTestCase):
+    def test_sync_and_push(self):
+        from vpn.services import ssh_remote_server
+        from vpn.sync import sync_server
+        srv = self.make_server()
+        clients = [self.make_client(srv, f'c{n}') for n in range(3)]
+        with self.fake_host(srv) as host:
+            result = sync_server(srv)
+            self.assertTrue(result['ok'])
+            self.assertEqual(result['diff'], '+3 -0 ~0')
+            peers = host.wireguard.interfaces['wg0']['peers']
+            self.assertEqual({k: p['allowed_ips'] for k, p in peers.items()},
+                             {c.data['public_key']: f'{c.ip}/32' for c in clients})
+            self.assertIn('# Name = c0', host.wireguard.files[f'{self.config_path}/wg0.conf'].decode())
+
+            # Nothing changed: no upload, no wg set
+            host.wireguard.commands.clear()
+            result = sync_server(srv)
+            self.assertEqual((result['diff'], result['uploaded']), ('+0 -0 ~0', False))
+            self.assertFalse([c for c in host.wireguard.commands if c.startswith('wg set')])
+
+            clients[0].delete()
+            self.make_client(srv, 'c3')
+            self.assertEqual(sync_server(srv)['diff'], '+1 -1 ~0')
+            self.assertEqual(len(peers), 3)
+
+            client = self.make_client(srv, 'c4')
+            self.assertTrue(ssh_remote_server(srv, client)['ok'])
+            self.assertIn(client.data['public_key'], peers)
+
+    def test_interface_down(self):
+        from vpn.sync import sync_server
+        srv = self.make_server()
+        self.make_client(srv)
+        with self.fake_host(srv) as host:
+            host.wireguard.interfaces.clear()
+            result = sync_server(srv)
+            self.assertTrue(result['ok'])
+            self.assertIn('No such device', result['msg'])
+            self.assertIn(f'{self.config_path}/wg0.conf', host.wireguard.files)
+
+
+class CoalesceTests(VpnTestCase):
+    def test_flush_syncs_every_dirty_server_once(self):
+        s1, s2 = self.make_server(), self.make_server('s2', port=41801)
+        for srv_id in (s1.id, s2.id, s1.id):
+            coalesce.mark_dirty(srv_id)
+        with mock.patch('vpn.sync.sync_server', return_value={'ok': True}) as sync_server:
+            result = coalesce.flush()
+        self.assertEqual(set(result), {s1.id, s2.id})
+        self.assertEqual(sync_server.call_count, 2)
+        self.assertEqual(coalesce.pending(), set())
+
+    def test_flush_survives_failed_server(self):
+        s1, s2 = self.make_server(), self.make_server('s2', port=41801)
+        coalesce.mark_dirty(s1.id)
+        coalesce.mark_dirty(s2.id)
+
+        def sync_server(srv):
+            if srv.id == s1.id:
+                raise ValueError('bad client')
+            return {'ok': True}
+
+        with mock.patch('vpn.sync.sync_server', side_effect=sync_server):
+            result = coalesce.flush()
+        self.assertEqual(result[s2.id], {'ok': True})
+        self.assertFalse(result[s1.id]['ok'])
+        # Failed server is pushed again with the next flush
+        self.assertEqual(coalesce.pending(), {s1.id})
+
+    @override_settings(PUSH_DEBOUNCE=2, PUSH_RETRY_MAX=10)
+    def test_failed_push_is_retried_with_backoff(self):
+        srv = self.make_server()
+        coalesce.mark_dirty(srv.id)
+        intervals = []
+        with mock.patch('vpn.sync.sync_server', return_value={'ok': False, 'msg': 'wg0 is down'}):
+            for _ in range(4):
+                coalesce.flush()
+                intervals.append(coalesce._timer.interval)
+                self.cancel_flush()
+        self.assertEqual(intervals, [2, 4, 8, 10])
+        self.assertEqual(coalesce.pending(), {srv.id})
+        with mock.patch('vpn.sync.sync_server', return_value={'ok': True}):
+            coalesce.flush()
+        self.assertEqual((coalesce.pending(), coalesce._timer, coalesce._retries), (set(), None, 0))
+
+
+class JobTests(VpnTestCase):
+    def test_one_running_job_per_server(self):
+        from vpn.jobs import claim_job
+        from vpn.models import Job
+        s1, s2 = self.make_server(), self.make_server('s2', port=41801)
+        first = Job.objects.create(server=s1, operation='sync')
+        Job.objects.create(server=s1, operation='restart')
+        other = Job.objects.create(server=s2, operation='sync')
+        self.assertEqual([claim_job(), claim_job(), claim_job()], [first, other, None])
+
+    def test_claim_is_conditional(self):
+        from vpn.jobs import claim_job
+        from vpn.models import Job
+        srv = self.make_server()
+        job = Job.objects.create(server=srv, operation='sync')
+        running = Job.objects.create(server=srv, operation='stop')
+
+        def lock_server():
+            # Another worker starts a job of the server after the candidates were read
+            Job.objects.filter(id=running.id).update(status=Job.RUNNING)
+            return Server.objects.all()
+
+        with mock.patch.object(Server.objects, 'select_for_update', side_effect=lock_server):
+            self.assertIsNone(claim_job())
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.PENDING)
+
+    def test_requeue_stale(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from vpn.jobs import requeue_stale
+        from vpn.models import Job
+        job = Job.objects.create(server=self.make_server(), operation='sync', status=Job.RUNNING)
+        self.assertEqual(requeue_stale(), 0)
+        Job.objects.filter(id=job.id).update(update_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(requeue_stale(), 1)
+
+
+class CollectorTests(VpnTestCase):
+    def test_downsample(self):
+        from vpn.collector import downsample
+        from vpn.models import PeerSample
+        srv = self.make_server()
+        now = 100 * 86400
+        hour = (now - 3 * 86400) // PeerSample.HOURLY * PeerSample.HOURLY
+
+        def sample(ts, resolution=PeerSample.RAW, rx=0):
+            PeerSample.objects.create(server=srv, public_key='k', ts=ts, resolution=resolution, rx=rx, handshake=ts)
+
+        sample(hour + 10, rx=100)
+        sample(hour + 20, rx=260)
+        sample(now - 60, rx=5)
+        sample(now - 200 * 86400, PeerSample.HOURLY, rx=1)
+        with self.settings(STATS_RAW_RETENTION=86400, STATS_RETENTION=90 * 86400):
+            self.assertEqual(downsample(now), (1, 2, 1))
+        hourly = PeerSample.objects.get(resolution=PeerSample.HOURLY)
+        self.assertEqual((hourly.ts, hourly.rx, hourly.handshake), (hour, 360, hour + 20))
+        self.assertEqual(hourly.rx_rate, 360 / PeerSample.HOURLY)
+        # Fresh raw samples stay
+        self.assertEqual(list(PeerSample.objects.filter(resolution=PeerSample.RAW).values_list('rx', flat=True)), [5])
+
+
+class StatsStoreTests(TestCase):
+    def setUp(self):
+        path = tempfile.mkdtemp(prefix='wg-test-stats-')
+        self.store = SQLiteStatsStore(f'{path}/stats.sqlite3', ttl=60)
+
+    def test_set_and_get(self):
+        self.store.set_many({'a': {'rx_bytes': 1}, 'b': {'rx_bytes': 2}})
+        self.store.set_many({'a': {'rx_bytes': 3}})
+        self.assertEqual(self.store.get_many(['a', 'b', 'c']), {'a': {'rx_bytes': 3}, 'b': {'rx_bytes': 2}})
+        self.assertEqual(self.store.get('b'), {'rx_bytes': 2})
+        self.assertIsNone(self.store.get('c'))
+
+    def test_ttl_and_eviction(self):
+        import time
+        now = time.time()
+        self.store.set_many({'old': {'rx_bytes': 1}})
+        with mock.patch('vpn.stats_store.time.time', return_value=now + 61):
+            # Expired rows are not returned, and deleted with the next write
+            self.assertIsNone(self.store.get('old'))
+            self.store.set_many({'new': {'rx_bytes': 2}})
+            rows = self.store.db.execute('SELECT public_key FROM peer_stats').fetchall()
+        self.assertEqual(rows, [('new',)])
+
+    def test_many_keys(self):
+        stats = {f'k{n}': {'rx_bytes': n} for n in range(2500)}
+        self.store.set_many(stats)
+        self.assertEqual(self.store.get_many(list(stats)), stats)
+
+    def test_cache_store_alias(self):
+        from django.core.cache import caches
+        from vpn.stats_store import CacheStatsStore
+        locmem = 'django.core.cache.backends.locmem.LocMemCache'
+        with self.settings(CACHES={'default': {'BACKEND': locmem}, 'stats': {'BACKEND': locmem, 'LOCATION': 'stats'}}):
+            self.assertIs(CacheStatsStore().cache, caches['stats'])
+        with self.settings(CACHES={'default': {'BACKEND': locmem}}):
+            self.assertIs(CacheStatsStore().cache, caches['default'])
+
+
+class IpamTests(VpnTestCase):
+    def test_allocate_and_release(self):
+        from vpn.ipam import allocate, release
+        srv = self.make_server()
+        first, second = allocate(srv.id, 2)
+        self.assertEqual((first['ip'], second['ip']), ('10.10.10.2', '10.10.10.3'))
+        release(srv.id, first['ip'])
+        # Released address is reused first, then never used ones
+        self.assertEqual([a['ip'] for a in allocate(srv.id, 2)], ['10.10.10.2', '10.10.10.4'])
+
+    def test_release_twice_and_foreign_address(self):
+        from vpn.ipam import allocate, free_count, release
+        srv = self.make_server()
+        address = allocate(srv.id)[0]
+        srv.refresh_from_db()
+        free = free_count(srv)
+        release(srv.id, address['ip'], address['ip'], '192.168.0.1', 'garbage')
+        srv.refresh_from_db()
+        self.assertEqual(free_count(srv), free + 1)
+
+    def test_pool_exhausted(self):
+        from vpn.ipam import AddressPoolExhausted, allocate, free_count
+        srv = self.make_server(network='10.10.10.0/29')
+        # .0 network, .1 server, .7 broadcast
+        self.assertEqual(free_count(srv), 5)
+        self.assertEqual(len(allocate(srv.id, 5)), 5)
+        with self.assertRaises(AddressPoolExhausted):
+            allocate(srv.id)
+
+    def test_client_address(self):
+        srv = self.make_server()
+        clients = [self.make_client(srv, f'c{n}') for n in range(3)]
+        self.assertEqual([c.ip for c in clients], ['10.10.10.2', '10.10.10.3', '10.10.10.4'])
+        clients[1].delete()
+        self.assertEqual(self.make_client(srv, 'new').ip, '10.10.10.3')
+
+    def test_move_client_to_other_server(self):
+        s1, s2 = self.make_server(), self.make_server('s2', network='10.20.0.0/24', port=41801)
+        client = self.make_client(s1)
+        client.server = s2
+        client.save()
+        self.assertEqual(client.ip, '10.20.0.2')
+        s1.refresh_from_db()
+        self.assertEqual(s1.data['ip_free'], [2])
+
+
+class ProvisionTests(VpnTestCase):
+    def test_parse_csv(self):
+        from vpn.provision import parse_csv
+        rows = parse_csv('name,group,description,allowed\nc1,,,"192.168.1.0/24, 10.1.1.1"\n,,,\nc2,,,\n')
+        self.assertEqual([(r['name'], r['allowed']) for r in rows],
+                         [('c1', '192.168.1.0/24,10.1.1.1/32'), ('c2', '')])
+        with self.assertRaisesMessage(ValueError, 'bad'):
+            parse_csv('bad,,,10.1.1.0/33')
+
+    def test_bulk_create(self):
+        from vpn.provision import bulk_create_clients
+        srv = self.make_server()
+        clients = bulk_create_clients(srv, [{'name': f'c{n}'} for n in range(5)], group=self.group)
+        self.assertEqual(len({c.ip for c in clients}), 5)
+        self.assertEqual(coalesce.pending(), {srv.id})
+        with self.assertRaisesMessage(ValueError, 'c9'):
+            bulk_create_clients(srv, [{'name': 'c9', 'allowed': 'nope'}], group=self.group)
+
+
+class ConfigDownloadTests(VpnTestCase):
+    def test_etag_and_not_modified(self):
+        client = self.make_client(self.make_server())
+        response = self.client.get(f'/cfg/{client.rnd}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(f'Address = {client.ip}/32', b''.join(response.streaming_content).decode()
+                      if response.streaming else response.content.decode())
+        etag = response.headers['ETag']
+        response = self.client.get(f'/cfg/{client.rnd}/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # Changed config gets a new tag
+        self.group.ips = '10.0.0.0/8'
+        self.group.save()
+        response = self.client.get(f'/cfg/{client.rnd}/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_server_save_invalidates_on_change_only(self):
+        srv = self.make_server()
+        client = self.make_client(srv)
+        with mock.patch('vpn.config_cache.invalidate_client_configs') as invalidate:
+            # Nothing of client configs changed
+            srv.data['agent_token'] = 'hash'
+            srv.save()
+            invalidate.assert_not_called()
+            srv.port = 41900
+            srv.save()
+            invalidate.assert_called_once_with(client.rnd)
+            srv.save()
+            invalidate.assert_called_once()
+            Server.objects.get(id=srv.id).save()
+            invalidate.assert_called_once()
+
+    def test_download_disabled(self):
+        client = self.make_client(self.make_server(), enable_download=False)
+        self.assertEqual(self.client.get(f'/cfg/{client.rnd}/').status_code, 404)
+
+
+class ExportTests(VpnTestCase):
+    def test_admin_download_needs_login(self):
+        from django.contrib.auth.models import User
+        client = self.make_client(self.make_server())
+        url = f'/admin/vpn/client/get_config/{client.id}/json/'
+        self.assertEqual(self.client.get(url).status_code, 302)
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_conf_to_dict(self):
+        from vpn.export import conf_to_dict
+        body = b'[Interface]\nAddress = 10.0.0.2/32\n# comment\n\n[Peer]\nEndpoint = 1.2.3.4:41800\n' \
+               b'AllowedIPs = 0.0.0.0/0\n[Peer]\nPublicKey = a=b=\n'
+        self.assertEqual(conf_to_dict(body), {'interface': {'Address': '10.0.0.2/32'},
+                                              'peers': [{'Endpoint': '1.2.3.4:41800', 'AllowedIPs': '0.0.0.0/0'},
+                                                        {'PublicKey': 'a=b='}]})
+
+    def test_zip(self):
+        import io
+        import zipfile
+        from vpn.export import iter_zip
+        srv = self.make_server()
+        clients = [self.make_client(srv, f'c/{n}') for n in range(3)]
+        Client.objects.filter(id=clients[2].id).update(server=None)
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(iter_zip(Client.objects.all()))))
+        self.assertEqual(archive.namelist(), [f'test/c_{n}-{clients[n].id}.conf' for n in range(2)])
+        self.assertIn(clients[0].data['private_key'], archive.read(archive.namelist()[0]).decode())
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(iter_zip(Client.objects.all(), 'server', 'json'))))
+        self.assertEqual(archive.namelist()[0], f's1/c_0-{clients[0].id}.json')
+
+
+class AdminSearchTests(VpnTestCase):
+    def search(self, term: str) -> list:
+        from django.contrib.admin.sites import site
+        from django.test import RequestFactory
+        found, _ = site._registry[Client].get_search_results(RequestFactory().get('/'), Client.objects.all(), term)
+        return sorted(found.values_list('name', flat=True))
+
+    def test_search_by_address(self):
+        dual = self.make_server(network='10.10.10.0/24, fd00:10::/64')
+        self.make_client(dual, 'dual')
+        self.make_client(self.make_server('s2', port=41801, network='fd00:20::/64'), 'v6')
+        self.make_client(dual, 'fd00:20::2 lab')
+        self.assertEqual(self.search('10.10.10.2'), ['dual'])
+        self.assertEqual(self.search('FD00:10:0::2'), ['dual'])
+        self.assertEqual(self.search('fd00:20::2'), ['fd00:20::2 lab', 'v6'])
+        self.assertEqual(self.search('dual'), ['dual'])
+
+
+class DashboardTests(TestCase):
+    def state(self, clients: dict, online: int = 1) -> dict:
+        return {'servers': {'1': {'name': 's1', 'online': online}}, 'clients': clients,
+                'totals': {'servers': 1, 'online': online}}
+
+    def test_diff_state(self):
+        from vpn.dashboard import diff_state
+        first = self.state({'a': {'name': 'a', 'rx_rate': 1}, 'b': {'name': 'b', 'rx_rate': 2}})
+        # Everything is new for a fresh stream
+        self.assertEqual(diff_state({}, first), first)
+        self.assertEqual(diff_state(first, first), {})
+        second = self.state({'a': {'name': 'a', 'rx_rate': 5}, 'c': {'name': 'c', 'rx_rate': 0}})
+        self.assertEqual(diff_state(first, second), {'clients': {'a': {'rx_rate': 5}, 'c': {'name': 'c', 'rx_rate': 0},
+                                                                 'b': None}})
+        third = self.state({}, online=0)
+        self.assertEqual(diff_state(second, third), {'servers': {'1': {'online': 0}},
+                                                     'clients': {'a': None, 'c': None},
+                                                     'totals': {'servers': 1, 'online': 0}})
+
+
+class DumpParseTests(TestCase):
+    DUMP = ('wg0\tprivate\tpublic\t41800\toff\n'
+            'wg0\tkey-a\t(none)\t198.51.100.1:5000\t10.0.0.2/32\t1700000000\t100\t200\t20\n'
+            'wg0\tkey-b\t(none)\t(none)\t(none)\t0\t0\t0\toff\n'
+            'wg1\tkey-c\t(none)\t[2001:db8::1]:5000\t10.1.0.2/32,fd00::2/128\t1699999000\t5\t7\toff\n')
+
+    def test_parse(self):
+        from vpn.dump import parse
+        table = parse(self.DUMP)
+        self.assertEqual(len(table), 3)
+        self.assertEqual(table.totals(), (105, 207))
+        self.assertEqual(table.online(1700000100, 180), 1)
+        records = table.records()
+        self.assertEqual(records['key-a'], {'interface': 'wg0', 'remote_ip': '198.51.100.1:5000',
+                                            'local_ip': '10.0.0.2/32', 'last_handshake': 1700000000,
+                                            'rx_bytes': 100, 'tx_bytes': 200})
+        self.assertEqual((records['key-b']['remote_ip'], records['key-b']['local_ip']), (None, None))
+        self.assertEqual(records['key-c']['interface'], 'wg1')
+
+    def test_empty(self):
+        from vpn.dump import parse
+        for out in ('', 'wg0\tprivate\tpublic\t41800\toff\n'):
+            table = parse(out)
+            self.assertEqual((len(table), table.totals(), table.records()), (0, (0, 0), {}))
+
+
+class IngestTests(VpnTestCase):
+    def test_authenticate(self):
+        from vpn.ingest import authenticate, issue_token
+        srv = self.make_server()
+        token = issue_token(srv)
+        self.assertEqual(authenticate(f'Bearer {srv.id}.{token}'), srv)
+        for header in (None, '', f'Bearer {srv.id}.wrong', f'Basic {srv.id}.{token}', f'Bearer x.{token}',
+                       f'Bearer {srv.id}', f'Bearer {srv.id + 1}.{token}'):
+            self.assertIsNone(authenticate(header), header)
+
+    def test_authenticate_disabled_server(self):
+        from vpn.ingest import authenticate, issue_token
+        srv = self.make_server()
+        token = issue_token(srv)
+        Server.objects.filter(id=srv.id).update(is_enable=False)
+        self.assertIsNone(authenticate(f'Bearer {srv.id}.{token}'))
+
+    def test_samples(self):
+        from vpn.ingest import ingest
+        from vpn.models import PeerSample
+        srv = self.make_server()
+        self.assertEqual(ingest(srv, {'ts': 1000, 'full': True, 'peers': {'k': ['wg0', None, '', 5, 100, 50]}})[
+                             'samples'], 0)
+        # tx counter was reset
+        ingest(srv, {'ts': 1010, 'peers': {'k': ['wg0', None, '', 5, 300, 20]}})
+        sample = PeerSample.objects.get()
+        self.assertEqual((sample.rx, sample.tx, sample.rx_rate, sample.tx_rate), (200, 20, 20.0, 2.0))
+
+    def test_counters_are_not_culled(self):
+        from django.core.cache.backends.locmem import LocMemCache
+        from vpn.ingest import ingest
+        from vpn.models import PeerSample
+        from vpn.stats_store import CacheStatsStore
+        srv = self.make_server()
+        # Statistic for display may be culled, counters of the next delta are kept anyway
+        culling = CacheStatsStore(LocMemCache('culling', {'OPTIONS': {'MAX_ENTRIES': 300}}), ttl=300)
+        with mock.patch('vpn.stats_store._store', culling):
+            for ts, rx in ((1000, 100), (1010, 300)):
+                peers = {f'k{n}': ['wg0', None, '', 5, rx, 0] for n in range(500)}
+                ingest(srv, {'ts': ts, 'full': True, 'peers': peers})
+        self.assertEqual(PeerSample.objects.filter(rx=200).count(), 500)
+
+
+class OperationLogTests(VpnTestCase):
+    def test_sync_covers_earlier_syncs(self):
+        from vpn.oplog import execute
+        srv = self.make_server()
+        waiting = Operation.objects.create(server=srv, operation='sync')
+        func = mock.Mock(return_value={'ok': True})
+        self.assertEqual(execute(srv, 'sync', func), {'ok': True})
+        func.assert_called_once()
+        waiting.refresh_from_db()
+        entry = Operation.objects.exclude(id=waiting.id).get()
+        self.assertEqual((waiting.status, waiting.covered_by), (Operation.SKIPPED, entry.id))
+        self.assertEqual(entry.status, Operation.DONE)
+
+    def test_failed_sync_covers_nothing(self):
+        from vpn.oplog import execute
+        srv = self.make_server()
+        waiting = Operation.objects.create(server=srv, operation='sync')
+        execute(srv, 'sync', lambda s: {'ok': False, 'msg': 'failed'})
+        waiting.refresh_from_db()
+        self.assertEqual(waiting.status, Operation.PENDING)
+
+    def test_superseded_sync_is_skipped(self):
+        from vpn import oplog
+        srv = self.make_server()
+        lock = oplog.server_lock
+
+        @contextmanager
+        def covered_while_waiting(srv_id, timeout=None):
+            # Another sync finished while this one waited for the lock
+            Operation.objects.filter(server_id=srv_id, status=Operation.PENDING).update(
+                status=Operation.SKIPPED, covered_by=0)
+            with lock(srv_id, timeout):
+                yield
+
+        func = mock.Mock(return_value={'ok': True})
+        with mock.patch('vpn.oplog.server_lock', covered_while_waiting):
+            result = oplog.execute(srv, 'sync', func)
+        self.assertTrue(result['skipped'])
+        func.assert_not_called()
+
+
+class MetricsTests(TestCase):
+    def test_render(self):
+        from vpn.metrics import BUCKETS, render
+        series = [0] * len(BUCKETS) + [0.0, 0]
+        series[0], series[2], series[-2], series[-1] = 2, 1, 0.012, 3
+        data = {'histograms': {'wg_operation_seconds': {(('server', '1'),): series}},
+                'counters': {'wg_cache_requests_total': {(('cache', 'a"b'), ('result', 'hit')): 4}}}
+        lines = render(data).splitlines()
+        self.assertIn('# TYPE wg_operation_seconds histogram', lines)
+        self.assertIn('wg_operation_seconds_bucket{server="1",le="0.001"} 2', lines)
+        self.assertIn('wg_operation_seconds_bucket{server="1",le="0.005"} 2', lines)
+        self.assertIn('wg_operation_seconds_bucket{server="1",le="0.01"} 3', lines)
+        self.assertIn('wg_operation_seconds_bucket{server="1",le="+Inf"} 3', lines)
+        self.assertIn('wg_operation_seconds_sum{server="1"} 0.012', lines)
+        self.assertIn('wg_operation_seconds_count{server="1"} 3', lines)
+        self.assertIn('# TYPE wg_cache_requests_total counter', lines)
+        self.assertIn('wg_cache_requests_total{cache="a\\"b",result="hit"} 4', lines)
+
+    def test_quantile(self):
+        from vpn.metrics import BUCKETS, quantile
+        series = [0] * len(BUCKETS) + [0.0, 0]
+        self.assertIsNone(quantile(series, 0.5))
+        series[1], series[-1] = 10, 10
+        self.assertEqual(quantile(series, 0.99), BUCKETS[1])
+
+    @override_settings(METRICS_TOKEN='secret', **TEST_SETTINGS)
+    def test_token(self):
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+        for header in ('Bearer wrong', 'Bearer секрет', 'secret', ''):
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION=header).status_code, 401, header)
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+
+
+class PlacementTests(VpnTestCase):
+    def test_new_client_goes_to_least_loaded_server(self):
+        from vpn.placement import plan
+        s1, s2 = self.make_server(), self.make_server('s2', network='10.20.0.0/24', port=41801)
+        for n in range(3):
+            self.make_client(s1, f'c{n}')
+        client = Client(name='auto', group=self.group)
+        client.save()
+        self.assertEqual(client.server, s2)
+        self.assertEqual({srv.name: count for srv, count in plan(4).items()}, {'s1': 1, 's2': 3})
+
+    def test_servers_out_of_placement(self):
+        from vpn.placement import PlacementError, choose_server
+        self.make_server(data={'placement': False})
+        with self.assertRaises(PlacementError):
+            choose_server()
+
+
+class DualStackTests(VpnTestCase):
+    def test_dual_stack(self):
+        from vpn.ipam import allocate
+        srv = self.make_server(network='10.10.10.0/24, fd00:10::/64')
+        address = allocate(srv.id)[0]
+        self.assertEqual(address, {'interface': 'wg0', 'ip': '10.10.10.2', 'ip6': 'fd00:10::2'})
+        # Smaller IPv4 network limits the pool
+        srv.refresh_from_db()
+        from vpn.ipam import free_count
+        self.assertEqual(free_count(srv), 252)
+
+    def allowed_ips(self, srv_instance) -> str:
+        from vpn.services import generate_client_config
+        self.group.ips = '0.0.0.0/0'
+        self.group.save()
+        client = self.make_client(srv_instance)
+        peer = generate_client_config(client_instance=Client.objects.get(id=client.id))[0][1]
+        return next(line for line in peer.splitlines() if line.startswith('AllowedIPs')).split(' = ')[1]
+
+    def test_full_tunnel(self):
+        self.assertEqual(self.allowed_ips(self.make_server()), '0.0.0.0/0')
+
+    def test_full_tunnel_dual_stack(self):
+        self.assertEqual(self.allowed_ips(self.make_server(network='10.10.10.0/24, fd00:10::/64')), '0.0.0.0/0,::/0')
+
+    def test_full_tunnel_ipv6_only(self):
+        self.assertEqual(self.allowed_ips(self.make_server(network='fd00:10::/64')), '::/0')
+
+    def test_several_interfaces(self):
+        from vpn.ipam import allocate, free_count, release
+        srv = self.make_server(data={'interfaces': [{'name': 'wg1', 'port': 41801, 'network': '10.10.11.0/24'}]})
+        addresses = allocate(srv.id, 4)
+        self.assertEqual(sorted(a['interface'] for a in addresses), ['wg0', 'wg0', 'wg1', 'wg1'])
+        for address in addresses:
+            network = ip_network(srv.get_interface(address['interface'])['network'])
+            self.assertIn(ip_address(address['ip']), network)
+        self.assertEqual(allocate(srv.id, interface='wg1')[0]['ip'], '10.10.11.4')
+        release(srv.id, '10.10.11.2')
+        srv.refresh_from_db()
+        self.assertEqual(srv.data['ipam']['wg1']['ip_free'], [2])
+        self.assertEqual(free_count(srv, 'wg1'), 251)
+
+    def test_interface_with_clients_is_not_removed(self):
+        srv = self.make_server(data={'interfaces': [{'name': 'wg1', 'port': 41801, 'network': '10.10.11.0/24'}]})
+        client = self.make_client(srv, 'c1')
+        self.make_client(srv, 'c2')
+        self.assertEqual({client.data['interface'], Client.objects.get(name='c2').data['interface']}, {'wg0', 'wg1'})
+        srv.data['interfaces'] = []
+        with self.assertRaises(ValidationError):
+            srv.full_clean(exclude=['user'])
+
+    def test_several_interfaces_dual_stack(self):
+        from vpn.sync import sync_server
+        srv = self.make_server(network='10.10.10.0/24, fd00:10::/64',
+                               data={'interfaces': [{'name': 'wg1', 'port': 41801, 'network': '10.10.11.0/24'}]})
+        clients = [self.make_client(srv, f'c{n}') for n in range(4)]
+        with self.fake_host(srv, 'wg1') as host:
+            result = sync_server(srv)
+            self.assertEqual(result['diff'], 'wg0 +2 -0 ~0, wg1 +2 -0 ~0')
+            for client in clients:
+                peer = host.wireguard.interfaces[client.data['interface']]['peers'][client.data['public_key']]
+                expected = [f'{client.ip}/32'] + ([f'{client.data["ip6"]}/128'] if client.data.get('ip6') else [])
+                self.assertEqual(sorted(peer['allowed_ips'].split(',')), sorted(expected))
+            self.assertIn('Address =  10.10.10.1/24, fd00:10::1/64',
+                          host.wireguard.files[f'{self.config_path}/wg0.conf'].decode())
+            self.assertIn('ListenPort = 41801', host.wireguard.files[f'{self.config_path}/wg1.conf'].decode())
@@ -2,13 +2,71 @@
 
 __author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
 
-from django.http import HttpResponse
+import json
+
+from django.http import HttpResponse, JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from loguru import logger
 from vpn.models import Client
-from vpn.services import get_client_file
+from vpn.config_cache import aget_client_config, aset_client_config
+from vpn.metrics import inc, timer
+from vpn.services import aclient_file_response, render_client_entry
+
+
+async def get_vpn_config(request, rnd_id, fmt='conf'):
+    from vpn.export import FORMATS
+    # Format comes from the url, unknown ones share one label value
+    with timer('wg_download_seconds', format=fmt if fmt in FORMATS else 'other') as labels:
+        response = await _get_vpn_config(request, rnd_id, fmt)
+        labels['status'] = response.status_code
+    return response
+
+
+async def _get_vpn_config(request, rnd_id, fmt):
+    # Cached config is served without touching client, server and group rows
+    entry = await aget_client_config(rnd_id)
+    inc('wg_cache_requests_total', cache='client_config', result='miss' if entry is None else 'hit')
+    if entry is None:
+        wg = await Client.objects.select_related('server', 'group').filter(rnd=rnd_id).filter(
+            enable_download=True).afirst()
+        if not wg:
+            return HttpResponse('Config not found ¯\_(ツ)_/¯', status=404)
+        entry = render_client_entry(wg)
+        await aset_client_config(wg.rnd, entry)
+    return await aclient_file_response(request, entry, fmt)
+
+
+async def empty_response(request):
+    return HttpResponse('<code>Hello, world via VPN !</code>', status=200)
+
+
+@csrf_exempt
+@require_POST
+def agent_ingest(request):
+    # Statistic pushed by agent/wg_agent.py
+    from vpn.ingest import IngestError, authenticate, decode_body, ingest
+    srv = authenticate(request.headers.get('Authorization'))
+    if not srv:
+        return JsonResponse({'ok': False, 'msg': 'unauthorized'}, status=401)
+    try:
+        payload = json.loads(decode_body(request.body, request.headers.get('Content-Encoding')))
+        return JsonResponse(ingest(srv, payload))
+    except (IngestError, ValueError) as e:
+        logger.warning(f'agent report from {srv} rejected: {e}')
+        return JsonResponse({'ok': False, 'msg': str(e)}, status=400)
 
 
-def get_vpn_config(request, rnd_id):
-    wg = Client.objects.filter(rnd=rnd_id).filter(enable_download=True).first()
-    if not wg:
-        return HttpResponse('Config not found ¯\_(ツ)_/¯', status=404)
-    return get_client_file(wg)
+def metrics(request):
+    # Prometheus scrape endpoint: staff session or "Authorization: Bearer <METRICS_TOKEN>"
+    import hmac
+    from django.conf import settings
+    from vpn.metrics import collect, render
+    token = settings.METRICS_TOKEN
+    authorized = request.user.is_authenticated and request.user.is_staff
+    if not authorized and token:
+        # Bytes, compare_digest() raises TypeError on non-ASCII str
+        authorized = hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode())
+    if not authorized:
+        return HttpResponse('Unauthorized', status=401, content_type='text/plain')
+    return HttpResponse(render(collect()), content_type='text/plain; version=0.0.4; charset=utf-8')